@@ -0,0 +1,162 @@
+"""Admission control in front of the conversation handlers.
+
+Every update takes a token of its user and, in the states listed in `state_limits`, a token of its user in that state.
+An update finding no token waits for one if it comes within `max_delay` and is dropped otherwise. While more handler
+work than `high_watermark` is pending, updates are shed before any token is looked at. Dropped and shed updates get
+a cheap "slow down" reply, at most one per user every `WARNING_INTERVAL_SECONDS`.
+"""
+from __future__ import annotations
+
+import asyncio
+import functools
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import ConversationHandler
+
+import metrics
+from sender import TokenBucket
+
+# updates per second of one user on average, and at once
+USER_RATE = 1.0
+USER_BURST = 10.0
+# longest wait for a token, a waiting update of a polling bot holds up the updates behind it
+MAX_DELAY_SECONDS = 0.5
+# handler callbacks running or waiting for a token plus updates not dispatched yet
+HIGH_WATERMARK = 256
+WARNING_INTERVAL_SECONDS = 10.0
+# refilled buckets are forgotten once there are more buckets than this
+MAX_BUCKETS = 10_000
+
+# (updates per second, burst) of a user in a state
+StateLimits = Dict[Hashable, Tuple[float, float]]
+Rejection = Callable[[Update, Any], Awaitable[None]]
+
+
+@dataclass
+class AdmissionStats:
+    pending: int
+    admitted: int
+    delayed: int
+    dropped: int
+    shed: int
+
+
+class AdmissionController:
+    """Token buckets per user and per user and state, and load shedding, wrapped around handler callbacks.
+
+    `reject(update, context)` sends the "slow down" reply. A refused callback returns None, which keeps the
+    conversation in its state.
+    """
+
+    def __init__(self,
+                 reject: Rejection,
+                 user_rate: float = USER_RATE,
+                 user_burst: float = USER_BURST,
+                 state_limits: Optional[StateLimits] = None,
+                 max_delay: float = MAX_DELAY_SECONDS,
+                 high_watermark: int = HIGH_WATERMARK,
+                 queued: Callable[[], int] = lambda: 0,
+                 clock: Callable[[], float] = time.monotonic,
+                 ):
+        self.reject = reject
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.state_limits = state_limits or dict()
+        self.max_delay = max_delay
+        self.high_watermark = high_watermark
+        self.pending = 0
+        self._queued = queued
+        self._clock = clock
+        # by (user id, state), the state is None for the bucket of the user
+        self._buckets: Dict[Tuple[int, Hashable], TokenBucket] = dict()
+        self._warned_at: Dict[int, float] = dict()
+        self._counts = {"admitted": 0, "delayed": 0, "dropped": 0, "shed": 0}
+
+    def backlog(self) -> int:
+        return self.pending + self._queued()
+
+    def stats(self) -> AdmissionStats:
+        return AdmissionStats(pending=self.pending, **self._counts)
+
+    def _bucket(self, user_id: int, state: Hashable) -> Optional[TokenBucket]:
+        bucket = self._buckets.get((user_id, state))
+        if bucket is not None:
+            return bucket
+        if state is None:
+            rate, burst = self.user_rate, self.user_burst
+        elif state in self.state_limits:
+            rate, burst = self.state_limits[state]
+        else:
+            return None
+        if len(self._buckets) >= MAX_BUCKETS:
+            self._forget_idle()
+        bucket = self._buckets[(user_id, state)] = TokenBucket(rate, burst, self._clock)
+        return bucket
+
+    def _forget_idle(self) -> None:
+        self._buckets = {key: bucket for key, bucket in self._buckets.items() if not bucket.is_full()}
+        now = self._clock()
+        self._warned_at = {user_id: warned_at for user_id, warned_at in self._warned_at.items()
+                           if now - warned_at < WARNING_INTERVAL_SECONDS}
+
+    def admit(self, user_id: int, state: Hashable = None) -> Optional[float]:
+        """Takes the tokens of an update and returns the seconds to wait for them, None if it is to be dropped."""
+        buckets = [self._bucket(user_id, None)]
+        state_bucket = self._bucket(user_id, state) if state is not None else None
+        if state_bucket is not None:
+            buckets.append(state_bucket)
+        wait = max(bucket.delay() for bucket in buckets)
+        if wait > self.max_delay:
+            return None
+        for bucket in buckets:
+            bucket.reserve()
+        return wait
+
+    def _count(self, outcome: str) -> None:
+        self._counts[outcome] += 1
+        if outcome != "admitted":
+            metrics.ADMISSION_OUTCOMES.labels(outcome).inc()
+
+    async def _refuse(self, update: Update, context: Any, user_id: int, outcome: str) -> None:
+        self._count(outcome)
+        now = self._clock()
+        warned_at = self._warned_at.get(user_id)
+        if warned_at is None or now - warned_at >= WARNING_INTERVAL_SECONDS:
+            self._warned_at[user_id] = now
+            await self.reject(update, context)
+
+    def guard(self, callback: Callable, state: Hashable = None) -> Callable:
+        """Wraps the handler callback `callback` of the conversation state `state`, None for the entry points."""
+
+        @functools.wraps(callback)
+        async def guarded(update: Update, context: Any):
+            user = update.effective_user
+            if user is None:
+                return await callback(update, context)
+            if self.backlog() >= self.high_watermark:
+                return await self._refuse(update, context, user.id, "shed")
+            wait = self.admit(user.id, state)
+            if wait is None:
+                return await self._refuse(update, context, user.id, "dropped")
+
+            self.pending += 1
+            try:
+                if wait > 0:
+                    self._count("delayed")
+                    await asyncio.sleep(wait)
+                self._count("admitted")
+                return await callback(update, context)
+            finally:
+                self.pending -= 1
+
+        return guarded
+
+    def guard_conversation(self, conversation: ConversationHandler) -> None:
+        for handler in [*conversation.entry_points, *conversation.fallbacks]:
+            handler.callback = self.guard(handler.callback)
+        for state, handlers in conversation.states.items():
+            for handler in handlers:
+                handler.callback = self.guard(handler.callback, state)
@@ -0,0 +1,112 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+os.environ.setdefault("WISHLIST_BOT_TOKEN", "123:test")
+
+import main
+import metrics
+from admission import AdmissionController
+from db import create_tables_dict
+from fake_transport import FakeRequest, UpdateFactory, run_bot
+
+
+def fake_update(user_id: int):
+    return SimpleNamespace(effective_user=SimpleNamespace(id=user_id))
+
+
+def test_tokens_per_user_and_per_state() -> None:
+    now = [0.0]
+    controller = AdmissionController(reject=None,
+                                     user_rate=1,
+                                     user_burst=4,
+                                     state_limits={"costly": (0.5, 2)},
+                                     max_delay=2.0,
+                                     clock=lambda: now[0])
+    assert [controller.admit(1, "costly") for _ in range(3)] == [0, 0, 2.0]
+    # the tokens of the delayed update are taken, the next one would wait too long
+    assert controller.admit(1, "costly") is None
+    assert controller.admit(1, "cheap") == 0
+    assert controller.admit(2, "costly") == 0
+
+    now[0] = 2.0
+    assert controller.admit(1, "costly") == 2.0
+    now[0] = 60.0
+    controller._forget_idle()
+    assert set(controller._buckets) == set()
+
+
+def test_bursts_are_delayed_then_dropped() -> None:
+    rejected = []
+
+    async def reject(update, context) -> None:
+        rejected.append(update.effective_user.id)
+
+    async def handler(update, context) -> str:
+        return "handled"
+
+    controller = AdmissionController(reject, user_rate=100, user_burst=5, state_limits={"costly": (20, 2)},
+                                     max_delay=0.1)
+    guarded = controller.guard(handler, "costly")
+    dropped_before = metrics.ADMISSION_OUTCOMES.labels("dropped").value()
+
+    async def burst():
+        return await asyncio.gather(*(guarded(fake_update(1), None) for _ in range(8)),
+                                    guarded(fake_update(2), None))
+
+    results = asyncio.run(burst())
+    # two at once, two more within 0.1s at 20 per second, the rest is dropped with one warning
+    assert results == ["handled"] * 4 + [None] * 4 + ["handled"]
+    assert rejected == [1]
+    stats = controller.stats()
+    assert (stats.admitted, stats.delayed, stats.dropped, stats.shed, stats.pending) == (5, 2, 4, 0, 0)
+    assert metrics.ADMISSION_OUTCOMES.labels("dropped").value() == dropped_before + 4
+
+
+def test_load_is_shed_above_the_high_watermark() -> None:
+    rejected = []
+
+    async def reject(update, context) -> None:
+        rejected.append(update.effective_user.id)
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def handler(update, context) -> str:
+            await release.wait()
+            return "handled"
+
+        controller = AdmissionController(reject, high_watermark=3)
+        guarded = controller.guard(handler)
+        tasks = [asyncio.create_task(guarded(fake_update(user_id), None)) for user_id in range(5)]
+        await asyncio.sleep(0.01)
+        assert controller.backlog() == 3
+        release.set()
+        return await asyncio.gather(*tasks), controller.stats()
+
+    results, stats = asyncio.run(scenario())
+    assert results == ["handled"] * 3 + [None] * 2
+    assert rejected == [3, 4]
+    assert (stats.admitted, stats.shed) == (3, 2)
+
+
+def test_a_flood_of_see_wishes_gets_a_slow_down_reply(tmp_path, monkeypatch) -> None:
+    db_path = str(tmp_path / "admission.db")
+    create_tables_dict(db_path)
+    request = FakeRequest()
+    updates = UpdateFactory()
+
+    flood = [updates.message(1, "@nobody") for _ in range(6)]
+    run_bot(monkeypatch, db_path, request,
+            [updates.message(1, "/start"), updates.message(1, "See wishes"), *flood,
+             updates.message(2, "/start")])
+
+    texts = [call.parameters["text"] for call in request.calls_of("sendMessage")]
+    assert texts.count("User's wishes were not found, please try again") == 3
+    assert texts.count(main.SLOW_DOWN_TEXT) == 1
+    # other users are not held back
+    replies_to_other = [call.parameters["text"] for call in request.calls_of("sendMessage")
+                        if int(call.parameters["chat_id"]) == 2]
+    assert replies_to_other and main.SLOW_DOWN_TEXT not in replies_to_other
+    stats = main.admission.stats()
+    assert (stats.dropped, stats.shed) == (3, 0)
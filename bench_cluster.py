@@ -0,0 +1,124 @@
+"""Measures how handled updates/s scale with the number of worker processes of a cluster, fully offline.
+
+The synthetic conversations of `loadtest.py` are routed through the ingress of a `cluster.Cluster` whose workers
+talk to the fake Bot API transport. Besides wall clock throughput, every worker reports the CPU time it spent, which
+tells the cost of an update independently of the cores available to the benchmark.
+
+Example: `python bench_cluster.py --workers 1 2 4 --users 2000 --json cluster.json`
+"""
+from __future__ import annotations
+
+import argparse
+import functools
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+from dataclasses import dataclass, asdict
+from itertools import zip_longest
+from typing import List
+
+os.environ.setdefault("WISHLIST_BOT_TOKEN", "123:loadtest")
+
+from cluster import Cluster
+from fake_transport import FakeRequest
+from loadtest import make_scripts, seed_database
+
+# updates per routed delivery, as many as a getUpdates call returns at most
+DELIVERY_SIZE = 100
+
+
+@dataclass
+class ClusterRun:
+    workers: int
+    updates: int
+    seconds: float
+    updates_per_second: float
+    speedup: float
+    # CPU milliseconds per update, summed over the workers
+    worker_cpu_ms_per_update: float
+    busiest_worker_share: float
+
+
+def run_cluster(workers: int,
+                users: int,
+                seed: int = 0,
+                see_ratio: float = 0.5,
+                creators: int = 50,
+                wishes_per_creator: int = 15,
+                api_latency: float = 0.0,
+                ) -> ClusterRun:
+    rng = random.Random(seed)
+    db_path = os.path.join(tempfile.mkdtemp(prefix="wishlist-cluster-"), "wishlist.db")
+    seed_database(db_path, creators, wishes_per_creator, rng)
+    # replies are not rate limited against the fake transport
+    cluster = Cluster("123:loadtest",
+                      workers=workers,
+                      db_path=db_path,
+                      request_factory=functools.partial(FakeRequest, latency=api_latency),
+                      global_rate=10 ** 6,
+                      chat_rate=10 ** 6,
+                      chat_burst=10 ** 6,
+                      log_level=logging.WARNING)
+    cluster.start()
+
+    scripts = make_scripts(users, see_ratio, creators, rng)
+    # users talk at the same time, each one waits for nothing but the order of their own updates is kept
+    stream = [payload for step in zip_longest(*scripts) for payload in step if payload is not None]
+    started = time.perf_counter()
+    for i in range(0, len(stream), DELIVERY_SIZE):
+        cluster.route(stream[i:i + DELIVERY_SIZE])
+    reports = cluster.stop()
+    elapsed = time.perf_counter() - started
+
+    return ClusterRun(workers=workers,
+                      updates=len(stream),
+                      seconds=elapsed,
+                      updates_per_second=len(stream) / elapsed,
+                      speedup=0.0,
+                      worker_cpu_ms_per_update=sum(report.cpu_seconds for report in reports) * 1000 / len(stream),
+                      busiest_worker_share=max(report.updates for report in reports) / len(stream))
+
+
+def print_runs(runs: List[ClusterRun]) -> None:
+    print(f"{'workers':>8}{'updates':>9}{'seconds':>9}{'updates/s':>11}{'speedup':>9}{'cpu ms/update':>15}"
+          f"{'busiest':>9}")
+    for run in runs:
+        print(f"{run.workers:>8}{run.updates:>9}{run.seconds:>9.2f}{run.updates_per_second:>11.0f}"
+              f"{run.speedup:>9.2f}{run.worker_cpu_ms_per_update:>15.3f}{run.busiest_worker_share:>9.0%}")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--see-ratio", type=float, default=0.5, help="share of users browsing instead of wishing")
+    parser.add_argument("--creators", type=int, default=50)
+    parser.add_argument("--wishes-per-creator", type=int, default=15)
+    parser.add_argument("--api-latency", type=float, default=0.0, help="seconds per fake Bot API call")
+    parser.add_argument("--json", help="also write the results to this file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    runs = []
+    for workers in args.workers:
+        run = run_cluster(workers,
+                          users=args.users,
+                          seed=args.seed,
+                          see_ratio=args.see_ratio,
+                          creators=args.creators,
+                          wishes_per_creator=args.wishes_per_creator,
+                          api_latency=args.api_latency)
+        run.speedup = run.updates_per_second / runs[0].updates_per_second if runs else 1.0
+        runs.append(run)
+    print_runs(runs)
+    print(f"{os.cpu_count()} CPUs available")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump([asdict(run) for run in runs], f, indent=2)
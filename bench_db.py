@@ -0,0 +1,333 @@
+"""Micro-benchmarks of the `db` hot paths over a large synthetic wishlist database.
+
+Example: `python bench_db.py --wishes 100000 --json bench.json --compare baseline.json`
+"""
+from __future__ import annotations
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, asdict
+from typing import Callable, Dict, List
+
+import db
+from db import FEED_VISIBILITY, Booked, Feed, TableName, Wish, create_tables_dict, current_time_in_ms_since_1970, db_ops
+from wishdata import WishData, WishOrder
+from writer import GroupCommitWriter
+
+GENERATION_BATCH_SIZE = 10_000
+ADJECTIVES = ["red", "blue", "wooden", "electric", "vintage", "tiny", "warm", "silver", "folding", "smart"]
+NOUNS = ["bike", "book", "lamp", "scarf", "camera", "kettle", "guitar", "watch", "backpack", "puzzle",
+         "headphones", "teapot", "tent", "skates", "umbrella", "notebook", "plant", "mug", "drone", "chess"]
+# model names make wish names specific, like real product names are
+MODELS = 5000
+BENCH_MAX_PRICE = 30.0
+
+
+@dataclass
+class Dataset:
+    db_path: str
+    wishes: int
+    creators: int
+    booked_share: float
+    skew: float
+    seed: int
+    relations_per_presenter: int = 20
+
+
+@dataclass
+class BenchResult:
+    op: str
+    mode: str
+    threads: int
+    ops: int
+    seconds: float
+    ops_per_second: float
+    p50_us: float
+    p95_us: float
+    p99_us: float
+
+
+class CreatorPicker:
+    """Picks creators with Zipf-like popularity: the creator of rank `r` is picked proportionally to `1 / r ** skew`."""
+
+    def __init__(self, creators: int, skew: float, rng: random.Random):
+        self.rng = rng
+        self.ids = range(creators)
+        self.cum_weights = list(itertools.accumulate(1 / (rank ** skew) for rank in range(1, creators + 1)))
+
+    def pick(self) -> int:
+        """User id of a creator, `creator<id>` is their name."""
+        return self.rng.choices(self.ids, cum_weights=self.cum_weights)[0]
+
+
+def presenter_id(dataset: Dataset, i: int) -> int:
+    """User id of `presenter<i>`, presenters come after the creators."""
+    return dataset.creators + i
+
+
+def generate_dataset(dataset: Dataset) -> None:
+    rng = random.Random(dataset.seed)
+    picker = CreatorPicker(dataset.creators, dataset.skew, rng)
+    create_tables_dict(dataset.db_path)
+    now = current_time_in_ms_since_1970()
+    wish_ids = itertools.count(1)
+
+    remaining = dataset.wishes
+    while remaining > 0:
+        batch = min(remaining, GENERATION_BATCH_SIZE)
+        remaining -= batch
+        wishes, bookings = [], []
+        for wish_id in itertools.islice(wish_ids, batch):
+            creator_id = picker.pick()
+            booked = rng.random() < dataset.booked_share
+            adjective, noun = rng.choice(ADJECTIVES), rng.choice(NOUNS)
+            price = rng.choice([None, 10.0, 25.0, 100.0])
+            wishes.append((wish_id, int(booked), f"creator{creator_id}",
+                           f"{adjective} {noun} x{rng.randrange(MODELS):04d}",
+                           rng.choice([None, 1, 2, 3, 4, 5]), price,
+                           f"a {adjective} {noun}, ideally with a {rng.choice(NOUNS)}", creator_id, price,
+                           None if price is None else "EUR"))
+            if booked:
+                presenter = rng.randrange(dataset.creators)
+                bookings.append((wish_id, f"creator{creator_id}", f"presenter{presenter}",
+                                 now - rng.randrange(365 * 24 * 60 * 60 * 1000), creator_id,
+                                 presenter_id(dataset, presenter)))
+        with db_ops(dataset.db_path) as cur:
+            cur.executemany(
+                f"""
+                INSERT INTO {TableName.WISH.value}(wish_id, booked, presented, creator_name, name, priority, price, desc,
+                                                   creator_id, price_amount, price_currency)
+                VALUES (?, ?, 0, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, wishes
+            )
+            cur.executemany(f"INSERT INTO {TableName.BOOKED.value} VALUES (?, ?, ?, ?, ?, ?)", bookings)
+
+    # presenter<i> is related to a few distinct creators; picking them by popularity as well would give the top
+    # creators most of the followers and fill the feed with a row per follower for each of their many wishes
+    relations = []
+    for i in range(dataset.creators):
+        for creator_id in rng.sample(range(dataset.creators), dataset.relations_per_presenter):
+            relations.append((f"creator{creator_id}", f"presenter{i}", "friend", creator_id, presenter_id(dataset, i)))
+    with db_ops(dataset.db_path) as cur:
+        cur.executemany(f"INSERT INTO {TableName.RELATION.value} VALUES (null, ?, ?, ?, ?, ?)", relations)
+
+
+def summarize(op: str, mode: str, threads: int, samples: List[float], seconds: float) -> BenchResult:
+    cuts = statistics.quantiles(samples, n=100) if len(samples) > 1 else samples * 99
+    return BenchResult(op=op,
+                       mode=mode,
+                       threads=threads,
+                       ops=len(samples),
+                       seconds=seconds,
+                       ops_per_second=len(samples) / seconds,
+                       p50_us=cuts[49] * 1e6,
+                       p95_us=cuts[94] * 1e6,
+                       p99_us=cuts[98] * 1e6)
+
+
+def run(op: str, operation: Callable[[int], None], iterations: int, threads: int = 1) -> BenchResult:
+    """Calls `operation(i)` for `iterations` distinct `i`, spread over `threads` threads."""
+    samples: List[float] = []
+    samples_lock = threading.Lock()
+    counter = itertools.count()
+
+    def worker() -> None:
+        local_samples = []
+        for i in iter(lambda: next(counter), None):
+            if i >= iterations:
+                break
+            started = time.perf_counter()
+            operation(i)
+            local_samples.append(time.perf_counter() - started)
+        with samples_lock:
+            samples.extend(local_samples)
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return summarize(op, "single" if threads == 1 else "concurrent", threads, samples, time.perf_counter() - started)
+
+
+def run_group_commit(dataset: Dataset, iterations: int, writers: int) -> List[BenchResult]:
+    """`Wish.add` from `writers` threads, each insert in its own transaction and then through the writer thread."""
+    wish = Wish(dataset.db_path)
+    writer = GroupCommitWriter(dataset.db_path)
+
+    def add(i: int) -> None:
+        creator_id = i % dataset.creators
+        wish.add(creator_id=creator_id, creator_name=f"creator{creator_id}", name=f"grouped wish {i}", priority=i % 5)
+
+    results = [run("Wish.add (commit per write)", add, iterations, writers),
+               run("Wish.add (group commit)", lambda i: writer.submit(add, i).result(), iterations, writers)]
+    writer.close()
+    return results
+
+
+def run_benchmarks(dataset: Dataset, iterations: int, threads: int) -> List[BenchResult]:
+    rng = random.Random(dataset.seed + 1)
+    picker = CreatorPicker(dataset.creators, dataset.skew, rng)
+    wish = Wish(dataset.db_path)
+    booked = Booked(dataset.db_path)
+    feed = Feed(dataset.db_path)
+    run_id = itertools.count()
+
+    def search_terms() -> str:
+        return f"{rng.choice(NOUNS)} x{rng.randrange(MODELS):04d}"
+
+    def like_scan(presenter: int, terms: str) -> List:
+        # the same search without the full-text index, unranked
+        with db_ops(dataset.db_path, readonly=True) as cur:
+            return list(cur.execute(
+                f"""
+                SELECT * FROM {TableName.WISH.value}
+                WHERE (name LIKE ? OR desc LIKE ?) AND booked = 0 AND creator_id IN (
+                    SELECT creator_id FROM {TableName.RELATION.value} WHERE presenter_id = ?
+                )
+                LIMIT 10
+                """, [f"%{terms}%", f"%{terms}%", presenter]
+            ))
+
+    def feed_join(presenter: int) -> List:
+        # the same feed page joined on every read
+        with db_ops(dataset.db_path, readonly=True) as cur:
+            return list(cur.execute(
+                f"""
+                SELECT w.* FROM {TableName.RELATION.value} r
+                JOIN {TableName.WISH.value} w ON {FEED_VISIBILITY.format(wish="w", relation="r")}
+                WHERE r.presenter_id = ?
+                ORDER BY w.wish_id DESC
+                LIMIT 10
+                """, [presenter]
+            ))
+
+    def filter_price(creator_id: int) -> List[WishData]:
+        # the same page under a price, filtered and sorted in Python
+        wishes = wish.search_by_creator_and_booked_value(creator_id, row_factory=WishData.row_factory)
+        return sorted((w for w in wishes if w.price_amount is not None and w.price_amount <= BENCH_MAX_PRICE),
+                      key=lambda w: (w.price_amount, w.wish_id))[:10]
+
+    def add(i: int) -> None:
+        creator_id = picker.pick()
+        wish.add(creator_id=creator_id, creator_name=f"creator{creator_id}", name=f"bench wish {i}", priority=i % 5)
+
+    def add_booking(prefix: str, i: int) -> None:
+        creator_id = picker.pick()
+        booked.add(creator_id, f"creator{creator_id}", -i - 1, f"{prefix}-presenter{i}",
+                   rng.randrange(1, dataset.wishes + 1))
+
+    def operations() -> Dict[str, Callable[[int], None]]:
+        prefix = f"run{next(run_id)}"
+        return {
+            "Wish.add": add,
+            "Wish.search_by_creator_and_booked_value":
+                lambda i: wish.search_by_creator_and_booked_value(picker.pick()),
+            "Wish.search_page under a price":
+                lambda i: wish.search_page(picker.pick(), wish_order=WishOrder.PRICE, max_price=BENCH_MAX_PRICE),
+            "price filter in Python":
+                lambda i: filter_price(picker.pick()),
+            "Wish.search_text":
+                lambda i: wish.search_text(presenter_id(dataset, i % dataset.creators), search_terms()),
+            "LIKE scan (no full-text index)":
+                lambda i: like_scan(presenter_id(dataset, i % dataset.creators), search_terms()),
+            "Feed.page":
+                lambda i: feed.page(presenter_id(dataset, i % dataset.creators)),
+            "feed join (no feed table)":
+                lambda i: feed_join(presenter_id(dataset, i % dataset.creators)),
+            "Wish.change_booked":
+                lambda i: wish.change_booked(rng.randrange(1, dataset.wishes + 1), bool(i % 2)),
+            "Booked.add":
+                lambda i: add_booking(prefix, i),
+            "book_wish":
+                lambda i: db.book_wish(rng.randrange(1, dataset.wishes + 1), -i - 1, f"{prefix}-booker{i}",
+                                       dataset.db_path),
+        }
+
+    results = [run(op, operation, iterations) for op, operation in operations().items()]
+    if threads > 1:
+        results += [run(op, operation, iterations, threads) for op, operation in operations().items()]
+    return results
+
+
+def compare(results: List[BenchResult], baseline_path: str, tolerance: float) -> List[str]:
+    """Names the results whose throughput dropped by more than `tolerance` compared to the baseline report."""
+    with open(baseline_path) as f:
+        baseline = {(r["op"], r["mode"], r["threads"]): r for r in json.load(f)["results"]}
+    regressions = []
+    for result in results:
+        previous = baseline.get((result.op, result.mode, result.threads))
+        if previous and result.ops_per_second < previous["ops_per_second"] * (1 - tolerance):
+            regressions.append(f"{result.op} ({result.mode}, {result.threads} threads): "
+                               f"{previous['ops_per_second']:.0f} -> {result.ops_per_second:.0f} ops/s")
+    return regressions
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--wishes", type=int, default=10_000)
+    parser.add_argument("--creators", type=int, default=1_000)
+    parser.add_argument("--booked-share", type=float, default=0.2)
+    parser.add_argument("--skew", type=float, default=1.1, help="Zipf exponent of creator popularity")
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=4, help="concurrent writers, 1 to skip the concurrent run")
+    parser.add_argument("--writers", type=int, default=16, help="threads submitting writes in the group commit run")
+    parser.add_argument("--synchronous", default=db.SYNCHRONOUS, help="PRAGMA synchronous of the connections")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--db", help="database file, a temporary one by default")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="baseline results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    db.SYNCHRONOUS = args.synchronous
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix="wishlist-bench-"), "wishlist.db")
+    dataset = Dataset(db_path=db_path,
+                      wishes=args.wishes,
+                      creators=args.creators,
+                      booked_share=args.booked_share,
+                      skew=args.skew,
+                      seed=args.seed)
+
+    started = time.perf_counter()
+    generate_dataset(dataset)
+    print(f"Generated {dataset.wishes} wishes in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+    results = run_benchmarks(dataset, args.iterations, args.threads)
+    results += run_group_commit(dataset, args.iterations * 4, args.writers)
+    for result in results:
+        print(f"{result.op:<42}{result.mode:>11}{result.threads:>3}  {result.ops_per_second:>9.0f} ops/s  "
+              f"p50 {result.p50_us:>8.0f}us  p95 {result.p95_us:>8.0f}us  p99 {result.p99_us:>8.0f}us")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"sqlite_version": sqlite3.sqlite_version,
+                       "dataset": asdict(dataset),
+                       "iterations": args.iterations,
+                       "results": [asdict(result) for result in results]}, f, indent=2)
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,136 @@
+"""Compares wish list reads from the database file with reads from an in-memory snapshot.
+
+A read-mostly workload asks for the whole lists (`list`) or the first pages (`page`) of Zipf-distributed creators,
+with a `Wish.change_booked` every `--write-every` reads. Besides latency, the read system calls of the process and
+the bytes they returned tell how much of the work reached the file, from `/proc/self/io` (Linux only).
+
+Example: `python bench_snapshot.py --wishes 100000 --reads 3000 --write-every 100 --json snapshot.json`
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, asdict
+from typing import Dict, List
+
+import db
+from bench_db import CreatorPicker, Dataset, generate_dataset
+from db import Wish, configure_snapshot
+
+
+@dataclass
+class SnapshotRun:
+    mode: str
+    query: str
+    reads: int
+    writes: int
+    p50_us: float
+    p99_us: float
+    read_bytes_per_read: float
+    read_calls_per_read: float
+    full_copies: int
+    refreshes: int
+    # bytes held by the in-memory copies, 0 when reading the file
+    snapshot_bytes: int
+
+
+def process_io() -> Dict[str, int]:
+    with open("/proc/self/io") as f:
+        return {key: int(value) for key, value in (line.split(": ") for line in f)}
+
+
+def run_reads(dataset: Dataset,
+              mode: str,
+              query: str,
+              reads: int,
+              write_every: int,
+              staleness: float,
+              seed: int,
+              ) -> SnapshotRun:
+    rng = random.Random(seed)
+    picker = CreatorPicker(dataset.creators, dataset.skew, rng)
+    snapshot = configure_snapshot(dataset.db_path, staleness if mode == "snapshot" else None)
+    wish = Wish(dataset.db_path)
+    read = wish.search_by_creator_and_booked_value if query == "list" else wish.search_page
+    # connections and the first copy are not part of the measurement
+    read(picker.pick())
+
+    latencies: List[float] = []
+    writes = 0
+    before = process_io()
+    for i in range(1, reads + 1):
+        if write_every and i % write_every == 0:
+            wish.change_booked(rng.randrange(1, dataset.wishes + 1), bool(rng.random() < dataset.booked_share))
+            writes += 1
+        creator_id = picker.pick()
+        started = time.perf_counter()
+        read(creator_id)
+        latencies.append(time.perf_counter() - started)
+    after = process_io()
+
+    percentiles = statistics.quantiles(latencies, n=100)
+    run = SnapshotRun(mode=mode,
+                      query=query,
+                      reads=reads,
+                      writes=writes,
+                      p50_us=percentiles[49] * 1e6,
+                      p99_us=percentiles[98] * 1e6,
+                      read_bytes_per_read=(after["rchar"] - before["rchar"]) / reads,
+                      read_calls_per_read=(after["syscr"] - before["syscr"]) / reads,
+                      full_copies=snapshot.full_copies if snapshot is not None else 0,
+                      refreshes=snapshot.refreshes if snapshot is not None else 0,
+                      snapshot_bytes=snapshot.size() if snapshot is not None else 0)
+    configure_snapshot(dataset.db_path, None)
+    return run
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--wishes", type=int, default=100_000)
+    parser.add_argument("--creators", type=int, default=1_000)
+    parser.add_argument("--booked-share", type=float, default=0.2)
+    parser.add_argument("--skew", type=float, default=1.1, help="Zipf exponent of creator popularity")
+    parser.add_argument("--reads", type=int, default=3_000)
+    parser.add_argument("--write-every", type=int, default=100, help="reads per write, 0 for no writes")
+    parser.add_argument("--staleness", type=float, default=db.SNAPSHOT_STALENESS_SECONDS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the results to this file")
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    dataset = Dataset(db_path=os.path.join(tempfile.mkdtemp(prefix="wishlist-snapshot-"), "wishlist.db"),
+                      wishes=args.wishes,
+                      creators=args.creators,
+                      booked_share=args.booked_share,
+                      skew=args.skew,
+                      seed=args.seed)
+    started = time.perf_counter()
+    generate_dataset(dataset)
+    print(f"Generated {dataset.wishes} wishes in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+    runs = [run_reads(dataset, mode, query, args.reads, args.write_every, args.staleness, args.seed)
+            for query in ("list", "page") for mode in ("file", "snapshot")]
+    print(f"{'mode':<10}{'query':<6}{'reads':>7}{'writes':>7}{'p50 us':>9}{'p99 us':>9}{'bytes/read':>12}"
+          f"{'calls/read':>12}{'copies':>8}{'refreshes':>11}{'snapshot MB':>13}")
+    for run in runs:
+        print(f"{run.mode:<10}{run.query:<6}{run.reads:>7}{run.writes:>7}{run.p50_us:>9.0f}{run.p99_us:>9.0f}"
+              f"{run.read_bytes_per_read:>12.0f}{run.read_calls_per_read:>12.2f}{run.full_copies:>8}"
+              f"{run.refreshes:>11}{run.snapshot_bytes / 2 ** 20:>13.1f}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"dataset": asdict(dataset), "runs": [asdict(run) for run in runs]}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,95 @@
+"""Measures the cold start of the bot: from a fresh process to the first handled update.
+
+Every run is a new interpreter against a fresh or an already initialized database file. The `per-table` mode replays
+the previous bootstrap, one transaction per table followed by the migrations, for comparison.
+
+Example: `python bench_startup.py --runs 5 --json startup.json`
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+MODES = ["fresh", "current", "per-table"]
+
+
+async def first_update(db_path: str, per_table: bool) -> Dict[str, float]:
+    started = time.perf_counter()
+    import main
+    import db
+    from fake_transport import FakeRequest, UpdateFactory
+    from repository import WishRepository
+    from telegram import Update
+    imported = time.perf_counter()
+
+    if per_table:
+        for table_class in db.TABLE_CLASSES.values():
+            table_class(db_path).create_table()
+        db.migrate(db_path)
+    main.repository = WishRepository(db_path)
+    application = main.build_application("123:startup", request=FakeRequest())
+    await application.initialize()
+    await application.post_init(application)
+    initialized = time.perf_counter()
+
+    await application.process_update(Update.de_json(UpdateFactory().message(1, "/start"), application.bot))
+    await main.outbox.stop()
+    handled = time.perf_counter()
+    await application.post_shutdown(application)
+    await application.shutdown()
+    return {"import_seconds": imported - started,
+            "startup_seconds": initialized - imported,
+            "first_update_seconds": handled - started}
+
+
+def child(db_path: str, per_table: bool) -> None:
+    print(json.dumps(asyncio.run(first_update(db_path, per_table))))
+
+
+def run_once(mode: str, workdir: str, run: int) -> Dict[str, float]:
+    db_path = os.path.join(workdir, f"{mode}-{run}.db")
+    if mode == "current":
+        # an initialized database from a previous start
+        subprocess.run([sys.executable, __file__, "--child", db_path], check=True, capture_output=True)
+    started = time.perf_counter()
+    command = [sys.executable, __file__, "--child", db_path] + (["--per-table"] if mode == "per-table" else [])
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result["process_seconds"] = time.perf_counter() - started
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--child", metavar="DB", help=argparse.SUPPRESS)
+    parser.add_argument("--per-table", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child, args.per_table)
+        return
+
+    workdir = tempfile.mkdtemp(prefix="wishlist-startup-")
+    results: Dict[str, Dict[str, float]] = dict()
+    for mode in MODES:
+        runs: List[Dict[str, float]] = [run_once(mode, workdir, run) for run in range(args.runs)]
+        results[mode] = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+        print(f"{mode:<10} startup {results[mode]['startup_seconds'] * 1000:>7.1f}ms  "
+              f"first update {results[mode]['first_update_seconds'] * 1000:>7.1f}ms  "
+              f"process {results[mode]['process_seconds'] * 1000:>7.1f}ms")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""Compares the memory and time spent on 100k `WishData` rows with the previous plain dataclass.
+
+Example: `python bench_wishdata.py --rows 100000`
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Tuple
+
+from db import Wish, bootstrap, close_pools, db_ops
+from wishdata import WishData, render_wish
+
+
+@dataclass
+class LegacyWishData:
+    """`WishData` as it was before slots, the row factory and the render cache."""
+    creator_name: str
+
+    booked: bool
+    presented: bool
+
+    wish_id: Optional[int] = None
+    name: Optional[str] = None
+
+    priority: Optional[int] = None
+    relation_type: Optional[str] = None
+    link: Optional[str] = None
+    price: Optional[str] = None
+    photo_id: Optional[str] = None
+    desc: Optional[str] = None
+    quantity: Optional[str] = None
+
+    @staticmethod
+    def from_tuple(t: Tuple) -> LegacyWishData:
+        return LegacyWishData(
+            wish_id=t[0],
+            booked=t[1],
+            presented=t[2],
+            creator_name=t[3],
+            name=t[4],
+            priority=t[5],
+            relation_type=t[6],
+            link=t[7],
+            price=t[8],
+            photo_id=t[9],
+            desc=t[10],
+            quantity=t[11],
+        )
+
+    def __str__(self):
+        name_str = f"*name:* {self.name}"
+        price_str = "" if self.price is None else f"\n*price:* {self.price}"
+        desc_str = "" if self.desc is None else f"\n*desc:* {self.desc}"
+        link_str = "" if self.link is None else f"\n[link]({self.link})"
+        return "".join([name_str, price_str, desc_str, link_str]).replace(".", "\\.")
+
+
+def make_rows(count: int, seed: int) -> List[Tuple]:
+    """Stores `count` random wishes in a scratch database and reads them back as `SELECT * FROM wish` rows."""
+    rng = random.Random(seed)
+    wishes = [WishData(creator_name=f"creator{creator}", booked=False, presented=False, name=f"wish number {i}.",
+                       priority=rng.choice([None, 1, 2, 3]), link=rng.choice([None, f"https://example.com/item/{i}"]),
+                       price=rng.choice([None, "9.99", "25 EUR"]),
+                       desc=rng.choice([None, f"a description of wish {i}, with some punctuation!"]),
+                       creator_id=creator)
+              for i, creator in enumerate(rng.randrange(1000) for _ in range(count))]
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, "bench.db")
+        bootstrap(db_path)
+        Wish(db_path).add_many(wishes)
+        with db_ops(db_path, readonly=True) as cur:
+            rows = cur.execute("SELECT * FROM wish ORDER BY wish_id").fetchall()
+        close_pools()
+    return rows
+
+
+def measure_build(build: Callable[[List[Tuple]], list], rows: List[Tuple]) -> Tuple[list, float, int]:
+    tracemalloc.start()
+    started = time.perf_counter()
+    wishes = build(rows)
+    elapsed = time.perf_counter() - started
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return wishes, elapsed, size
+
+
+def measure_render(wishes: list, views: int) -> float:
+    started = time.perf_counter()
+    for _ in range(views):
+        for wish in wishes:
+            str(wish)
+    return time.perf_counter() - started
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--working-set", type=int, default=10_000, help="wishes shown again on repeated views")
+    parser.add_argument("--views", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows, args.seed)
+    legacy, legacy_build, legacy_bytes = measure_build(lambda r: [LegacyWishData.from_tuple(t) for t in r], rows)
+    slotted, slotted_build, slotted_bytes = measure_build(lambda r: [WishData.row_factory(None, t) for t in r], rows)
+
+    render_wish.cache_clear()
+    first_view = {"legacy": measure_render(legacy, 1), "slotted": measure_render(slotted, 1)}
+
+    # a working set of lists that is viewed again and again, after being rendered once
+    render_wish.cache_clear()
+    measure_render(slotted[:args.working_set], 1)
+    repeated_views = {"legacy": measure_render(legacy[:args.working_set], args.views),
+                      "slotted": measure_render(slotted[:args.working_set], args.views)}
+
+    results = {
+        "rows": args.rows,
+        "build_seconds": {"legacy": legacy_build, "slotted": slotted_build},
+        "bytes_per_row": {"legacy": legacy_bytes / args.rows, "slotted": slotted_bytes / args.rows},
+        "render_first_view_seconds": first_view,
+        "render_repeated_views_seconds": repeated_views,
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import os
+
+os.environ.setdefault("WISHLIST_BOT_TOKEN", "123:test")
+
+import main
+from db import BookedArchive, Booked, Presented, Wish, archive_bookings, book_wish, create_tables_dict, db_ops, \
+    explain_query_plan, remember_user
+from fake_transport import FakeRequest, UpdateFactory, run_bot
+from wishdata import WishData
+
+
+def booked_wish_ids(db_path: str, table: str = "booked"):
+    with db_ops(db_path, readonly=True) as cur:
+        return sorted(row[0] for row in cur.execute(f"SELECT wish_id FROM {table}"))
+
+
+def test_bookings_are_paged_most_recent_first(tmp_path) -> None:
+    db_path = str(tmp_path / "bookings.db")
+    create_tables_dict(db_path)
+    wish = Wish(db_path)
+    for i in range(5):
+        wish.add(creator_id=2, creator_name="user2", name=f"wish {i}")
+        book_wish(i + 1, 1, "user1", db_path)
+    with db_ops(db_path) as cur:
+        # wishes 1 and 2 booked at the same time
+        cur.execute("UPDATE booked SET date = CASE WHEN wish_id <= 2 THEN 100 ELSE wish_id * 100 END")
+
+    booked = Booked(db_path)
+    first = booked.page(1, limit=2, row_factory=WishData.booking_row_factory)
+    assert [(date, w.name) for date, w in first] == [(500, "wish 4"), (400, "wish 3")]
+    second = booked.page(1, limit=2, after=(first[-1][0], first[-1][1].wish_id))
+    third = booked.page(1, limit=2, after=(second[-1][-1], second[-1][0]))
+    assert [row[4] for row in second + third] == ["wish 2", "wish 1", "wish 0"]
+    assert [row[4] for row in booked.page(1, limit=2, before=(third[0][-1], third[0][0]))] == ["wish 2", "wish 1"]
+    assert booked.page(3) == []
+
+    plan = explain_query_plan("SELECT wish_id FROM booked WHERE presenter_id = ? ORDER BY date DESC, wish_id DESC",
+                              [1], db_path)
+    assert any("INDEX booked_presenter_id_date" in step for step in plan)
+    assert not any("TEMP B-TREE" in step for step in plan)
+
+
+def test_presented_and_old_bookings_move_to_the_archive(tmp_path) -> None:
+    db_path = str(tmp_path / "archive.db")
+    create_tables_dict(db_path)
+    wish = Wish(db_path)
+    for i in range(7):
+        wish.add(creator_id=2, creator_name="user2", name=f"wish {i}")
+        book_wish(i + 1, 1, "user1", db_path)
+
+    presented = Presented(db_path)
+    assert presented.do_present_wish(1, 1)
+    assert not presented.do_present_wish(1, 1)
+    assert not presented.do_present_wish(2, 3)
+    assert booked_wish_ids(db_path) == [2, 3, 4, 5, 6, 7]
+    assert booked_wish_ids(db_path, "presented") == [1]
+
+    with db_ops(db_path) as cur:
+        cur.execute("UPDATE wish SET booked = 0 WHERE wish_id = 2")
+        cur.execute("DELETE FROM wish WHERE wish_id = 3")
+        cur.execute("UPDATE booked SET date = 1 WHERE wish_id IN (4, 5)")
+    assert archive_bookings(db_path, batch_size=3) == 3
+    assert archive_bookings(db_path, batch_size=3) == 1
+    assert archive_bookings(db_path, batch_size=3) == 0
+    assert booked_wish_ids(db_path) == [6, 7]
+    assert booked_wish_ids(db_path, "booked_archive") == [1, 2, 3, 4, 5]
+    # the booking of the deleted wish is kept but has no wish to show
+    archive = BookedArchive(db_path)
+    archived = archive.page(1, limit=10)
+    assert sorted(row[4] for row in archived) == ["wish 0", "wish 1", "wish 3", "wish 4"]
+
+    archive.add(2, "user2", 1, "user1", 6, date=0, archived=2)
+    assert [row[4] for row in archive.page(1, limit=10)][-1] == "wish 5"
+
+
+def test_my_bookings_command(tmp_path, monkeypatch) -> None:
+    db_path = str(tmp_path / "bookings_command.db")
+    create_tables_dict(db_path)
+    wish = Wish(db_path)
+    for i in range(12):
+        wish.add(creator_id=2, creator_name="user2", name=f"wish {i}")
+        book_wish(i + 1, 1, "user1", db_path)
+    remember_user(2, "user2", db_path)
+    request = FakeRequest()
+    updates = UpdateFactory()
+
+    run_bot(monkeypatch, db_path, request,
+            [updates.message(3, "/bookings"), updates.message(1, "/start"), updates.message(1, "My bookings"),
+             updates.callback_query(1, main.NEXT_BOOKINGS_PAGE), updates.message(1, "12"), updates.message(1, "12"),
+             updates.message(1, "/cancel"), updates.message(1, "/bookings")])
+
+    texts = [call.parameters["text"] for call in request.calls_of("sendMessage")]
+    assert texts[0] == "You have not booked any wish"
+    pages = [text for text in texts if text.startswith("*Your bookings*")]
+    assert pages[0].count("*Wish \\#") == 10 and pages[0].index("wish 11") < pages[0].index("wish 2")
+    second_page = request.calls_of("editMessageText")[0].parameters["text"]
+    assert "*Wish \\#11* for user2" in second_page and "wish 0" in second_page
+    assert "Marked wish 0 as presented, it left your bookings" in texts
+    assert "wish 0 is not among your bookings anymore" in texts
+    assert pages[1].count("*Wish \\#") == 10 and "wish 0" not in pages[1]
+    assert booked_wish_ids(db_path, "presented") == [1]
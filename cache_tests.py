@@ -0,0 +1,41 @@
+from cache import LRUCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_lru_eviction_and_ttl() -> None:
+    clock = FakeClock()
+    cache = LRUCache(maxsize=2, ttl=10, clock=clock)
+
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+
+    clock.now = 11
+    assert cache.get("a") is None
+
+    stats = cache.stats()
+    assert (stats.hits, stats.misses, stats.evictions, stats.expirations) == (2, 2, 1, 1)
+    assert stats.size == 1
+
+
+def test_load_racing_with_invalidation_is_not_stored() -> None:
+    cache = LRUCache()
+
+    def load() -> list:
+        cache.invalidate("key")
+        return ["stale"]
+
+    assert cache.get_or_load("key", load) == ["stale"]
+    assert cache.get("key") is None
+    assert cache.get_or_load("key", lambda: ["fresh"]) == ["fresh"]
+    assert cache.get("key") == ["fresh"]
@@ -0,0 +1,229 @@
+"""Runs the bot as one ingress process long-polling Telegram and a pool of worker processes handling the updates.
+
+Updates are routed by the id of the user sending them, so the conversation state of a user lives in one worker.
+The workers share the SQLite file: in WAL mode they read concurrently and take turns on the write lock.
+
+Example: `WISHLIST_BOT_TOKEN=... python cluster.py --workers 4`
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+from telegram import Bot, Update
+from telegram.request import BaseRequest
+
+from db import DB_PATH, bootstrap, configure_pool, share_between_processes
+from dispatch import UserOrderedDispatcher, update_user_id
+from sender import CHAT_BURST, CHAT_RATE, GLOBAL_RATE
+
+logger = logging.getLogger(__name__)
+
+WORKERS = int(os.environ.get("WISHLIST_WORKERS", os.cpu_count() or 1))
+# points of the ring per worker, the more of them the more even the split of the users
+VIRTUAL_NODES = 64
+# updates a worker processes at once, updates of one user never run concurrently
+WORKER_MAX_CONCURRENCY = 64
+POLL_TIMEOUT_SECONDS = 30
+POLL_LIMIT = 100
+
+
+def _ring_hash(value: str) -> int:
+    # unlike `hash`, the same in every process
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent hashing of user ids onto `nodes` workers.
+
+    Every worker owns `replicas` points of the ring and a user belongs to the first point after the hash of their id,
+    so a pool resized by one worker only moves about `1 / nodes` of the users.
+    """
+
+    def __init__(self, nodes: int, replicas: int = VIRTUAL_NODES):
+        points = sorted((_ring_hash(f"worker{node}:{replica}"), node)
+                        for node in range(nodes) for replica in range(replicas))
+        self.nodes = nodes
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, user_id: int) -> int:
+        i = bisect.bisect(self._hashes, _ring_hash(str(user_id)))
+        return self._nodes[i % len(self._nodes)]
+
+
+@dataclass
+class WorkerConfig:
+    index: int
+    workers: int
+    token: str
+    db_path: str = DB_PATH
+    # builds the Bot API transport of the worker, the default HTTP one if unset
+    request_factory: Optional[Callable[[], BaseRequest]] = None
+    global_rate: float = GLOBAL_RATE
+    chat_rate: float = CHAT_RATE
+    chat_burst: float = CHAT_BURST
+    metrics_port: Optional[int] = None
+    log_level: int = logging.INFO
+
+
+@dataclass
+class WorkerReport:
+    index: int
+    updates: int
+    cpu_seconds: float
+
+
+async def serve_worker(config: WorkerConfig, inbox: multiprocessing.Queue, results: multiprocessing.Queue) -> None:
+    # imported here since main starts the cluster
+    import main
+    from repository import WishRepository
+
+    logging.getLogger().setLevel(config.log_level)
+    configure_pool(config.db_path, readers=main.DB_READERS)
+    share_between_processes(config.db_path)
+    main.repository = WishRepository(config.db_path)
+    main.OUTBOX_GLOBAL_RATE = config.global_rate
+    main.OUTBOX_CHAT_RATE = config.chat_rate
+    main.OUTBOX_CHAT_BURST = config.chat_burst
+    main.METRICS_PORT = config.metrics_port
+    request = config.request_factory() if config.request_factory is not None else None
+    application = main.build_application(config.token, request=request)
+    await application.initialize()
+    await application.post_init(application)
+    dispatcher = UserOrderedDispatcher(application, WORKER_MAX_CONCURRENCY)
+    results.put(config.index)
+
+    loop = asyncio.get_running_loop()
+    started = time.process_time()
+    while True:
+        batch = await loop.run_in_executor(None, inbox.get)
+        if batch is None:
+            break
+        for payload in batch:
+            await dispatcher.dispatch(update_user_id(payload), Update.de_json(payload, application.bot))
+    await dispatcher.join()
+    cpu_seconds = time.process_time() - started
+
+    await application.post_shutdown(application)
+    await application.shutdown()
+    results.put(WorkerReport(config.index, dispatcher.handled, cpu_seconds))
+
+
+def run_worker(config: WorkerConfig, inbox: multiprocessing.Queue, results: multiprocessing.Queue) -> None:
+    asyncio.run(serve_worker(config, inbox, results))
+
+
+class Cluster:
+    """Worker processes fed with update payloads by the calling process."""
+
+    def __init__(self,
+                 token: str,
+                 workers: int = WORKERS,
+                 db_path: str = DB_PATH,
+                 request_factory: Optional[Callable[[], BaseRequest]] = None,
+                 global_rate: float = GLOBAL_RATE,
+                 chat_rate: float = CHAT_RATE,
+                 chat_burst: float = CHAT_BURST,
+                 metrics_port: Optional[int] = None,
+                 log_level: int = logging.INFO,
+                 ):
+        self.db_path = db_path
+        self.ring = HashRing(workers)
+        # a fresh interpreter per worker, forking would copy the connections and threads of this process
+        context = multiprocessing.get_context("spawn")
+        self._results = context.Queue()
+        self._inboxes = [context.Queue() for _ in range(workers)]
+        self._processes = [
+            context.Process(target=run_worker,
+                            name=f"wishlist-worker-{index}",
+                            args=(WorkerConfig(index=index,
+                                               workers=workers,
+                                               token=token,
+                                               db_path=db_path,
+                                               request_factory=request_factory,
+                                               global_rate=global_rate / workers,
+                                               chat_rate=chat_rate,
+                                               chat_burst=chat_burst,
+                                               metrics_port=metrics_port + index if metrics_port is not None else None,
+                                               log_level=log_level),
+                                  inbox,
+                                  self._results))
+            for index, inbox in enumerate(self._inboxes)
+        ]
+
+    def start(self) -> None:
+        """Migrates the database before the workers open it, returns once all of them are ready."""
+        bootstrap(self.db_path)
+        for process in self._processes:
+            process.start()
+        for _ in self._processes:
+            self._results.get()
+
+    def route(self, payloads: List[Dict[str, Any]]) -> None:
+        """Hands the update payloads to their workers, one message per worker."""
+        batches: List[List[Dict[str, Any]]] = [[] for _ in self._inboxes]
+        for payload in payloads:
+            batches[self.ring.node_for(update_user_id(payload))].append(payload)
+        for inbox, batch in zip(self._inboxes, batches):
+            if batch:
+                inbox.put(batch)
+
+    def stop(self) -> List[WorkerReport]:
+        """Lets the workers finish the routed updates and returns what each of them did."""
+        for inbox in self._inboxes:
+            inbox.put(None)
+        reports = [self._results.get() for _ in self._processes]
+        for process in self._processes:
+            process.join()
+        return sorted(reports, key=lambda report: report.index)
+
+
+async def poll(cluster: Cluster, token: str) -> None:
+    """Long-polls the Bot API and routes the updates, an update counts as delivered once routed."""
+    bot = Bot(token)
+    async with bot:
+        await bot.delete_webhook()
+        offset = None
+        while True:
+            updates = await bot.get_updates(offset=offset,
+                                            limit=POLL_LIMIT,
+                                            timeout=POLL_TIMEOUT_SECONDS,
+                                            allowed_updates=Update.ALL_TYPES)
+            if updates:
+                cluster.route([update.to_dict() for update in updates])
+                offset = updates[-1].update_id + 1
+
+
+def run(token: str, workers: int = WORKERS, db_path: str = DB_PATH) -> None:
+    metrics_port = os.environ.get("WISHLIST_METRICS_PORT")
+    cluster = Cluster(token, workers, db_path, metrics_port=int(metrics_port) if metrics_port is not None else None)
+    cluster.start()
+    logger.info(f"Started {workers} workers")
+    try:
+        asyncio.run(poll(cluster, token))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        cluster.stop()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--db", default=DB_PATH, help="database file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    run(os.environ["WISHLIST_BOT_TOKEN"], workers=args.workers, db_path=args.db)
@@ -0,0 +1,66 @@
+import random
+import sqlite3
+from itertools import zip_longest
+
+from cluster import Cluster, HashRing
+from dispatch import update_user_id
+from db import Wish, create_tables_dict, db_ops, share_between_processes
+from fake_transport import FakeRequest, UpdateFactory
+from loadtest import make_scripts, seed_database
+
+
+def test_ring_moves_few_users_when_a_worker_joins() -> None:
+    users = range(10_000)
+    before = HashRing(4)
+    after = HashRing(5)
+    owners = [before.node_for(user_id) for user_id in users]
+    assert all(0.15 < owners.count(node) / len(users) < 0.35 for node in range(4))
+
+    moved = [user_id for user_id, owner in zip(users, owners) if after.node_for(user_id) != owner]
+    assert all(after.node_for(user_id) == 4 for user_id in moved)
+    assert 0.1 < len(moved) / len(users) < 0.3
+
+
+def test_updates_are_routed_by_sender() -> None:
+    updates = UpdateFactory()
+    assert update_user_id(updates.message(42, "/start")) == 42
+    assert update_user_id(updates.callback_query(43, "page")) == 43
+    assert update_user_id({"update_id": 1, "poll": {"id": "1"}}) == 0
+
+
+def test_wish_cache_sees_writes_of_other_processes(tmp_path) -> None:
+    db_path = str(tmp_path / "shared.db")
+    create_tables_dict(db_path)
+    share_between_processes(db_path)
+    wish = Wish(db_path)
+    wish.add(creator_id=10, creator_name="10", name="bike")
+    assert [w.name for w in wish.search_wishes(10)] == ["bike"]
+
+    other = sqlite3.connect(db_path, isolation_level=None)
+    other.execute("UPDATE wish SET name = 'car'")
+    other.close()
+    assert [w.name for w in wish.search_wishes(10)] == ["car"]
+
+
+def test_workers_handle_every_conversation(tmp_path) -> None:
+    db_path = str(tmp_path / "cluster.db")
+    rng = random.Random(5)
+    seed_database(db_path, creators=5, wishes_per_creator=3, rng=rng)
+    scripts = make_scripts(users=30, see_ratio=0.5, creators=5, rng=rng)
+    cluster = Cluster("123:test",
+                      workers=2,
+                      db_path=db_path,
+                      request_factory=FakeRequest,
+                      global_rate=10 ** 6,
+                      chat_rate=10 ** 6,
+                      chat_burst=10 ** 6)
+    cluster.start()
+    for step in zip_longest(*scripts):
+        cluster.route([payload for payload in step if payload is not None])
+    reports = cluster.stop()
+
+    assert sum(report.updates for report in reports) == sum(len(script) for script in scripts)
+    assert all(report.updates > 0 for report in reports)
+    wishing = sum(1 for script in scripts if script[1]["message"]["text"] == "Make a wish")
+    with db_ops(db_path, readonly=True) as cur:
+        assert list(cur.execute("SELECT count(*) FROM wish WHERE creator_id >= 1000")) == [(wishing,)]
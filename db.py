@@ -1,14 +1,65 @@
 from __future__ import annotations
 
 import logging
+import queue
+import random
 import sqlite3
+import threading
 import time
 from abc import ABC, abstractmethod
 from contextlib import contextmanager
 from enum import Enum
-from typing import Optional, Dict, List
+from typing import Any, Callable, Optional, Dict, Iterable, List, Iterator, Tuple, Union
+
+import metrics
+from cache import LRUCache
+from metrics import timed_db_operation
+from wishdata import PhotoVariant, WishData, WishOrder, parse_price
 
 DB_PATH = "wishlist.db"
+READER_POOL_SIZE = 4
+STATEMENT_CACHE_SIZE = 256
+WISH_CACHE_SIZE = 1024
+WISH_CACHE_TTL_SECONDS = 60.0
+# how long a statement waits for a lock held by another connection before failing with "database is locked"
+BUSY_TIMEOUT_SECONDS = 5.0
+# readers work on a snapshot while the writer appends to the log; commits survive a crash of the process,
+# only an OS crash may lose the last ones
+JOURNAL_MODE = "wal"
+SYNCHRONOUS = "NORMAL"
+WAL_AUTOCHECKPOINT_PAGES = 1000
+JOURNAL_SIZE_LIMIT_BYTES = 64 * 1024 * 1024
+BOOKING_MAX_ATTEMPTS = 5
+BOOKING_BACKOFF_SECONDS = 0.01
+BOOKING_MAX_BACKOFF_SECONDS = 0.2
+
+# `priority ASC NULLS LAST` as an expression an index can be built on
+PRIORITY_NULL_KEY = 9223372036854775807
+PRIORITY_SORT_KEY = f"ifnull(priority, {PRIORITY_NULL_KEY})"
+# `price_amount ASC NULLS LAST`, 1e999 reads as infinity
+PRICE_NULL_KEY = float("inf")
+PRICE_SORT_KEY = "ifnull(price_amount, 1e999)"
+SORT_KEYS = {WishOrder.PRIORITY: PRIORITY_SORT_KEY, WishOrder.PRICE: PRICE_SORT_KEY}
+PAGE_SIZE = 10
+WISH_FTS_TABLE = "wish_fts"
+# rows per transaction when filling the user id columns of existing rows
+BACKFILL_BATCH_SIZE = 10_000
+# bookings moved to the archive per transaction, and the age after which a booking is moved regardless of its wish
+BOOKING_ARCHIVE_BATCH_SIZE = 500
+BOOKING_RETENTION_MS = 365 * 24 * 60 * 60 * 1000
+# changes of wishes kept in the change log, a snapshot further behind is copied anew
+WISH_CHANGELOG_TABLE = "wish_changelog"
+WISH_CHANGELOG_SIZE = 10_000
+# how long a snapshot may miss the commits of other processes
+SNAPSHOT_STALENESS_SECONDS = 1.0
+# lists show the smallest variant of a photo with a side at least this long, Telegram keeps 90, 320, 800 and 1280 px
+THUMBNAIL_SIDE = 320
+
+# position of a wish in its creator's list: (sort key of the list order, wish_id)
+WishCursor = Tuple[Union[int, float], int]
+# position of a booking in the bookings of a presenter: (date, wish_id)
+BookingCursor = Tuple[int, int]
+RowFactory = Callable[[sqlite3.Cursor, Tuple], Any]
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +71,10 @@ class TableName(Enum):
     RELATION = "relation"
     BOOKED = "booked"
     PRESENTED = "presented"
+    USERNAME = "username"
+    FEED = "feed"
+    BOOKED_ARCHIVE = "booked_archive"
+    PHOTO = "photo"
 
 
 class RelationType(Enum):
@@ -28,13 +83,461 @@ class RelationType(Enum):
     FAMILY = "family"
 
 
+class BookingOutcome(Enum):
+    BOOKED = "booked"
+    ALREADY_BOOKED = "already_booked"
+    MISSING = "missing"
+
+
+class ConnectionPool:
+    """Long-lived connections to one database file.
+
+    Writes share a single connection guarded by a lock, reads check out one of at most `readers` connections.
+    Every connection keeps its own cache of `cached_statements` prepared statements.
+    In WAL mode readers never wait for the writer.
+    """
+
+    def __init__(self,
+                 db_path: str = DB_PATH,
+                 readers: int = READER_POOL_SIZE,
+                 cached_statements: int = STATEMENT_CACHE_SIZE,
+                 busy_timeout: float = BUSY_TIMEOUT_SECONDS,
+                 ):
+        self.db_path = db_path
+        self.max_readers = readers
+        self.cached_statements = cached_statements
+        self.busy_timeout = busy_timeout
+
+        self._writer = self._connect()
+        self._writer.execute(f"PRAGMA journal_mode = {JOURNAL_MODE}")
+        self._writer.execute(f"PRAGMA wal_autocheckpoint = {WAL_AUTOCHECKPOINT_PAGES}")
+        self._writer.execute(f"PRAGMA journal_size_limit = {JOURNAL_SIZE_LIMIT_BYTES}")
+        self._writer_lock = threading.RLock()
+        # thread running the current write transaction and what to run once it commits
+        self.transaction_owner: Optional[int] = None
+        self.after_commit: List[Callable[[], None]] = []
+        self._readers: queue.LifoQueue = queue.LifoQueue(maxsize=readers)
+        self._readers_created = 0
+        self._readers_lock = threading.Lock()
+        # never commits, so its data version tells about the commits of every other connection
+        self._watcher: Optional[sqlite3.Connection] = None
+        self._watcher_lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        # transactions are managed explicitly by `db_ops`, hence autocommit mode
+        conn = sqlite3.connect(self.db_path,
+                               timeout=self.busy_timeout,
+                               isolation_level=None,
+                               check_same_thread=False,
+                               cached_statements=self.cached_statements)
+        conn.execute(f"PRAGMA synchronous = {SYNCHRONOUS}")
+        return conn
+
+    @contextmanager
+    def writer(self) -> Iterator[sqlite3.Connection]:
+        with self._writer_lock:
+            yield self._writer
+
+    @contextmanager
+    def reader(self) -> Iterator[sqlite3.Connection]:
+        conn = self._checkout_reader()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+
+    def _checkout_reader(self) -> sqlite3.Connection:
+        try:
+            return self._readers.get_nowait()
+        except queue.Empty:
+            pass
+        with self._readers_lock:
+            if self._readers_created < self.max_readers:
+                self._readers_created += 1
+                conn = self._connect()
+                conn.execute("PRAGMA query_only = 1")
+                return conn
+        return self._readers.get()
+
+    def data_version(self) -> int:
+        """Changes whenever the file is committed to, by this process or by another one."""
+        with self._watcher_lock:
+            if self._watcher is None:
+                self._watcher = self._connect()
+            return self._watcher.execute("PRAGMA data_version").fetchone()[0]
+
+    def close(self) -> None:
+        with self._writer_lock:
+            self._writer.close()
+        with self._watcher_lock:
+            if self._watcher is not None:
+                self._watcher.close()
+                self._watcher = None
+        with self._readers_lock:
+            while True:
+                try:
+                    self._readers.get_nowait().close()
+                except queue.Empty:
+                    break
+            self._readers_created = 0
+
+
+_pools: Dict[str, ConnectionPool] = dict()
+_pools_lock = threading.Lock()
+
+
+def configure_pool(db_path: str = DB_PATH,
+                   readers: int = READER_POOL_SIZE,
+                   cached_statements: int = STATEMENT_CACHE_SIZE,
+                   busy_timeout: float = BUSY_TIMEOUT_SECONDS,
+                   ) -> ConnectionPool:
+    """Sets up the connections for `db_path`, should be called once at startup."""
+    with _pools_lock:
+        old_pool = _pools.pop(db_path, None)
+        if old_pool is not None:
+            old_pool.close()
+        pool = _pools[db_path] = ConnectionPool(db_path, readers, cached_statements, busy_timeout)
+    return pool
+
+
+def get_pool(db_path: str = DB_PATH) -> ConnectionPool:
+    with _pools_lock:
+        pool = _pools.get(db_path)
+        if pool is None:
+            pool = _pools[db_path] = ConnectionPool(db_path)
+    return pool
+
+
+def close_pools() -> None:
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
+
+_wish_caches: Dict[str, LRUCache] = dict()
+
+
+def configure_wish_cache(db_path: str = DB_PATH,
+                         maxsize: int = WISH_CACHE_SIZE,
+                         ttl: float = WISH_CACHE_TTL_SECONDS
+                         ) -> LRUCache:
+    with _pools_lock:
+        cache = _wish_caches[db_path] = LRUCache(maxsize, ttl)
+    return cache
+
+
+def get_wish_cache(db_path: str = DB_PATH) -> LRUCache:
+    """Materialized wish lists of `db_path`, keyed by `(creator_id, booked)`, and pages of them, see
+    `Wish.search_wishes_page`."""
+    with _pools_lock:
+        cache = _wish_caches.get(db_path)
+        if cache is None:
+            cache = _wish_caches[db_path] = LRUCache(WISH_CACHE_SIZE, WISH_CACHE_TTL_SECONDS)
+    return cache
+
+
+# files written by several processes, with the data version their wish cache was last checked against
+_shared_files: Dict[str, Optional[int]] = dict()
+
+
+def share_between_processes(db_path: str = DB_PATH) -> None:
+    """Makes the wish cache of `db_path` see the writes of other processes.
+
+    A process only invalidates the cached lists its own writes change, so once any other commit is noticed
+    the whole cache is dropped.
+    """
+    with _pools_lock:
+        _shared_files[db_path] = None
+
+
+def drop_stale_wishes(db_path: str = DB_PATH) -> None:
+    if db_path not in _shared_files:
+        return
+    version = get_pool(db_path).data_version()
+    if _shared_files[db_path] != version:
+        get_wish_cache(db_path).clear()
+        snapshot = _snapshots.get(db_path)
+        if snapshot is not None:
+            snapshot.mark_stale()
+        _shared_files[db_path] = version
+
+
+def _pages_key(creator_id: int, booked: bool) -> Tuple[str, int, bool]:
+    return "pages", creator_id, booked
+
+
+def invalidate_wishes(db_path: str, *keys: Tuple[int, bool]) -> None:
+    """Drops the cached lists `keys` of `db_path` and their pages, and makes its snapshot catch up before it is read
+    again."""
+    get_wish_cache(db_path).invalidate(*keys, *(_pages_key(*key) for key in keys))
+    snapshot = _snapshots.get(db_path)
+    if snapshot is not None:
+        snapshot.mark_stale()
+
+
+class WishSnapshot:
+    """In-memory copy of the wish table of a database file and of its indexes, serving the queries of that table.
+
+    Two copies take turns: readers share the current one while the other catches up, by copying only the wishes
+    named in the change log since it was last current, and then takes its place. The snapshot catches up before
+    the first read after a commit of this process, and at most `max_staleness` seconds after a commit of another one.
+    Making a snapshot turns on the change log of the file, see `enable_wish_changelog`.
+    """
+
+    def __init__(self,
+                 db_path: str = DB_PATH,
+                 max_staleness: float = SNAPSHOT_STALENESS_SECONDS,
+                 clock: Callable[[], float] = time.monotonic,
+                 ):
+        self.db_path = db_path
+        self.max_staleness = max_staleness
+        self.full_copies = 0
+        self.refreshes = 0
+        self._clock = clock
+        self._copies = [self._connect(), self._connect()]
+        # last change log entry applied to each copy, None before its first copy
+        self._seqs: List[Optional[int]] = [None, None]
+        self._readers = [0, 0]
+        self._current = 0
+        # guards `_current` and `_readers`, notified when a reader is done
+        self._turns = threading.Condition()
+        # held while the other copy catches up
+        self._lock = threading.Lock()
+        self._refreshed_at = 0.0
+        # bumped by `mark_stale`, a read catches up if it moved since the last one
+        self._changes = 0
+        self._seen_changes = 0
+        enable_wish_changelog(db_path)
+
+    @staticmethod
+    def _connect() -> sqlite3.Connection:
+        return sqlite3.connect(":memory:",
+                               isolation_level=None,
+                               check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+
+    def mark_stale(self) -> None:
+        self._changes += 1
+
+    def _is_stale(self, changes: int) -> bool:
+        return self._seqs[self._current] is None or changes != self._seen_changes \
+            or self._clock() - self._refreshed_at > self.max_staleness
+
+    @contextmanager
+    def cursor(self) -> Iterator[sqlite3.Cursor]:
+        if self._is_stale(self._changes):
+            self._catch_up()
+        with self._turns:
+            current = self._current
+            self._readers[current] += 1
+        cur = self._copies[current].cursor()
+        try:
+            yield cur
+        finally:
+            cur.close()
+            with self._turns:
+                self._readers[current] -= 1
+                self._turns.notify_all()
+
+    def _catch_up(self) -> None:
+        with self._lock:
+            changes = self._changes
+            # another reader may have caught up meanwhile
+            if not self._is_stale(changes):
+                return
+            spare = 1 - self._current
+            with self._turns:
+                self._turns.wait_for(lambda: self._readers[spare] == 0)
+            self._refresh(spare)
+            with self._turns:
+                self._current = spare
+            self._seen_changes = changes
+
+    def _refresh(self, index: int) -> None:
+        memory = self._copies[index]
+        if self._seqs[index] is None and self._seqs[1 - index] is not None:
+            # the current copy is not written to while it is current, cloning it reads no file
+            self._copies[1 - index].backup(memory)
+            self._seqs[index] = self._seqs[1 - index]
+        seq = self._seqs[index]
+        self._refreshed_at = self._clock()
+        with get_pool(self.db_path).reader() as disk:
+            disk.execute("BEGIN")
+            try:
+                first, last = disk.execute(f"SELECT min(seq), ifnull(max(seq), 0) FROM {WISH_CHANGELOG_TABLE}") \
+                    .fetchone()
+                if seq is not None and (first is None or first <= seq + 1):
+                    wish_ids = [(wish_id,) for wish_id, in disk.execute(
+                        f"SELECT DISTINCT wish_id FROM {WISH_CHANGELOG_TABLE} WHERE seq > ?", [seq])]
+                    rows = list(disk.execute(
+                        f"""
+                        SELECT * FROM {TableName.WISH.value}
+                        WHERE wish_id IN (SELECT wish_id FROM {WISH_CHANGELOG_TABLE} WHERE seq > ?)
+                        """, [seq]))
+                else:
+                    # the first copy, or the changes since the last one were trimmed from the log
+                    self._copy(disk, memory)
+                    wish_ids = rows = None
+            finally:
+                disk.execute("COMMIT")
+        if wish_ids is None:
+            self._seqs[index] = last
+            self.full_copies += 1
+            return
+
+        if wish_ids:
+            memory.execute("BEGIN")
+            try:
+                memory.executemany(f"DELETE FROM {TableName.WISH.value} WHERE wish_id = ?", wish_ids)
+                if rows:
+                    memory.executemany(
+                        f"INSERT INTO {TableName.WISH.value} VALUES ({', '.join('?' * len(rows[0]))})", rows)
+            except BaseException:
+                memory.execute("ROLLBACK")
+                raise
+            memory.execute("COMMIT")
+        # only once the changes are in, a copy failing to apply them tries again on its next turn
+        self._seqs[index] = last
+        self.refreshes += 1
+
+    @staticmethod
+    def _copy(disk: sqlite3.Connection, memory: sqlite3.Connection) -> None:
+        """Copies the wish table and its indexes, leaving out the other tables and the triggers writing to them."""
+        schema = list(disk.execute(
+            """
+            SELECT type, sql FROM sqlite_master
+            WHERE tbl_name = ? AND type IN ('table', 'index') AND sql IS NOT NULL
+            ORDER BY type = 'index'
+            """, [TableName.WISH.value]))
+        memory.execute("BEGIN")
+        try:
+            memory.execute(f"DROP TABLE IF EXISTS {TableName.WISH.value}")
+            memory.execute(schema[0][1])
+            rows = disk.execute(f"SELECT * FROM {TableName.WISH.value}")
+            memory.executemany(
+                f"INSERT INTO {TableName.WISH.value} VALUES ({', '.join('?' * len(rows.description))})", rows)
+            # indexes are built once the rows are in
+            for _, sql in schema[1:]:
+                memory.execute(sql)
+        except BaseException:
+            memory.execute("ROLLBACK")
+            raise
+        memory.execute("COMMIT")
+
+    def size(self) -> int:
+        """Bytes held by both copies."""
+        with self._lock:
+            return sum(copy.execute("PRAGMA page_count").fetchone()[0] * copy.execute("PRAGMA page_size").fetchone()[0]
+                       for copy in self._copies)
+
+    def close(self) -> None:
+        with self._lock, self._turns:
+            self._turns.wait_for(lambda: not any(self._readers))
+            for copy in self._copies:
+                copy.close()
+
+
+_snapshots: Dict[str, WishSnapshot] = dict()
+
+
+def configure_snapshot(db_path: str = DB_PATH,
+                       max_staleness: Optional[float] = SNAPSHOT_STALENESS_SECONDS,
+                       ) -> Optional[WishSnapshot]:
+    """Serves the wish lists of `db_path` from an in-memory snapshot, from the file again if `max_staleness` is None.
+
+    Every process writing to `db_path` has to be configured alike, writes are only logged while snapshots are on.
+    """
+    # made outside of the lock, turning the change log on or off takes a pooled connection
+    snapshot = WishSnapshot(db_path, max_staleness) if max_staleness is not None else None
+    with _pools_lock:
+        old_snapshot = _snapshots.pop(db_path, None)
+        if old_snapshot is not None:
+            old_snapshot.close()
+        if snapshot is not None:
+            _snapshots[db_path] = snapshot
+    if snapshot is None:
+        disable_wish_changelog(db_path)
+    return snapshot
+
+
 @contextmanager
-def db_ops(db_name):
-    conn = sqlite3.connect(db_name)
-    cur = conn.cursor()
-    yield cur
-    conn.commit()
-    conn.close()
+def wish_reads(db_path: str = DB_PATH) -> Iterator[sqlite3.Cursor]:
+    """Read cursor for queries of the wish table alone, on the snapshot of `db_path` if it has one."""
+    snapshot = _snapshots.get(db_path)
+    if snapshot is None:
+        with db_ops(db_path, readonly=True) as cur:
+            yield cur
+    else:
+        with snapshot.cursor() as cur:
+            yield cur
+
+
+@contextmanager
+def db_ops(db_name: str = DB_PATH, readonly: bool = False, immediate: bool = False) -> Iterator[sqlite3.Cursor]:
+    """Yields a cursor of a pooled connection.
+
+    Unless `readonly` is set, everything done with the cursor runs in a single transaction on the writer connection,
+    which is committed on exit and rolled back on exception. Nested calls join the outer transaction.
+    An `immediate` transaction takes the write lock upfront instead of on its first write.
+    """
+    pool = get_pool(db_name)
+    if readonly:
+        with pool.reader() as conn:
+            cur = conn.cursor()
+            try:
+                yield cur
+            finally:
+                cur.close()
+        return
+
+    with pool.writer() as conn:
+        cur = conn.cursor()
+        if conn.in_transaction:
+            try:
+                yield cur
+            finally:
+                cur.close()
+            return
+
+        cur.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        pool.transaction_owner = threading.get_ident()
+        try:
+            yield cur
+        except BaseException:
+            pool.after_commit.clear()
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+                metrics.DB_ROLLBACKS.inc()
+            raise
+        else:
+            try:
+                conn.execute("COMMIT")
+            except BaseException:
+                pool.after_commit.clear()
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                    metrics.DB_ROLLBACKS.inc()
+                raise
+            callbacks, pool.after_commit = pool.after_commit, []
+            pool.transaction_owner = None
+            for callback in callbacks:
+                callback()
+        finally:
+            pool.transaction_owner = None
+            cur.close()
+
+
+def after_commit(db_path: str, callback: Callable[[], None]) -> None:
+    """Calls `callback` once the write transaction of the calling thread commits, right away if there is none.
+
+    Keeps caches from being refilled with data a batch has not committed yet.
+    """
+    pool = get_pool(db_path)
+    if pool.transaction_owner == threading.get_ident():
+        pool.after_commit.append(callback)
+    else:
+        callback()
 
 
 class Table(ABC):
@@ -42,6 +545,14 @@ class Table(ABC):
         self.db_path = db_path
         self.table_name = ""
 
+    def __init_subclass__(cls, **kwargs):
+        """Times every public method a table defines, under `<class>.<method>`."""
+        super().__init_subclass__(**kwargs)
+        for name, attribute in list(vars(cls).items()):
+            if callable(attribute) and not name.startswith("_"):
+                setattr(cls, name, timed_db_operation(f"{cls.__name__}.{name}")(attribute))
+
+    @timed_db_operation("Table.delete")
     def delete(self):
         with db_ops(self.db_path) as cur:
             cur.execute(f"DROP TABLE IF EXISTS {self.table_name}")
@@ -56,57 +567,67 @@ class Table(ABC):
 
 
 class Creator(Table):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, db_path: str = DB_PATH):
+        super().__init__(db_path)
         self.table_name = TableName.CREATOR.value
 
     def create_table(self) -> Table:
         with db_ops(self.db_path) as cur:
             query = f"""CREATE TABLE IF NOT EXISTS {self.table_name} 
                     ( 
-                        creator_name TEXT NOT NULL PRIMARY KEY
+                        creator_name TEXT NOT NULL,
+                        creator_id INTEGER NOT NULL PRIMARY KEY
                     )"""  # TODO: add name
             cur.execute(query)
         return self
 
     def add(self,
-            creator_name: str
+            creator_id: int,
+            creator_name: str,
             ) -> None:
         with db_ops(self.db_path) as cur:
             cur.execute(
                 f"""
                 INSERT INTO {self.table_name} VALUES
-                    (?)
-                """, [creator_name, ])
+                    (?, ?)
+                ON CONFLICT(creator_id) DO UPDATE SET creator_name = excluded.creator_name
+                """, [creator_name, creator_id])
 
 
 class Presenter(Table):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, db_path: str = DB_PATH):
+        super().__init__(db_path)
         self.table_name = TableName.PRESENTER.value
 
     def create_table(self) -> Table:
         with db_ops(self.db_path) as cur:
             query = f"""CREATE TABLE IF NOT EXISTS {self.table_name} 
                     ( 
-                        presenter_name TEXT NOT NULL PRIMARY KEY
+                        presenter_name TEXT NOT NULL,
+                        presenter_id INTEGER NOT NULL PRIMARY KEY
                     )"""
             cur.execute(query)
         return self
 
-    def add(self, telegram_id: int) -> None:
+    def add(self, presenter_id: int, presenter_name: str) -> None:
         with db_ops(self.db_path) as cur:
             cur.execute(
                 f"""
                 INSERT INTO {self.table_name} VALUES
-                    (?)
-                """, [telegram_id, ])
+                    (?, ?)
+                ON CONFLICT(presenter_id) DO UPDATE SET presenter_name = excluded.presenter_name
+                """, [presenter_name, presenter_id])
 
 
 class Wish(Table):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, db_path: str = DB_PATH):
+        super().__init__(db_path)
         self.table_name = TableName.WISH.value
+        self.cache = get_wish_cache(db_path)
+
+    def delete(self):
+        super().delete()
+        self.cache.clear()
 
     def create_table(self) -> Table:
         with db_ops(self.db_path) as cur:
@@ -127,12 +648,17 @@ class Wish(Table):
                         photo_id TEXT,
                         desc TEXT,
                         quantity INTEGER,
-                        FOREIGN KEY(creator_name) REFERENCES creator(creator_name)
+                        creator_id INTEGER NOT NULL,
+                        price_amount REAL,
+                        price_currency TEXT,
+                        photo_unique_id TEXT,
+                        FOREIGN KEY(creator_id) REFERENCES creator(creator_id)
                     )"""
             cur.execute(query)
         return self
 
     def add(self,
+            creator_id: int,
             creator_name: str,
             name: str,
             priority: Optional[int] = None,
@@ -141,41 +667,206 @@ class Wish(Table):
             price: Optional[float] = None,
             photo_id: Optional[str] = None,
             desc: Optional[str] = None,
-            quantity: Optional[int] = None
+            quantity: Optional[int] = None,
+            photo_unique_id: Optional[str] = None,
             ) -> None:
+        """`price` is stored as given, along with the amount and currency parsed from it."""
         with db_ops(self.db_path) as cur:
             cur.execute(
                 f"""
                 INSERT INTO {self.table_name} VALUES
-                    (null, 0, 0, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, [creator_name, name, priority, relation_type, link, price, photo_id, desc, quantity])
+                    (null, 0, 0, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, [creator_name, name, priority, relation_type, link, price, photo_id, desc, quantity, creator_id,
+                      *parse_price(price), photo_unique_id])
+        after_commit(self.db_path, lambda: invalidate_wishes(self.db_path, (creator_id, False)))
 
-    def search_by_creator_and_booked_value(self, creator_name: str, booked_value_needed: bool = False) -> List[tuple]:
-        with db_ops(self.db_path) as cur:
-            return list(cur.execute(
+    def add_many(self, wishes: Iterable[WishData]) -> List[int]:
+        """Inserts `wishes` with a single `executemany` in one transaction and returns their new ids, in order.
+
+        `wish_id` of the given wishes is ignored.
+        """
+        wishes = list(wishes)
+        # the write lock is taken before the ids are read, so no other connection can insert in between
+        with db_ops(self.db_path, immediate=True) as cur:
+            # the ids AUTOINCREMENT would hand out
+            last_id = cur.execute("SELECT ifnull(max(seq), 0) FROM sqlite_sequence WHERE name = ?",
+                                  [self.table_name]).fetchone()[0]
+            wish_ids = list(range(last_id + 1, last_id + 1 + len(wishes)))
+            cur.executemany(
                 f"""
+                INSERT INTO {self.table_name} VALUES
+                    (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, [(wish_id, int(bool(wish.booked)), int(bool(wish.presented)), wish.creator_name, wish.name,
+                       wish.priority, wish.relation_type, wish.link, wish.price, wish.photo_id, wish.desc,
+                       wish.quantity, wish.creator_id, *parse_price(wish.price), wish.photo_unique_id)
+                      for wish_id, wish in zip(wish_ids, wishes)])
+        creator_ids = {wish.creator_id for wish in wishes}
+        after_commit(self.db_path,
+                     lambda: invalidate_wishes(self.db_path, *((creator_id, booked) for creator_id in creator_ids
+                                                               for booked in (False, True))))
+        return wish_ids
+
+    def search_by_creator_and_booked_value_query(self) -> str:
+        return f"""
                 SELECT * FROM {self.table_name} 
-                WHERE creator_name = ? and booked = ? 
-                ORDER BY priority ASC
-                NULLS LAST
-                """, [creator_name, int(booked_value_needed)]
+                WHERE creator_id = ? and booked = ? 
+                ORDER BY {PRIORITY_SORT_KEY}, wish_id
+                """
+
+    def search_by_creator_and_booked_value(self,
+                                           creator_id: int,
+                                           booked_value_needed: bool = False,
+                                           row_factory: Optional[RowFactory] = None,
+                                           ) -> List[Any]:
+        with wish_reads(self.db_path) as cur:
+            cur.row_factory = row_factory
+            return list(cur.execute(
+                self.search_by_creator_and_booked_value_query(), [creator_id, int(booked_value_needed)]
             )
             )
 
+    def search_page(self,
+                    creator_id: int,
+                    booked_value_needed: bool = False,
+                    limit: int = PAGE_SIZE,
+                    after: Optional[WishCursor] = None,
+                    before: Optional[WishCursor] = None,
+                    row_factory: Optional[RowFactory] = None,
+                    wish_order: WishOrder = WishOrder.PRIORITY,
+                    max_price: Optional[float] = None,
+                    currency: Optional[str] = None,
+                    ) -> List[Any]:
+        """Up to `limit` rows of the list of `creator_id` in `wish_order`, right after `after` or right before `before`.
+
+        Seeks through the index on the list order, so only the returned rows are read. A `max_price` bounds the range
+        scanned on the price index, so it requires the price order; wishes in other currencies than `currency`
+        are skipped.
+        """
+        if max_price is not None and wish_order != WishOrder.PRICE:
+            raise ValueError("Filtering by price requires the price order")
+        sort_key = SORT_KEYS[wish_order]
+        params = [creator_id, int(booked_value_needed)]
+        seek = ""
+        order = "ASC"
+        if after is not None:
+            seek = f"AND {sort_key} >= ? AND ({sort_key} > ? OR wish_id > ?)"
+            params += [after[0], after[0], after[1]]
+        elif before is not None:
+            seek = f"AND {sort_key} <= ? AND ({sort_key} < ? OR wish_id < ?)"
+            params += [before[0], before[0], before[1]]
+            order = "DESC"
+        if max_price is not None:
+            seek += f" AND {sort_key} <= ?"
+            params.append(max_price)
+        if currency is not None:
+            seek += " AND price_currency = ?"
+            params.append(currency)
+        with wish_reads(self.db_path) as cur:
+            cur.row_factory = row_factory
+            rows = list(cur.execute(
+                f"""
+                SELECT * FROM {self.table_name}
+                WHERE creator_id = ? and booked = ? {seek}
+                ORDER BY {sort_key} {order}, wish_id {order}
+                LIMIT ?
+                """, params + [limit]
+            ))
+        if before is not None:
+            rows.reverse()
+        return rows
+
+    def search_wishes(self, creator_id: int, booked_value_needed: bool = False) -> List[WishData]:
+        """Cached version of `search_by_creator_and_booked_value` returning materialized wishes."""
+        drop_stale_wishes(self.db_path)
+        wishes = self.cache.get_or_load(
+            (creator_id, booked_value_needed),
+            lambda: self.search_by_creator_and_booked_value(creator_id, booked_value_needed, WishData.row_factory)
+        )
+        return list(wishes)
+
+    def search_wishes_page(self,
+                           creator_id: int,
+                           booked_value_needed: bool = False,
+                           limit: int = PAGE_SIZE,
+                           after: Optional[WishCursor] = None,
+                           before: Optional[WishCursor] = None,
+                           wish_order: WishOrder = WishOrder.PRIORITY,
+                           max_price: Optional[float] = None,
+                           currency: Optional[str] = None,
+                           ) -> List[WishData]:
+        """Cached version of `search_page` returning materialized wishes.
+
+        Pages are keyed by the generation of their list, a new one after every invalidation of the list, so a write
+        drops all of them at once and the pages of the old generation age out.
+        """
+        drop_stale_wishes(self.db_path)
+        generation = self.cache.get_or_load(_pages_key(creator_id, booked_value_needed), object)
+        wishes = self.cache.get_or_load(
+            (generation, limit, after, before, wish_order, max_price, currency),
+            lambda: self.search_page(creator_id, booked_value_needed, limit, after, before, WishData.row_factory,
+                                     wish_order, max_price, currency)
+        )
+        return list(wishes)
+
+    def search_text(self,
+                    presenter_id: int,
+                    terms: str,
+                    limit: int = PAGE_SIZE,
+                    offset: int = 0,
+                    row_factory: Optional[RowFactory] = None,
+                    ) -> List[Any]:
+        """Unbooked wishes matching `terms` in their name or description, best match first.
+
+        Only wishes of creators `presenter_id` has a relation with are searched.
+        """
+        query = fts_query(terms)
+        if not query:
+            return []
+        with db_ops(self.db_path, readonly=True) as cur:
+            cur.row_factory = row_factory
+            return list(cur.execute(
+                f"""
+                SELECT w.* FROM {WISH_FTS_TABLE}
+                JOIN {self.table_name} w ON w.wish_id = {WISH_FTS_TABLE}.rowid
+                WHERE {WISH_FTS_TABLE} MATCH ? AND w.booked = 0 AND w.creator_id IN (
+                    SELECT creator_id FROM {TableName.RELATION.value} WHERE presenter_id = ?
+                )
+                ORDER BY {WISH_FTS_TABLE}.rank, w.wish_id
+                LIMIT ? OFFSET ?
+                """, [query, presenter_id, limit, offset]
+            ))
+
     def change_booked(self, wish_id: int, booked_value_to_set: bool):
         with db_ops(self.db_path) as cur:
-            cur.execute(
+            creator_ids = list(cur.execute(
                 f"""
                 UPDATE {self.table_name}
                 SET booked = ? 
                 WHERE wish_id = ?
+                RETURNING creator_id
                 """, [int(booked_value_to_set), wish_id, ]
-            )
+            ))
+        for (creator_id,) in creator_ids:
+            after_commit(self.db_path,
+                         lambda creator_id=creator_id: invalidate_wishes(self.db_path, (creator_id, False),
+                                                                         (creator_id, True)))
+
+
+def fts_query(terms: str) -> str:
+    """FTS5 query matching every word of `terms` as a prefix, user input never reaches the query syntax."""
+    words = [word.replace('"', '""') for word in terms.split()]
+    return " ".join(f'"{word}"*' for word in words if word.strip('"'))
+
+
+def wish_cursor(wish: WishData, wish_order: WishOrder = WishOrder.PRIORITY) -> WishCursor:
+    if wish_order == WishOrder.PRICE:
+        return PRICE_NULL_KEY if wish.price_amount is None else wish.price_amount, wish.wish_id
+    return PRIORITY_NULL_KEY if wish.priority is None else wish.priority, wish.wish_id
 
 
 class Relation(Table):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, db_path: str = DB_PATH):
+        super().__init__(db_path)
         self.table_name = TableName.RELATION.value
 
     def create_table(self) -> Table:
@@ -186,15 +877,19 @@ class Relation(Table):
                     creator_name TEXT NOT NULL,
                     presenter_name TEXT NOT NULL,
                     relation_type TEXT, 
+                    creator_id INTEGER NOT NULL,
+                    presenter_id INTEGER NOT NULL,
                     FOREIGN KEY(relation_id) REFERENCES relation(relation_id),
-                    FOREIGN KEY(creator_name) REFERENCES creator(creator_name),
-                    FOREIGN KEY(presenter_name) REFERENCES presenter(presenter_name)
+                    FOREIGN KEY(creator_id) REFERENCES creator(creator_id),
+                    FOREIGN KEY(presenter_id) REFERENCES presenter(presenter_id)
                     )"""
             cur.execute(query)
         return self
 
     def add(self,
+            creator_id: int,
             creator_name: str,
+            presenter_id: int,
             presenter_name: str,
             relation_type: RelationType = None,
             ) -> None:
@@ -202,13 +897,69 @@ class Relation(Table):
             cur.execute(
                 f"""
                 INSERT INTO {self.table_name} VALUES
-                    (null, ?, ?, ?)
-                """, [creator_name, presenter_name, relation_type.value])
+                    (null, ?, ?, ?, ?, ?)
+                """, [creator_name, presenter_name, relation_type.value, creator_id, presenter_id])
 
+    def replace(self,
+                creator_id: int,
+                creator_name: str,
+                presenter_id: int,
+                presenter_name: str,
+                relation_type: RelationType,
+                ) -> None:
+        """Makes `relation_type` the only relation of the presenter to the creator."""
+        with db_ops(self.db_path):
+            self.remove(creator_id, presenter_id)
+            self.add(creator_id, creator_name, presenter_id, presenter_name, relation_type)
 
-class Booked(Table):
-    def __init__(self):
-        super().__init__()
+    def remove(self, creator_id: int, presenter_id: int) -> bool:
+        with db_ops(self.db_path) as cur:
+            cur.execute(f"DELETE FROM {self.table_name} WHERE creator_id = ? AND presenter_id = ?",
+                        [creator_id, presenter_id])
+            return cur.rowcount > 0
+
+
+class Bookings(Table):
+    """A table of bookings, which are listed by presenter."""
+
+    def page(self,
+             presenter_id: int,
+             limit: int = PAGE_SIZE,
+             after: Optional[BookingCursor] = None,
+             before: Optional[BookingCursor] = None,
+             row_factory: Optional[RowFactory] = None,
+             ) -> List[Any]:
+        """Up to `limit` rows of `SELECT w.*, b.date` for the bookings of `presenter_id`, most recent first,
+        right after `after` or right before `before`. Seeks through the index on `(presenter_id, date)`."""
+        params = [presenter_id]
+        seek = ""
+        order = "DESC"
+        if after is not None:
+            seek = "AND b.date <= ? AND (b.date < ? OR b.wish_id < ?)"
+            params += [after[0], after[0], after[1]]
+        elif before is not None:
+            seek = "AND b.date >= ? AND (b.date > ? OR b.wish_id > ?)"
+            params += [before[0], before[0], before[1]]
+            order = "ASC"
+        with db_ops(self.db_path, readonly=True) as cur:
+            cur.row_factory = row_factory
+            rows = list(cur.execute(
+                f"""
+                SELECT w.*, b.date FROM {self.table_name} b
+                JOIN {TableName.WISH.value} w ON w.wish_id = b.wish_id
+                WHERE b.presenter_id = ? {seek}
+                ORDER BY b.date {order}, b.wish_id {order}
+                LIMIT ?
+                """, params + [limit]
+            ))
+        if before is not None:
+            rows.reverse()
+        return rows
+
+
+class Booked(Bookings):
+    def __init__(self, db_path: str = DB_PATH):
+        super().__init__(db_path)
         self.table_name = TableName.BOOKED.value
 
     def create_table(self) -> Table:
@@ -219,16 +970,20 @@ class Booked(Table):
                         creator_name TEXT NOT NULL,
                         presenter_name TEXT NOT NULL,
                         date INT NOT NULL,
+                        creator_id INTEGER NOT NULL,
+                        presenter_id INTEGER NOT NULL,
                         FOREIGN KEY(wish_id) REFERENCES present(wish_id),
-                        FOREIGN KEY(creator_name) REFERENCES creator(creator_name),
-                        FOREIGN KEY(presenter_name) REFERENCES presenter(presenter_name),
-                        PRIMARY KEY(wish_id, presenter_name)
+                        FOREIGN KEY(creator_id) REFERENCES creator(creator_id),
+                        FOREIGN KEY(presenter_id) REFERENCES presenter(presenter_id),
+                        PRIMARY KEY(wish_id, presenter_id)
                     )"""
             cur.execute(query)
         return self
 
     def add(self,
+            creator_id: int,
             creator_name: str,
+            presenter_id: int,
             presenter_name: str,
             wish_id: int,
             date: Optional[int] = None,
@@ -239,67 +994,821 @@ class Booked(Table):
             cur.execute(
                 f"""
                 INSERT INTO {self.table_name} VALUES
-                    (null, ?, ?, ?, ?)
-                """, [creator_name, presenter_name, wish_id, date])
+                    (?, ?, ?, ?, ?, ?)
+                """, [wish_id, creator_name, presenter_name, date, creator_id, presenter_id])
 
 
-class Presented(Booked):
-    def __init__(self):
-        super().__init__()
-        self.table_name = "presented"
+class BookedArchive(Bookings):
+    """Bookings moved out of `booked` by `archive_bookings`, so the table bookings are read from stays small."""
+
+    def __init__(self, db_path: str = DB_PATH):
+        super().__init__(db_path)
+        self.table_name = TableName.BOOKED_ARCHIVE.value
+
+    def create_table(self) -> Table:
+        with db_ops(self.db_path) as cur:
+            # a wish may be booked again by the same presenter once archived, so no primary key;
+            # imported bookings only name their presenter and have no presenter_id
+            query = f"""CREATE TABLE IF NOT EXISTS {self.table_name}
+                    (
+                        wish_id INT NOT NULL,
+                        creator_name TEXT NOT NULL,
+                        presenter_name TEXT NOT NULL,
+                        date INT NOT NULL,
+                        creator_id INTEGER,
+                        presenter_id INTEGER,
+                        archived INT NOT NULL
+                    )"""
+            cur.execute(query)
+        return self
+
+    def add(self,
+            creator_id: int,
+            creator_name: str,
+            presenter_id: int,
+            presenter_name: str,
+            wish_id: int,
+            date: int,
+            archived: Optional[int] = None,
+            ) -> None:
+        if not archived:
+            archived = current_time_in_ms_since_1970()
+        with db_ops(self.db_path) as cur:
+            cur.execute(
+                f"""
+                INSERT INTO {self.table_name} VALUES
+                    (?, ?, ?, ?, ?, ?, ?)
+                """, [wish_id, creator_name, presenter_name, date, creator_id, presenter_id, archived])
+
+    def add_many(self, bookings: Iterable[Tuple[int, str, str, int, int, Optional[int], int]]) -> None:
+        """Inserts `(wish_id, creator_name, presenter_name, date, creator_id, presenter_id, archived)` rows
+        with a single `executemany`."""
+        with db_ops(self.db_path) as cur:
+            cur.executemany(
+                f"""
+                INSERT INTO {self.table_name} VALUES
+                    (?, ?, ?, ?, ?, ?, ?)
+                """, bookings)
+
 
-    def do_present_wish(self, wish_id: int) -> None:
-        ...
+def _archive_booking_rows(cur: sqlite3.Cursor, rowids: List[int]) -> None:
+    placeholders = ", ".join("?" * len(rowids))
+    cur.execute(
+        f"""
+        INSERT INTO {TableName.BOOKED_ARCHIVE.value}
+        SELECT wish_id, creator_name, presenter_name, date, creator_id, presenter_id, ?
+        FROM {TableName.BOOKED.value} WHERE rowid IN ({placeholders})
+        """, [current_time_in_ms_since_1970(), *rowids])
+    cur.execute(f"DELETE FROM {TableName.BOOKED.value} WHERE rowid IN ({placeholders})", rowids)
 
 
-def book_wish(wish_id: int, presenter_name: str):
-    sql = sqlite3.connect(DB_PATH)
-    sql.isolation_level = None
-    cur = sql.cursor()
-    cur.execute("BEGIN")
-    try:
-        creator_name_list = list(cur.execute(
+def archive_bookings(db_path: str = DB_PATH,
+                     older_than: Optional[int] = None,
+                     batch_size: int = BOOKING_ARCHIVE_BATCH_SIZE,
+                     ) -> int:
+    """Moves up to `batch_size` bookings to the archive in one transaction and returns how many were moved.
+
+    Moved are the bookings made before `older_than` (`BOOKING_RETENTION_MS` ago by default) and those of wishes
+    that were presented, unbooked or deleted since. The latter are found by a scan of `booked`, which these moves
+    keep short.
+    """
+    if older_than is None:
+        older_than = current_time_in_ms_since_1970() - BOOKING_RETENTION_MS
+    with db_ops(db_path) as cur:
+        rowids = [row[0] for row in cur.execute(
             f"""
-                SELECT creator_name FROM {TableName.WISH.value}
-                WHERE wish_id = ?
-            """, [wish_id, ]
-        ))
-        if not creator_name_list:
-            raise ValueError("This wish_id doesn't exist")
-        creator_name = creator_name_list[0][0]
+            SELECT rowid FROM {TableName.BOOKED.value} WHERE date < ?
+            UNION
+            SELECT b.rowid FROM {TableName.BOOKED.value} b
+            LEFT JOIN {TableName.WISH.value} w ON w.wish_id = b.wish_id
+            WHERE w.wish_id IS NULL OR w.presented = 1 OR w.booked = 0
+            LIMIT ?
+            """, [older_than, batch_size])]
+        if rowids:
+            _archive_booking_rows(cur, rowids)
+    return len(rowids)
 
-        cur.execute(
+
+class Presented(Booked):
+    def __init__(self, db_path: str = DB_PATH):
+        super().__init__(db_path)
+        self.table_name = TableName.PRESENTED.value
+
+    def do_present_wish(self, wish_id: int, presenter_id: int) -> bool:
+        """Marks the wish `presenter_id` booked as presented and moves its booking to the archive.
+
+        Returns False if `presenter_id` has no booking of the wish or it was presented already.
+        """
+        with db_ops(self.db_path) as cur:
+            bookings = list(cur.execute(
+                f"SELECT rowid FROM {TableName.BOOKED.value} WHERE wish_id = ? AND presenter_id = ?",
+                [wish_id, presenter_id]))
+            if not bookings:
+                return False
+            creator_ids = list(cur.execute(
+                f"""
+                UPDATE {TableName.WISH.value} SET presented = 1
+                WHERE wish_id = ? AND presented = 0
+                RETURNING creator_id
+                """, [wish_id]))
+            if not creator_ids:
+                return False
+            cur.execute(
+                f"""
+                INSERT INTO {self.table_name}
+                SELECT wish_id, creator_name, presenter_name, ?, creator_id, presenter_id
+                FROM {TableName.BOOKED.value} WHERE rowid = ?
+                """, [current_time_in_ms_since_1970(), bookings[0][0]])
+            _archive_booking_rows(cur, [rowid for rowid, in bookings])
+        creator_id = creator_ids[0][0]
+        after_commit(self.db_path, lambda: invalidate_wishes(self.db_path, (creator_id, True)))
+        return True
+
+
+class Username(Table):
+    """Current username of every known Telegram user, where `@username` is resolved to a user id.
+
+    Usernames only seen in rows written before user ids were stored point to negative placeholder ids
+    until their owner talks to the bot, see `remember_user`.
+    """
+
+    def __init__(self, db_path: str = DB_PATH):
+        super().__init__(db_path)
+        self.table_name = TableName.USERNAME.value
+
+    def create_table(self) -> Table:
+        with db_ops(self.db_path) as cur:
+            query = f"""CREATE TABLE IF NOT EXISTS {self.table_name}
+                    (
+                        username TEXT NOT NULL PRIMARY KEY COLLATE NOCASE,
+                        user_id INTEGER NOT NULL,
+                        date INT NOT NULL
+                    ) WITHOUT ROWID"""
+            cur.execute(query)
+        return self
+
+    def add(self, username: str, user_id: int, date: Optional[int] = None) -> None:
+        if date is None:
+            date = current_time_in_ms_since_1970()
+        with db_ops(self.db_path) as cur:
+            cur.execute(
+                f"""
+                INSERT INTO {self.table_name} VALUES
+                    (?, ?, ?)
+                ON CONFLICT(username) DO UPDATE SET user_id = excluded.user_id, date = excluded.date
+                """, [username, user_id, date])
+
+    def resolve(self, username: str) -> Optional[int]:
+        with db_ops(self.db_path, readonly=True) as cur:
+            row = cur.execute(f"SELECT user_id FROM {self.table_name} WHERE username = ?", [username]).fetchone()
+        return None if row is None else row[0]
+
+    def _last_placeholder_id(self, cur: sqlite3.Cursor) -> int:
+        return cur.execute(f"SELECT min(0, ifnull(min(user_id), 0)) FROM {self.table_name}").fetchone()[0]
+
+
+class Photo(Table):
+    """Variants of the photos of wishes by their `file_unique_id`, an image sent twice is stored once.
+
+    A photo is identified by the `file_unique_id` of its largest variant, which wishes store as `photo_unique_id`.
+    """
+
+    def __init__(self, db_path: str = DB_PATH):
+        super().__init__(db_path)
+        self.table_name = TableName.PHOTO.value
+
+    def create_table(self) -> Table:
+        with db_ops(self.db_path) as cur:
+            query = f"""CREATE TABLE IF NOT EXISTS {self.table_name}
+                    (
+                        file_unique_id TEXT NOT NULL PRIMARY KEY,
+                        photo_unique_id TEXT NOT NULL,
+                        file_id TEXT NOT NULL,
+                        width INTEGER NOT NULL,
+                        height INTEGER NOT NULL,
+                        file_size INTEGER
+                    ) WITHOUT ROWID"""
+            cur.execute(query)
+            cur.execute(f"""CREATE INDEX IF NOT EXISTS photo_photo_unique_id
+                            ON {self.table_name}(photo_unique_id)""")
+        return self
+
+    def add(self, variants: Iterable[PhotoVariant]) -> str:
+        """Stores the variants of one photo not stored yet and returns the `file_unique_id` of the photo."""
+        variants = list(variants)
+        photo_unique_id = max(variants, key=lambda variant: variant.width * variant.height).file_unique_id
+        with db_ops(self.db_path) as cur:
+            cur.executemany(
+                f"""
+                INSERT INTO {self.table_name} VALUES
+                    (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(file_unique_id) DO NOTHING
+                """, [(variant.file_unique_id, photo_unique_id, variant.file_id, variant.width, variant.height,
+                       variant.file_size) for variant in variants])
+        return photo_unique_id
+
+    def thumbnails(self, photo_unique_ids: Iterable[str], side: int = THUMBNAIL_SIDE) -> Dict[str, str]:
+        """`file_id` of the smallest variant with a side of at least `side` px of each photo that has one."""
+        photo_unique_ids = list(set(photo_unique_ids))
+        if not photo_unique_ids:
+            return dict()
+        with db_ops(self.db_path, readonly=True) as cur:
+            # the bare file_id comes from the row of the min()
+            return {photo_unique_id: file_id for photo_unique_id, file_id, _ in cur.execute(
+                f"""
+                SELECT photo_unique_id, file_id, min(width * height) FROM {self.table_name}
+                WHERE photo_unique_id IN ({", ".join("?" * len(photo_unique_ids))}) AND max(width, height) >= ?
+                GROUP BY photo_unique_id
+                """, [*photo_unique_ids, side])}
+
+
+# a wish is shown to the presenters related to its creator, to one type of relation only if it names one
+FEED_VISIBILITY = "{wish}.creator_id = {relation}.creator_id AND {wish}.booked = 0 " \
+                  "AND ({wish}.relation_type IS NULL OR {wish}.relation_type = {relation}.relation_type)"
+
+
+class Feed(Table):
+    """Unbooked wishes of everyone a presenter is related to, see `FEED_VISIBILITY`.
+
+    A materialized join of `relation` and `wish`, kept current by the triggers `add_feed` creates,
+    so a feed page is a range read of the primary key instead of a join over every relation.
+    """
+
+    def __init__(self, db_path: str = DB_PATH):
+        super().__init__(db_path)
+        self.table_name = TableName.FEED.value
+
+    def create_table(self) -> Table:
+        with db_ops(self.db_path) as cur:
+            query = f"""CREATE TABLE IF NOT EXISTS {self.table_name}
+                    (
+                        presenter_id INTEGER NOT NULL,
+                        wish_id INTEGER NOT NULL,
+                        creator_id INTEGER NOT NULL,
+                        PRIMARY KEY(presenter_id, wish_id)
+                    ) WITHOUT ROWID"""
+            cur.execute(query)
+        return self
+
+    def add(self, presenter_id: int, wish_id: int, creator_id: int) -> None:
+        with db_ops(self.db_path) as cur:
+            cur.execute(
+                f"""
+                INSERT OR IGNORE INTO {self.table_name} VALUES
+                    (?, ?, ?)
+                """, [presenter_id, wish_id, creator_id])
+
+    def rebuild(self) -> None:
+        """Recomputes every row from `relation` and `wish`."""
+        with db_ops(self.db_path) as cur:
+            cur.execute(f"DELETE FROM {self.table_name}")
+            cur.execute(
+                f"""
+                INSERT OR IGNORE INTO {self.table_name}
+                SELECT r.presenter_id, w.wish_id, w.creator_id
+                FROM {TableName.RELATION.value} r JOIN {TableName.WISH.value} w
+                    ON {FEED_VISIBILITY.format(wish="w", relation="r")}
+                WHERE r.presenter_id IS NOT NULL
+                """)
+
+    def page(self,
+             presenter_id: int,
+             limit: int = PAGE_SIZE,
+             older_than: Optional[int] = None,
+             newer_than: Optional[int] = None,
+             row_factory: Optional[RowFactory] = None,
+             ) -> List[Any]:
+        """Up to `limit` wishes of the presenter's feed, newest first, right after the wish with id `older_than`
+        or right before the one with id `newer_than`."""
+        params = [presenter_id]
+        seek = ""
+        order = "DESC"
+        if older_than is not None:
+            seek = "AND f.wish_id < ?"
+            params.append(older_than)
+        elif newer_than is not None:
+            seek = "AND f.wish_id > ?"
+            params.append(newer_than)
+            order = "ASC"
+        with db_ops(self.db_path, readonly=True) as cur:
+            cur.row_factory = row_factory
+            rows = list(cur.execute(
+                f"""
+                SELECT w.* FROM {self.table_name} f
+                JOIN {TableName.WISH.value} w ON w.wish_id = f.wish_id
+                WHERE f.presenter_id = ? {seek}
+                ORDER BY f.wish_id {order}
+                LIMIT ?
+                """, params + [limit]
+            ))
+        if newer_than is not None:
+            rows.reverse()
+        return rows
+
+
+def is_busy_error(error: sqlite3.Error) -> bool:
+    return isinstance(error, sqlite3.OperationalError) and \
+        any(reason in str(error) for reason in ("database is locked", "database is busy"))
+
+
+def _try_book_wish(wish_id: int,
+                   presenter_id: int,
+                   presenter_name: str,
+                   db_path: str,
+                   ) -> Tuple[BookingOutcome, Optional[int]]:
+    with db_ops(db_path, immediate=True) as cur:
+        booked_by = list(cur.execute(
             f"""
                 UPDATE {TableName.WISH.value}
-                SET booked = 1 
-                WHERE wish_id = ?
+                SET booked = 1
+                WHERE wish_id = ? AND booked = 0
+                RETURNING creator_id, creator_name
             """, [wish_id, ]
-        )
+        ))
+        if not booked_by:
+            exists = cur.execute(f"SELECT 1 FROM {TableName.WISH.value} WHERE wish_id = ?", [wish_id]).fetchone()
+            return (BookingOutcome.ALREADY_BOOKED if exists else BookingOutcome.MISSING), None
+        creator_id, creator_name = booked_by[0]
 
         cur.execute(
             f"""
             INSERT INTO {TableName.BOOKED.value} VALUES
-                (?, ?, ?, ?)
-            """, [wish_id, creator_name, presenter_name, current_time_in_ms_since_1970()]
+                (?, ?, ?, ?, ?, ?)
+            """, [wish_id, creator_name, presenter_name, current_time_in_ms_since_1970(), creator_id, presenter_id]
         )
+    return BookingOutcome.BOOKED, creator_id
+
+
+@timed_db_operation("book_wish")
+def book_wish(wish_id: int,
+              presenter_id: int,
+              presenter_name: str,
+              db_path: str = DB_PATH,
+              max_attempts: int = BOOKING_MAX_ATTEMPTS,
+              ) -> BookingOutcome:
+    """Books the wish unless it is booked already, in one short write transaction.
+
+    A busy database is retried up to `max_attempts` times with jittered exponential backoff,
+    after which the `sqlite3.OperationalError` is raised.
+    """
+    backoff = BOOKING_BACKOFF_SECONDS
+    for attempt in range(1, max_attempts + 1):
+        try:
+            outcome, creator_id = _try_book_wish(wish_id, presenter_id, presenter_name, db_path)
+            break
+        except sqlite3.OperationalError as e:
+            if not is_busy_error(e) or attempt == max_attempts:
+                if is_busy_error(e):
+                    metrics.BOOKING_BUSY_FAILURES.inc()
+                logger.error(f"Booking failed for wish with wish_id={wish_id} after {attempt} attempts: {e}")
+                raise
+            metrics.BOOKING_RETRIES.inc()
+            time.sleep(random.uniform(backoff / 2, backoff))
+            backoff = min(backoff * 2, BOOKING_MAX_BACKOFF_SECONDS)
 
-        cur.execute("COMMIT")
-        logger.info(f"Booked wish with wish_id={wish_id}")
-    except sql.Error:
-        logger.error(f"Booking failed for wish with wish_id={wish_id}")
-        cur.execute("ROLLBACK")
+    metrics.BOOKING_OUTCOMES.labels(outcome.value).inc()
+    if creator_id is not None:
+        after_commit(db_path,
+                     lambda: invalidate_wishes(db_path, (creator_id, False), (creator_id, True)))
+    logger.info(f"Booking of wish with wish_id={wish_id}: {outcome.value}")
+    return outcome
 
 
 def current_time_in_ms_since_1970() -> int:
     return int(time.time() * 1000)
 
 
-def create_tables_dict() -> Dict[Enum, Table]:
-    return {  # TODO make proper singletones
-        TableName.CREATOR: Creator().create_table(),
-        TableName.PRESENTER: Presenter().create_table(),
-        TableName.WISH: Wish().create_table(),
-        TableName.RELATION: Relation().create_table(),
-        TableName.BOOKED: Booked().create_table(),
-        TableName.PRESENTED: Presented().create_table(),
-    }
+# user id columns of every table and the username columns they were filled from
+USER_ID_COLUMNS: Dict[TableName, List[Tuple[str, str]]] = {
+    TableName.CREATOR: [("creator_id", "creator_name")],
+    TableName.PRESENTER: [("presenter_id", "presenter_name")],
+    TableName.WISH: [("creator_id", "creator_name")],
+    TableName.RELATION: [("creator_id", "creator_name"), ("presenter_id", "presenter_name")],
+    TableName.BOOKED: [("creator_id", "creator_name"), ("presenter_id", "presenter_name")],
+    TableName.PRESENTED: [("creator_id", "creator_name"), ("presenter_id", "presenter_name")],
+}
+
+
+def remember_user(user_id: int, username: Optional[str], db_path: str = DB_PATH) -> None:
+    """Points `username` at `user_id`, to be called whenever the user talks to the bot.
+
+    A placeholder id the name had is replaced by `user_id` in every table. A name the user no longer has is
+    forgotten, Telegram lets somebody else take it.
+    """
+    usernames = Username(db_path)
+    with db_ops(db_path) as cur:
+        previous_id = None
+        if username is not None:
+            row = cur.execute(f"SELECT user_id FROM {usernames.table_name} WHERE username = ?", [username]).fetchone()
+            previous_id = None if row is None else row[0]
+            if previous_id == user_id:
+                return
+        cur.execute(f"DELETE FROM {usernames.table_name} WHERE user_id = ?", [user_id])
+        if username is None:
+            return
+        if previous_id is not None and previous_id < 0:
+            for table, columns in USER_ID_COLUMNS.items():
+                for id_column, _ in columns:
+                    # a row the user already has under their id wins over the one of the placeholder
+                    cur.execute(f"UPDATE OR REPLACE {table.value} SET {id_column} = ? WHERE {id_column} = ?",
+                                [user_id, previous_id])
+            after_commit(db_path, lambda: invalidate_wishes(
+                db_path, *((creator_id, booked) for creator_id in (previous_id, user_id) for booked in (False, True))))
+            logger.info(f"User {username} claimed the wishes of placeholder id {previous_id}")
+        usernames.add(username, user_id)
+
+
+def add_user_ids(db_path: str = DB_PATH) -> None:
+    """Adds a user id column next to every username column, with the indexes reads move to, and gives every
+    username found in the tables a placeholder id. Safe to run again."""
+    with db_ops(db_path) as cur:
+        usernames = Username(db_path).create_table()
+        cur.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS username_user_id ON {usernames.table_name}(user_id)")
+        for table, columns in USER_ID_COLUMNS.items():
+            existing = {row[1] for row in cur.execute(f"PRAGMA table_info({table.value})")}
+            for id_column, _ in columns:
+                if id_column not in existing:
+                    cur.execute(f"ALTER TABLE {table.value} ADD COLUMN {id_column} INTEGER")
+
+        names = " UNION ".join(f"SELECT {name_column} AS name FROM {table.value}"
+                               for table, columns in USER_ID_COLUMNS.items() for _, name_column in columns)
+        cur.execute(
+            f"""
+            INSERT OR IGNORE INTO {usernames.table_name}
+            SELECT name, ? - row_number() OVER (ORDER BY name), 0 FROM ({names})
+            """, [usernames._last_placeholder_id(cur)])
+
+        cur.execute("DROP INDEX IF EXISTS wish_creator_booked_priority")
+        cur.execute(f"""CREATE INDEX IF NOT EXISTS wish_creator_id_booked_priority
+                        ON {TableName.WISH.value}(creator_id, booked, {PRIORITY_SORT_KEY})""")
+        cur.execute("DROP INDEX IF EXISTS booked_presenter_date")
+        cur.execute(f"""CREATE INDEX IF NOT EXISTS booked_presenter_id_date
+                        ON {TableName.BOOKED.value}(presenter_id, date, wish_id)""")
+        cur.execute("DROP INDEX IF EXISTS relation_presenter_creator")
+        cur.execute(f"""CREATE INDEX IF NOT EXISTS relation_presenter_id_creator_id
+                        ON {TableName.RELATION.value}(presenter_id, creator_id)""")
+        cur.execute(f"""CREATE INDEX IF NOT EXISTS relation_creator_id
+                        ON {TableName.RELATION.value}(creator_id)""")
+
+
+def backfill_user_ids(db_path: str = DB_PATH, batch_size: int = BACKFILL_BATCH_SIZE) -> None:
+    """Fills the user id columns of rows written before they existed, `batch_size` rows per transaction.
+
+    Rows are walked in rowid order, so every batch is a range scan and writers wait for one batch at most.
+    An interrupted run is started over, rows already filled are skipped.
+    """
+    usernames = TableName.USERNAME.value
+    for table, columns in USER_ID_COLUMNS.items():
+        assignments = ", ".join(
+            f"{id_column} = ifnull({id_column}, "
+            f"(SELECT user_id FROM {usernames} WHERE username = {table.value}.{name_column}))"
+            for id_column, name_column in columns)
+        missing = " OR ".join(f"{id_column} IS NULL" for id_column, _ in columns)
+        last_rowid = 0
+        filled = 0
+        while True:
+            with db_ops(db_path) as cur:
+                upper = cur.execute(
+                    f"SELECT max(rowid) FROM (SELECT rowid FROM {table.value} WHERE rowid > ? ORDER BY rowid LIMIT ?)",
+                    [last_rowid, batch_size]).fetchone()[0]
+                if upper is None:
+                    break
+                filled += cur.execute(
+                    f"UPDATE {table.value} SET {assignments} WHERE rowid > ? AND rowid <= ? AND ({missing})",
+                    [last_rowid, upper]).rowcount
+            last_rowid = upper
+        if filled:
+            logger.info(f"Filled the user ids of {filled} rows of {table.value}")
+
+
+def add_feed(db_path: str = DB_PATH) -> None:
+    """Creates the feed table with the triggers maintaining it and fills it. Safe to run again."""
+    wish, relation = TableName.WISH.value, TableName.RELATION.value
+    feed = Feed(db_path)
+    wish_rows = f"""INSERT OR IGNORE INTO {feed.table_name}
+                SELECT r.presenter_id, new.wish_id, new.creator_id FROM {relation} r
+                WHERE {FEED_VISIBILITY.format(wish="new", relation="r")} AND r.presenter_id IS NOT NULL;"""
+    relation_rows = f"""INSERT OR IGNORE INTO {feed.table_name}
+                SELECT new.presenter_id, w.wish_id, w.creator_id FROM {wish} w
+                WHERE {FEED_VISIBILITY.format(wish="w", relation="new")} AND new.presenter_id IS NOT NULL;"""
+    # relations left between the pair of a removed or changed relation
+    remaining_rows = f"""DELETE FROM {feed.table_name}
+                WHERE presenter_id = old.presenter_id AND creator_id = old.creator_id;
+            INSERT OR IGNORE INTO {feed.table_name}
+                SELECT r.presenter_id, w.wish_id, w.creator_id FROM {relation} r
+                JOIN {wish} w ON {FEED_VISIBILITY.format(wish="w", relation="r")}
+                WHERE r.presenter_id = old.presenter_id AND r.creator_id = old.creator_id;"""
+    with db_ops(db_path) as cur:
+        feed.create_table()
+        cur.execute(f"CREATE INDEX IF NOT EXISTS feed_wish_id ON {feed.table_name}(wish_id)")
+        for statement in [
+            f"""CREATE TRIGGER IF NOT EXISTS feed_wish_insert AFTER INSERT ON {wish} BEGIN
+                {wish_rows}
+            END""",
+            f"""CREATE TRIGGER IF NOT EXISTS feed_wish_update
+            AFTER UPDATE OF booked, relation_type, creator_id ON {wish} BEGIN
+                DELETE FROM {feed.table_name} WHERE wish_id = old.wish_id;
+                {wish_rows}
+            END""",
+            f"""CREATE TRIGGER IF NOT EXISTS feed_wish_delete AFTER DELETE ON {wish} BEGIN
+                DELETE FROM {feed.table_name} WHERE wish_id = old.wish_id;
+            END""",
+            f"""CREATE TRIGGER IF NOT EXISTS feed_relation_insert AFTER INSERT ON {relation} BEGIN
+                {relation_rows}
+            END""",
+            f"""CREATE TRIGGER IF NOT EXISTS feed_relation_update
+            AFTER UPDATE OF creator_id, presenter_id, relation_type ON {relation} BEGIN
+                {remaining_rows}
+                {relation_rows}
+            END""",
+            f"""CREATE TRIGGER IF NOT EXISTS feed_relation_delete AFTER DELETE ON {relation} BEGIN
+                {remaining_rows}
+            END""",
+        ]:
+            cur.execute(statement)
+        feed.rebuild()
+
+
+def add_price_amounts(db_path: str = DB_PATH) -> None:
+    """Adds the parsed price columns of wishes and the index of the price order. Safe to run again."""
+    with db_ops(db_path) as cur:
+        existing = {row[1] for row in cur.execute(f"PRAGMA table_info({TableName.WISH.value})")}
+        for column, column_type in [("price_amount", "REAL"), ("price_currency", "TEXT")]:
+            if column not in existing:
+                cur.execute(f"ALTER TABLE {TableName.WISH.value} ADD COLUMN {column} {column_type}")
+        # the currency is filtered on the rows of the scanned range, in the index it would break the wish_id order
+        cur.execute(f"""CREATE INDEX IF NOT EXISTS wish_creator_id_booked_price
+                        ON {TableName.WISH.value}(creator_id, booked, {PRICE_SORT_KEY})""")
+
+
+def backfill_prices(db_path: str = DB_PATH, batch_size: int = BACKFILL_BATCH_SIZE) -> None:
+    """Parses the prices of wishes stored before they were parsed on write, `batch_size` rows per transaction.
+
+    Like `backfill_user_ids`, walks the rows in rowid ranges, an interrupted run is started over.
+    """
+    last_rowid = 0
+    parsed = 0
+    while True:
+        with db_ops(db_path) as cur:
+            rows = list(cur.execute(
+                f"""
+                SELECT wish_id, price FROM {TableName.WISH.value}
+                WHERE wish_id > ? AND price IS NOT NULL AND price_amount IS NULL
+                ORDER BY wish_id LIMIT ?
+                """, [last_rowid, batch_size]))
+            if not rows:
+                break
+            updates = [(*parse_price(price), wish_id) for wish_id, price in rows]
+            cur.executemany(f"UPDATE {TableName.WISH.value} SET price_amount = ?, price_currency = ? WHERE wish_id = ?",
+                            [update for update in updates if update[0] is not None])
+            parsed += sum(1 for update in updates if update[0] is not None)
+        last_rowid = rows[-1][0]
+    if parsed:
+        logger.info(f"Parsed the prices of {parsed} wishes")
+    get_wish_cache(db_path).clear()
+
+
+def add_booking_archive(db_path: str = DB_PATH) -> None:
+    """Creates the archive of bookings. Safe to run again."""
+    with db_ops(db_path) as cur:
+        archive = BookedArchive(db_path).create_table()
+        cur.execute(f"""CREATE INDEX IF NOT EXISTS booked_archive_presenter_id_date
+                        ON {archive.table_name}(presenter_id, date)""")
+
+
+def add_photos(db_path: str = DB_PATH) -> None:
+    """Creates the table of photo variants and the photo column of wishes. Safe to run again."""
+    with db_ops(db_path) as cur:
+        Photo(db_path).create_table()
+        existing = {row[1] for row in cur.execute(f"PRAGMA table_info({TableName.WISH.value})")}
+        if "photo_unique_id" not in existing:
+            cur.execute(f"ALTER TABLE {TableName.WISH.value} ADD COLUMN photo_unique_id TEXT")
+
+
+def _keyed_by_user_id(cur: sqlite3.Cursor, table: TableName) -> bool:
+    # the id columns were added nullable, `create_table` makes them NOT NULL along with the keys on them
+    not_null = {row[1]: row[3] for row in cur.execute(f"PRAGMA table_info({table.value})")}
+    return all(not_null[id_column] for id_column, _ in USER_ID_COLUMNS[table])
+
+
+def _rebuild_table(cur: sqlite3.Cursor, table: TableName, db_path: str) -> None:
+    """Recreates `table` from its `create_table` definition and copies its rows over, keeping its indexes and its
+    AUTOINCREMENT counter. Rows conflicting on the new key are dropped."""
+    name = table.value
+    rebuilt = TABLE_CLASSES[table](db_path)
+    rebuilt.table_name = f"{name}_rebuilt"
+    rebuilt.create_table()
+    old_columns = {row[1] for row in cur.execute(f"PRAGMA table_info({name})")}
+    columns = ", ".join(f'"{row[1]}"' for row in cur.execute(f"PRAGMA table_info({rebuilt.table_name})")
+                        if row[1] in old_columns)
+    indexes = [sql for sql, in cur.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL", [name])]
+    sequence = cur.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", [name]).fetchone()
+
+    cur.execute(f"INSERT OR IGNORE INTO {rebuilt.table_name}({columns}) SELECT {columns} FROM {name}")
+    cur.execute(f"DROP TABLE {name}")
+    cur.execute(f"ALTER TABLE {rebuilt.table_name} RENAME TO {name}")
+    for sql in indexes:
+        cur.execute(sql)
+    if sequence is not None:
+        cur.execute("UPDATE sqlite_sequence SET seq = max(seq, ?) WHERE name = ?", [sequence[0], name])
+
+
+def key_users_by_id(db_path: str = DB_PATH) -> None:
+    """Rebuilds the tables of users and of what links them with their user ids as the keys and the targets of the
+    foreign keys, usernames staying as indexed attributes. Safe to run again, each table is rebuilt in one transaction.
+
+    Expects every id column to be filled by `backfill_user_ids`.
+    """
+    for table in USER_ID_COLUMNS:
+        with db_ops(db_path) as cur:
+            if _keyed_by_user_id(cur, table):
+                continue
+            # renaming a table checks every trigger, some of which read the table being rebuilt
+            triggers = list(cur.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger'"))
+            for trigger, _ in triggers:
+                cur.execute(f"DROP TRIGGER {trigger}")
+            _rebuild_table(cur, table, db_path)
+            for _, sql in triggers:
+                cur.execute(sql)
+        logger.info(f"Rebuilt {table.value} keyed by user id")
+    with db_ops(db_path) as cur:
+        cur.execute(f"CREATE INDEX IF NOT EXISTS creator_creator_name ON {TableName.CREATOR.value}(creator_name)")
+        cur.execute(f"""CREATE INDEX IF NOT EXISTS presenter_presenter_name
+                        ON {TableName.PRESENTER.value}(presenter_name)""")
+
+
+# triggers filling the change log, by name; the oldest entries are trimmed
+WISH_CHANGELOG_TRIGGERS: Dict[str, str] = {
+    "wish_changelog_insert": f"""AFTER INSERT ON {TableName.WISH.value} BEGIN
+        INSERT INTO {WISH_CHANGELOG_TABLE}(wish_id) VALUES (new.wish_id);
+    END""",
+    "wish_changelog_update": f"""AFTER UPDATE ON {TableName.WISH.value} BEGIN
+        INSERT INTO {WISH_CHANGELOG_TABLE}(wish_id) VALUES (new.wish_id);
+    END""",
+    "wish_changelog_delete": f"""AFTER DELETE ON {TableName.WISH.value} BEGIN
+        INSERT INTO {WISH_CHANGELOG_TABLE}(wish_id) VALUES (old.wish_id);
+    END""",
+    "wish_changelog_trim": f"""AFTER INSERT ON {WISH_CHANGELOG_TABLE} BEGIN
+        DELETE FROM {WISH_CHANGELOG_TABLE} WHERE seq <= new.seq - {WISH_CHANGELOG_SIZE};
+    END""",
+}
+
+
+def enable_wish_changelog(db_path: str = DB_PATH) -> None:
+    """Makes every write of a wish append its id to the change log. Safe to run again."""
+    with db_ops(db_path) as cur:
+        for name, trigger in WISH_CHANGELOG_TRIGGERS.items():
+            cur.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {trigger}")
+
+
+def disable_wish_changelog(db_path: str = DB_PATH) -> None:
+    """Stops logging the writes of wishes and empties the log, for files no snapshot reads."""
+    with db_ops(db_path) as cur:
+        for name in WISH_CHANGELOG_TRIGGERS:
+            cur.execute(f"DROP TRIGGER IF EXISTS {name}")
+        cur.execute(f"DELETE FROM {WISH_CHANGELOG_TABLE}")
+
+
+# Schema changes applied on top of the `create_table` definitions, in order.
+# After the migration at index `i` the database reports `PRAGMA user_version` = `i + 1`.
+# A migration is a list of statements run in one transaction, or a function of the database path running
+# its own transactions, which has to be safe to run again.
+MIGRATIONS: List[Union[List[str], Callable[[str], None]]] = [
+    # "See wishes": filter on creator and booked, sort by priority
+    [
+        f"""CREATE INDEX IF NOT EXISTS wish_creator_booked_priority
+            ON {TableName.WISH.value}(creator_name, booked, {PRIORITY_SORT_KEY})""",
+    ],
+    # bookings of a presenter, bookings by age
+    [
+        f"""CREATE INDEX IF NOT EXISTS booked_presenter_date
+            ON {TableName.BOOKED.value}(presenter_name, date, wish_id)""",
+        f"""CREATE INDEX IF NOT EXISTS booked_date
+            ON {TableName.BOOKED.value}(date)""",
+    ],
+    # full-text search over names and descriptions, restricted to related creators
+    [
+        f"""CREATE VIRTUAL TABLE IF NOT EXISTS {WISH_FTS_TABLE} USING fts5(
+            name, "desc",
+            content='{TableName.WISH.value}', content_rowid='wish_id', tokenize='unicode61 remove_diacritics 2'
+        )""",
+        f"""CREATE TRIGGER IF NOT EXISTS wish_fts_insert AFTER INSERT ON {TableName.WISH.value} BEGIN
+            INSERT INTO {WISH_FTS_TABLE}(rowid, name, "desc") VALUES (new.wish_id, new.name, new."desc");
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS wish_fts_delete AFTER DELETE ON {TableName.WISH.value} BEGIN
+            INSERT INTO {WISH_FTS_TABLE}({WISH_FTS_TABLE}, rowid, name, "desc")
+                VALUES ('delete', old.wish_id, old.name, old."desc");
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS wish_fts_update AFTER UPDATE OF name, "desc" ON {TableName.WISH.value} BEGIN
+            INSERT INTO {WISH_FTS_TABLE}({WISH_FTS_TABLE}, rowid, name, "desc")
+                VALUES ('delete', old.wish_id, old.name, old."desc");
+            INSERT INTO {WISH_FTS_TABLE}(rowid, name, "desc") VALUES (new.wish_id, new.name, new."desc");
+        END""",
+        # a match in the name counts four times as much as one in the description
+        f"INSERT INTO {WISH_FTS_TABLE}({WISH_FTS_TABLE}, rank) VALUES ('rank', 'bm25(4.0, 1.0)')",
+        f"INSERT INTO {WISH_FTS_TABLE}({WISH_FTS_TABLE}) VALUES ('rebuild')",
+        f"""CREATE INDEX IF NOT EXISTS relation_presenter_creator
+            ON {TableName.RELATION.value}(presenter_name, creator_name)""",
+    ],
+    # users are keyed by their Telegram id, usernames are resolved through the username table
+    add_user_ids,
+    backfill_user_ids,
+    # wishes of everyone a presenter is related to, maintained on write
+    add_feed,
+    # prices as an amount and a currency, for filtering and sorting by price
+    add_price_amounts,
+    backfill_prices,
+    # bookings that are presented, cancelled or old move out of the booked table
+    add_booking_archive,
+    # variants of photos by file_unique_id, lists are sent small ones
+    add_photos,
+    # ids of the wishes changed, in order, for in-memory snapshots to catch up with, see `enable_wish_changelog`
+    [
+        f"""CREATE TABLE IF NOT EXISTS {WISH_CHANGELOG_TABLE}
+            (seq INTEGER PRIMARY KEY AUTOINCREMENT, wish_id INTEGER NOT NULL)""",
+    ],
+    # user ids replace usernames as the keys the tables are joined on
+    key_users_by_id,
+]
+
+
+def schema_version(db_path: str = DB_PATH) -> int:
+    with db_ops(db_path, readonly=True) as cur:
+        return cur.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(db_path: str = DB_PATH) -> int:
+    """Applies pending migrations, each in its own transaction, and returns the resulting schema version."""
+    version = schema_version(db_path)
+    for version in range(version, len(MIGRATIONS)):
+        if callable(MIGRATIONS[version]):
+            MIGRATIONS[version](db_path)
+        with db_ops(db_path) as cur:
+            if not callable(MIGRATIONS[version]):
+                for statement in MIGRATIONS[version]:
+                    cur.execute(statement)
+            cur.execute(f"PRAGMA user_version = {version + 1}")
+        logger.info(f"Migrated {db_path} to schema version {version + 1}")
+    return schema_version(db_path)
+
+
+def explain_query_plan(query: str, params: List, db_path: str = DB_PATH) -> List[str]:
+    with db_ops(db_path, readonly=True) as cur:
+        # EXPLAIN does not check for schema changes, reading the schema table picks up indexes added meanwhile
+        cur.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+        return [row[3] for row in cur.execute(f"EXPLAIN QUERY PLAN {query}", params)]
+
+
+TABLE_CLASSES: Dict[TableName, type] = {
+    TableName.CREATOR: Creator,
+    TableName.PRESENTER: Presenter,
+    TableName.WISH: Wish,
+    TableName.RELATION: Relation,
+    TableName.BOOKED: Booked,
+    TableName.PRESENTED: Presented,
+    TableName.USERNAME: Username,
+    TableName.FEED: Feed,
+    TableName.BOOKED_ARCHIVE: BookedArchive,
+    TableName.PHOTO: Photo,
+}
+
+
+def bootstrap(db_path: str = DB_PATH) -> int:
+    """Brings `db_path` to the current schema and returns its version.
+
+    A database already at the current version costs a single `PRAGMA user_version` read. A fresh one gets every
+    table and migration in one transaction. One created before migrations existed gets the tables it lacks and then
+    every migration like an older version does, so that backfills commit batch by batch.
+    """
+    version = schema_version(db_path)
+    if version == len(MIGRATIONS):
+        return version
+    if version > 0:
+        return migrate(db_path)
+    with db_ops(db_path, readonly=True) as cur:
+        has_tables = cur.execute(
+            "SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'").fetchone()[0]
+    if has_tables:
+        with db_ops(db_path):
+            for table_class in TABLE_CLASSES.values():
+                table_class(db_path).create_table()
+        return migrate(db_path)
+    with db_ops(db_path) as cur:
+        # the nested `db_ops` of `create_table` join this transaction
+        for table_class in TABLE_CLASSES.values():
+            table_class(db_path).create_table()
+        for migration in MIGRATIONS:
+            if callable(migration):
+                migration(db_path)
+                continue
+            for statement in migration:
+                cur.execute(statement)
+        cur.execute(f"PRAGMA user_version = {len(MIGRATIONS)}")
+    logger.info(f"Created {db_path} at schema version {len(MIGRATIONS)}")
+    return len(MIGRATIONS)
+
+
+def create_tables_dict(db_path: str = DB_PATH) -> Dict[Enum, Table]:
+    bootstrap(db_path)
+    return {name: table_class(db_path) for name, table_class in TABLE_CLASSES.items()}
@@ -1,27 +1,48 @@
-# TODO make tests correctly automatic without using actual db
-from db import Wish, db_ops, DB_PATH, Booked, book_wish, TableName
+import sqlite3
+from threading import Thread, Timer
 
+import pytest
 
-def print_db(table_name: TableName) -> None:
-    with db_ops(DB_PATH) as cur:
+import db
+import metrics
+from db import Wish, db_ops, Booked, book_wish, TableName, configure_pool, get_pool, migrate, MIGRATIONS, \
+    explain_query_plan, schema_version, get_wish_cache, wish_cursor, bootstrap, \
+    create_tables_dict, BookingOutcome, TABLE_CLASSES, USER_ID_COLUMNS, Username, add_user_ids, backfill_user_ids, \
+    remember_user, key_users_by_id, add_price_amounts, add_photos
+from wishdata import WishData
+
+# the schema before migrations existed
+SCHEMA_BEFORE_MIGRATIONS = """
+    CREATE TABLE creator (creator_name TEXT NOT NULL PRIMARY KEY);
+    CREATE TABLE presenter (presenter_name TEXT NOT NULL PRIMARY KEY);
+    CREATE TABLE wish (wish_id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, booked BOOLEAN NOT NULL,
+        presented BOOLEAN NOT NULL, creator_name TEXT NOT NULL, name TEXT NOT NULL, priority INTEGER,
+        relation_type TEXT, link TEXT, price REAL, photo_id TEXT, desc TEXT, quantity INTEGER);
+    CREATE TABLE relation (relation_id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, creator_name TEXT NOT NULL,
+        presenter_name TEXT NOT NULL, relation_type TEXT);
+    CREATE TABLE booked (wish_id INT NOT NULL, creator_name TEXT NOT NULL, presenter_name TEXT NOT NULL,
+        date INT NOT NULL, PRIMARY KEY(wish_id, presenter_name));
+    CREATE TABLE presented (wish_id INT NOT NULL, creator_name TEXT NOT NULL, presenter_name TEXT NOT NULL,
+        date INT NOT NULL, PRIMARY KEY(wish_id, presenter_name));
+"""
+
+
+def print_db(db_path: str, table_name: TableName) -> None:
+    with db_ops(db_path) as cur:
         rows = list(cur.execute(f"SELECT * FROM {table_name.value}"))
         print(rows)
 
 
-def test_wish() -> None:
-    wish = Wish()
-    wish.delete()
-    wish.create_table()
-
-    booked = Booked()
-    booked.delete()
-    booked.create_table()
+def test_wish(tmp_path) -> None:
+    db_path = str(tmp_path / "wish.db")
+    wish = Wish(db_path).create_table()
+    booked = Booked(db_path).create_table()
 
-    wish.add(creator_name="10", name="bla", priority=5)
-    wish.add(creator_name="10", name="noprio")
-    wish.add(creator_name="11", name="test", quantity=5)
-    wish.add(creator_name="10", name="TEST", priority=1, quantity=10)
-    with db_ops(DB_PATH) as cur:
+    wish.add(creator_id=10, creator_name="10", name="bla", priority=5)
+    wish.add(creator_id=10, creator_name="10", name="noprio")
+    wish.add(creator_id=11, creator_name="11", name="test", quantity=5)
+    wish.add(creator_id=10, creator_name="10", name="TEST", priority=1, quantity=10)
+    with db_ops(db_path) as cur:
         rows = list(cur.execute(f"SELECT name, quantity FROM {wish.table_name}"))
         print(rows)
 
@@ -29,30 +50,315 @@ def test_wish() -> None:
     assert rows[2] == ("test", 5)
     assert rows[3] == ("TEST", 10)
 
-    print(wish.search_by_creator_and_booked_value("10"))
-    assert [wish[0] for wish in wish.search_by_creator_and_booked_value("10")] == [4, 1, 2]
+    print(wish.search_by_creator_and_booked_value(10))
+    assert [wish[0] for wish in wish.search_by_creator_and_booked_value(10)] == [4, 1, 2]
 
-    book_wish(wish_id=1, presenter_name="PRESENTER")
-    book_wish(wish_id=2, presenter_name="PRESENTER2")
-    print_db(TableName.WISH)
-    print_db(TableName.BOOKED)
+    book_wish(wish_id=1, presenter_id=1, presenter_name="PRESENTER", db_path=db_path)
+    book_wish(wish_id=2, presenter_id=2, presenter_name="PRESENTER2", db_path=db_path)
+    print_db(db_path, TableName.WISH)
+    print_db(db_path, TableName.BOOKED)
 
 
-def test_booked() -> None:
-    booked = Booked()
-    booked.delete()
-    booked.create_table()
+def test_booked(tmp_path, monkeypatch) -> None:
+    db_path = str(tmp_path / "booked.db")
+    booked = Booked(db_path).create_table()
+    # dates are in milliseconds, the clock moves on between the two bookings
+    clock = iter([1_700_000_000_000, 1_700_000_000_001])
+    monkeypatch.setattr(db, "current_time_in_ms_since_1970", lambda: next(clock))
 
-    booked.add(1, 2, 3)
-    booked.add(2, 5, 3)
-    with db_ops(DB_PATH) as cur:
-        rows = list(cur.execute(f"SELECT creator_id, date FROM {booked.table_name}"))
+    booked.add(1, "1", 2, "2", 3)
+    booked.add(2, "2", 5, "5", 3)
+    with db_ops(db_path) as cur:
+        rows = list(cur.execute(f"SELECT creator_name, date FROM {booked.table_name} ORDER BY rowid"))
         print(rows)
 
         # check delay of adding
         assert rows[0][1] != rows[1][1]
 
 
+def test_pool_shared_between_threads(tmp_path) -> None:
+    db_path = str(tmp_path / "pool.db")
+    configure_pool(db_path, readers=2)
+    wish = Wish(db_path).create_table()
+
+    def add_and_read(creator_id: int) -> None:
+        for i in range(50):
+            wish.add(creator_id=creator_id, creator_name=str(creator_id), name=f"wish {i}", priority=i)
+            wish.search_by_creator_and_booked_value(creator_id)
+
+    threads = [Thread(target=add_and_read, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert all(len(wish.search_by_creator_and_booked_value(i)) == 50 for i in range(8))
+    assert get_pool(db_path).max_readers == 2
+    with db_ops(db_path) as cur:
+        assert list(cur.execute(f"SELECT count(*) FROM {wish.table_name}")) == [(400,)]
+
+
+def test_db_ops_rolls_back_on_error(tmp_path) -> None:
+    db_path = str(tmp_path / "rollback.db")
+    wish = Wish(db_path).create_table()
+    try:
+        with db_ops(db_path) as cur:
+            cur.execute(f"INSERT INTO {wish.table_name} VALUES (null, 0, 0, 'a', 'b', null, null, null, null, null, null, null, 1, null, null, null)")
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    assert wish.search_by_creator_and_booked_value(1) == []
+
+
+def test_migrations_add_indexes_for_hot_queries(tmp_path) -> None:
+    db_path = str(tmp_path / "migrations.db")
+    for table_class in TABLE_CLASSES.values():
+        table_class(db_path).create_table()
+    wish = Wish(db_path)
+    booked = Booked(db_path)
+
+    assert schema_version(db_path) == 0
+    assert migrate(db_path) == len(MIGRATIONS)
+    assert migrate(db_path) == len(MIGRATIONS)
+
+    plan = explain_query_plan(wish.search_by_creator_and_booked_value_query(), [10, 0], db_path)
+    assert any("USING INDEX wish_creator_id_booked_priority" in step for step in plan)
+    assert not any("TEMP B-TREE" in step for step in plan)
+
+    plan = explain_query_plan(
+        f"SELECT wish_id, date FROM {booked.table_name} WHERE presenter_id = ? ORDER BY date DESC", [10], db_path
+    )
+    assert any("USING COVERING INDEX booked_presenter_id_date" in step for step in plan)
+    assert not any("TEMP B-TREE" in step for step in plan)
+
+
+def test_bootstrap_creates_schema_once(tmp_path) -> None:
+    db_path = str(tmp_path / "bootstrap.db")
+    assert bootstrap(db_path) == len(MIGRATIONS)
+    with db_ops(db_path, readonly=True) as cur:
+        tables = {row[0] for row in cur.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert {name.value for name in TableName} <= tables
+
+    statements = []
+    with get_pool(db_path).writer() as conn:
+        conn.set_trace_callback(statements.append)
+    assert bootstrap(db_path) == len(MIGRATIONS)
+    assert statements == []
+
+
+def test_wish_lists_cache_is_invalidated_by_writes(tmp_path) -> None:
+    db_path = str(tmp_path / "cache.db")
+    wish = Wish(db_path).create_table()
+    Booked(db_path).create_table()
+    cache = get_wish_cache(db_path)
+
+    wish.add(creator_id=10, creator_name="10", name="bike")
+    assert [w.name for w in wish.search_wishes(10)] == ["bike"]
+    assert [w.name for w in wish.search_wishes(10)] == ["bike"]
+    assert cache.stats().hits == 1
+
+    wish.add(creator_id=10, creator_name="10", name="car", priority=1)
+    assert [w.name for w in wish.search_wishes(10)] == ["car", "bike"]
+    assert wish.search_wishes(10, booked_value_needed=True) == []
+
+    book_wish(wish_id=1, presenter_id=20, presenter_name="20", db_path=db_path)
+    assert [w.name for w in wish.search_wishes(10)] == ["car"]
+    assert [w.name for w in wish.search_wishes(10, booked_value_needed=True)] == ["bike"]
+
+    wish.change_booked(wish_id=1, booked_value_to_set=False)
+    assert [w.name for w in wish.search_wishes(10)] == ["car", "bike"]
+    assert wish.search_wishes(10, booked_value_needed=True) == []
+
+    wish.add(creator_id=11, creator_name="11", name="unrelated")
+    assert [w.name for w in wish.search_wishes(10)] == ["car", "bike"]
+    assert cache.stats().hits == 2
+
+
+def test_pages_of_a_list_are_cached_until_it_is_written(tmp_path) -> None:
+    db_path = str(tmp_path / "page_cache.db")
+    wish = Wish(db_path).create_table()
+    Booked(db_path).create_table()
+    for i in range(3):
+        wish.add(creator_id=10, creator_name="10", name=f"wish {i}", priority=i)
+    first = wish.search_wishes_page(10, limit=2)
+    after = wish_cursor(first[-1])
+    assert [w.name for w in wish.search_wishes_page(10, limit=2, after=after)] == ["wish 2"]
+
+    misses = get_wish_cache(db_path).stats().misses
+    assert wish.search_wishes_page(10, limit=2) == first
+    assert [w.name for w in wish.search_wishes_page(10, limit=2, after=after)] == ["wish 2"]
+    assert get_wish_cache(db_path).stats().misses == misses
+
+    wish.add(creator_id=10, creator_name="10", name="wish 3", priority=3)
+    assert [w.name for w in wish.search_wishes_page(10, limit=2, after=after)] == ["wish 2", "wish 3"]
+    book_wish(wish_id=3, presenter_id=20, presenter_name="20", db_path=db_path)
+    assert [w.name for w in wish.search_wishes_page(10, limit=2, after=after)] == ["wish 3"]
+    assert [w.name for w in wish.search_wishes_page(10, booked_value_needed=True)] == ["wish 2"]
+
+
+def test_search_page_walks_the_list_in_order(tmp_path) -> None:
+    db_path = str(tmp_path / "pages.db")
+    wish = Wish(db_path).create_table()
+    for i, priority in enumerate([3, None, 1, 3, None, 2, 1]):
+        wish.add(creator_id=10, creator_name="10", name=f"wish {i}", priority=priority)
+    expected = [row[0] for row in wish.search_by_creator_and_booked_value(10)]
+
+    pages = [[WishData.from_tuple(row) for row in wish.search_page(10, limit=3)]]
+    while len(pages[-1]) == 3:
+        pages.append([WishData.from_tuple(row)
+                      for row in wish.search_page(10, limit=3, after=wish_cursor(pages[-1][-1]))])
+    assert [w.wish_id for page in pages for w in page] == expected
+
+    previous = wish.search_page(10, limit=3, before=wish_cursor(pages[1][0]))
+    assert [row[0] for row in previous] == [w.wish_id for w in pages[0]]
+
+
+def test_bootstrap_upgrades_a_database_from_before_migrations_in_steps(tmp_path) -> None:
+    db_path = str(tmp_path / "unversioned.db")
+    conn = sqlite3.connect(db_path)
+    conn.executescript(SCHEMA_BEFORE_MIGRATIONS)
+    conn.executemany("INSERT INTO wish(booked, presented, creator_name, name, price) VALUES (0, 0, 'alice', ?, ?)",
+                     [(f"wish {i}", "10 EUR") for i in range(30)])
+    conn.execute("DELETE FROM wish WHERE wish_id = 30")
+    conn.commit()
+    conn.close()
+
+    statements = []
+    with get_pool(db_path).writer() as conn:
+        conn.set_trace_callback(statements.append)
+    assert bootstrap(db_path) == len(MIGRATIONS)
+    with get_pool(db_path).writer() as conn:
+        conn.set_trace_callback(None)
+    # one transaction for the missing tables, then at least one per migration
+    assert statements.count("COMMIT") > len(MIGRATIONS)
+
+    alice = Username(db_path).resolve("alice")
+    wishes = Wish(db_path).search_wishes(alice)
+    assert len(wishes) == 29
+    with db_ops(db_path, readonly=True) as cur:
+        assert list(cur.execute("SELECT DISTINCT price_amount, price_currency FROM wish")) == [(10.0, "EUR")]
+        assert [row[1] for row in cur.execute("PRAGMA table_info(booked)") if row[5]] == ["wish_id", "presenter_id"]
+
+    # the rebuilt table keeps its AUTOINCREMENT counter and the triggers indexing it
+    Wish(db_path).add(creator_id=alice, creator_name="alice", name="kite")
+    with db_ops(db_path, readonly=True) as cur:
+        assert list(cur.execute("SELECT rowid FROM wish_fts WHERE wish_fts MATCH 'kite'")) == [(31,)]
+
+
+def test_book_wish_outcomes_under_concurrency(tmp_path) -> None:
+    db_path = str(tmp_path / "booking.db")
+    create_tables_dict(db_path)
+    wish = Wish(db_path)
+    wish.add(creator_id=10, creator_name="10", name="bike")
+
+    outcomes = []
+    threads = [Thread(target=lambda i=i: outcomes.append(book_wish(1, i, f"presenter{i}", db_path))) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(outcome.value for outcome in outcomes) == ["already_booked"] * 7 + ["booked"]
+    assert book_wish(2, 20, "presenter", db_path) == BookingOutcome.MISSING
+    with db_ops(db_path, readonly=True) as cur:
+        assert list(cur.execute("SELECT count(*) FROM booked WHERE wish_id = 1")) == [(1,)]
+
+
+def test_book_wish_retries_while_another_process_writes(tmp_path) -> None:
+    db_path = str(tmp_path / "busy.db")
+    configure_pool(db_path, busy_timeout=0.01)
+    create_tables_dict(db_path)
+    Wish(db_path).add(creator_id=10, creator_name="10", name="bike")
+    retries = metrics.BOOKING_RETRIES.labels().value()
+
+    other = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+    other.execute("BEGIN IMMEDIATE")
+    releaser = Timer(0.05, other.execute, ["COMMIT"])
+    releaser.start()
+    assert book_wish(1, 20, "presenter", db_path, max_attempts=20) == BookingOutcome.BOOKED
+    releaser.join()
+    assert metrics.BOOKING_RETRIES.labels().value() > retries
+
+    other.execute("BEGIN IMMEDIATE")
+    with pytest.raises(sqlite3.OperationalError):
+        book_wish(1, 20, "presenter", db_path, max_attempts=2)
+    other.execute("ROLLBACK")
+    other.close()
+
+
+def test_existing_rows_are_keyed_by_user_id_in_batches(tmp_path) -> None:
+    db_path = str(tmp_path / "user_ids.db")
+    with db_ops(db_path) as cur:
+        for statement in SCHEMA_BEFORE_MIGRATIONS.split(";"):
+            cur.execute(statement)
+        cur.executemany("INSERT INTO wish(booked, presented, creator_name, name) VALUES (0, 0, ?, ?)",
+                        [("alice", f"wish {i}") for i in range(25)] + [("bob", "car")])
+        cur.execute("INSERT INTO booked(wish_id, creator_name, presenter_name, date) VALUES (26, 'bob', 'alice', 1)")
+
+    statements = []
+    add_user_ids(db_path)
+    # the wish columns added after user ids, read by `search_wishes`
+    add_price_amounts(db_path)
+    add_photos(db_path)
+    with get_pool(db_path).writer() as conn:
+        conn.set_trace_callback(statements.append)
+    backfill_user_ids(db_path, batch_size=10)
+    with get_pool(db_path).writer() as conn:
+        conn.set_trace_callback(None)
+    assert statements.count("COMMIT") >= 3
+
+    usernames = Username(db_path)
+    alice, bob = usernames.resolve("alice"), usernames.resolve("bob")
+    assert alice < 0 and bob < 0 and alice != bob
+    wish = Wish(db_path)
+    assert len(wish.search_wishes(alice)) == 25
+    with db_ops(db_path, readonly=True) as cur:
+        assert list(cur.execute("SELECT creator_id, presenter_id FROM booked")) == [(bob, alice)]
+
+    remember_user(7, "Alice", db_path)
+    assert usernames.resolve("alice") == 7
+    assert len(wish.search_wishes(7)) == 25
+    assert wish.search_wishes(alice) == []
+    with db_ops(db_path, readonly=True) as cur:
+        assert list(cur.execute("SELECT creator_id, presenter_id FROM booked")) == [(bob, 7)]
+
+    remember_user(7, "alice_renamed", db_path)
+    assert usernames.resolve("alice") is None
+    assert usernames.resolve("alice_renamed") == 7
+
+
+def test_user_tables_are_rebuilt_keyed_by_user_id(tmp_path) -> None:
+    db_path = str(tmp_path / "keys.db")
+    with db_ops(db_path) as cur:
+        for statement in SCHEMA_BEFORE_MIGRATIONS.split(";"):
+            cur.execute(statement)
+        cur.execute("INSERT INTO creator VALUES ('bob')")
+        cur.execute("INSERT INTO wish(booked, presented, creator_name, name) VALUES (1, 0, 'bob', 'car')")
+        cur.execute("INSERT INTO booked VALUES (1, 'bob', 'alice', 1)")
+        cur.execute("CREATE INDEX booked_date ON booked(date)")
+    add_user_ids(db_path)
+    backfill_user_ids(db_path)
+    bob = Username(db_path).resolve("bob")
+
+    key_users_by_id(db_path)
+    key_users_by_id(db_path)
+    with db_ops(db_path, readonly=True) as cur:
+        keys = {table: [row[1] for row in cur.execute(f"PRAGMA table_info({table.value})") if row[5]]
+                for table in USER_ID_COLUMNS}
+        assert list(cur.execute("SELECT creator_name, creator_id FROM creator")) == [("bob", bob)]
+        assert list(cur.execute("SELECT name FROM sqlite_master WHERE tbl_name = 'booked' AND sql IS NOT NULL "
+                                "AND type = 'index' ORDER BY name")) == [("booked_date",),
+                                                                         ("booked_presenter_id_date",)]
+    assert keys[TableName.CREATOR] == ["creator_id"]
+    assert keys[TableName.BOOKED] == keys[TableName.PRESENTED] == ["wish_id", "presenter_id"]
+
+    # a user booking under their id and a name they just claimed keeps one booking of the wish
+    Booked(db_path).add(creator_id=bob, creator_name="bob", presenter_id=7, presenter_name="alice7", wish_id=1)
+    remember_user(7, "alice", db_path)
+    with db_ops(db_path, readonly=True) as cur:
+        assert list(cur.execute("SELECT wish_id, presenter_id FROM booked")) == [(1, 7)]
+
+
 if __name__ == "__main__":
     test_wish()
     # test_booked()
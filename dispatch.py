@@ -0,0 +1,63 @@
+"""Dispatches Telegram updates to an application, keeping the updates of every user in order."""
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Any, Dict, Optional
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_CONCURRENCY = 64
+# updates without a sender, e.g. polls, all get this user id
+NO_USER = 0
+
+
+def update_user_id(payload: Dict[str, Any]) -> int:
+    """Id of the user who caused the update `payload`, as received from the Bot API."""
+    for value in payload.values():
+        if isinstance(value, dict):
+            user = value.get("from") or value.get("user")
+            if user is not None:
+                return user["id"]
+    return NO_USER
+
+
+class UserOrderedDispatcher:
+    """Processes the updates of different users concurrently and those of one user in arrival order."""
+
+    def __init__(self, application, max_concurrency: int = DEFAULT_MAX_CONCURRENCY):
+        self.application = application
+        self.handled = 0
+        self._slots = asyncio.Semaphore(max_concurrency)
+        # last update of every user still being processed
+        self._tails: Dict[int, asyncio.Task] = dict()
+
+    async def dispatch(self, user_id: int, update: Update) -> asyncio.Task:
+        """Waits for a free slot and starts processing `update` after the previous update of `user_id`.
+
+        Returns the task processing it.
+        """
+        await self._slots.acquire()
+        task = asyncio.create_task(self._process(self._tails.get(user_id), update))
+        self._tails[user_id] = task
+        task.add_done_callback(lambda done: self._done(user_id, done))
+        return task
+
+    async def _process(self, previous: Optional[asyncio.Task], update: Update) -> None:
+        if previous is not None:
+            await asyncio.wait([previous])
+        await self.application.process_update(update)
+
+    def _done(self, user_id: int, task: asyncio.Task) -> None:
+        self._slots.release()
+        self.handled += 1
+        if self._tails.get(user_id) is task:
+            del self._tails[user_id]
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Update processing failed", exc_info=task.exception())
+
+    async def join(self) -> None:
+        while self._tails:
+            await asyncio.wait(list(self._tails.values()))
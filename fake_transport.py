@@ -0,0 +1,187 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import time
+from dataclasses import dataclass
+from itertools import count
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple, TypeVar
+
+from telegram.request import BaseRequest, RequestData
+
+BOT_ID = 1
+BOT_USERNAME = "wishlist_test_bot"
+
+T = TypeVar("T")
+
+
+@dataclass
+class ApiCall:
+    method: str
+    parameters: Dict[str, Any]
+    at: float
+
+
+class FakeRequest(BaseRequest):
+    """Offline stand-in for the Bot API HTTP transport.
+
+    Answers every request with a plausible result after `latency` seconds and records it in `calls`.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: List[ApiCall] = []
+        # contents of the files the bot can download, by file_id
+        self.files: Dict[str, bytes] = dict()
+        self._message_ids = count(1)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self,
+                         url: str,
+                         method: str,
+                         request_data: Optional[RequestData] = None,
+                         read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE,
+                         connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE,
+                         ) -> Tuple[int, bytes]:
+        if "/file/bot" in url:
+            file_id = url.rsplit("/", 1)[-1]
+            self.calls.append(ApiCall(method="downloadFile", parameters={"file_id": file_id}, at=time.monotonic()))
+            return 200, self.files[file_id]
+        api_method = url.rsplit("/", 1)[-1]
+        parameters = request_data.parameters if request_data is not None else dict()
+        self.calls.append(ApiCall(method=api_method, parameters=parameters, at=time.monotonic()))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        result = self._result(api_method, parameters)
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    def calls_of(self, method: str) -> List[ApiCall]:
+        return [call for call in self.calls if call.method == method]
+
+    def _message(self, parameters: Dict[str, Any], **content) -> Dict[str, Any]:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(parameters.get("chat_id", 0)), "type": "private"},
+            "from": {"id": BOT_ID, "is_bot": True, "first_name": "Wishlist", "username": BOT_USERNAME},
+            **content,
+        }
+
+    def _photo(self, file_id: str) -> List[Dict[str, Any]]:
+        return [{"file_id": file_id, "file_unique_id": f"unique-{file_id}", "width": 90, "height": 90}]
+
+    def _result(self, api_method: str, parameters: Dict[str, Any]) -> Any:
+        if api_method == "getMe":
+            return {"id": BOT_ID, "is_bot": True, "first_name": "Wishlist", "username": BOT_USERNAME}
+        if api_method in ("sendMessage", "editMessageText"):
+            return self._message(parameters, text=parameters.get("text", ""))
+        if api_method == "sendPhoto":
+            return self._message(parameters, photo=self._photo(str(parameters.get("photo"))))
+        if api_method == "sendMediaGroup":
+            return [self._message(parameters, photo=self._photo(str(media["media"])))
+                    for media in parameters["media"]]
+        if api_method == "getFile":
+            file_id = parameters["file_id"]
+            file_path = f"documents/{file_id}" if file_id in self.files else f"photos/{file_id}.jpg"
+            return {"file_id": file_id, "file_unique_id": f"unique-{file_id}", "file_path": file_path}
+        if api_method == "getUpdates":
+            return []
+        return True
+
+
+def make_user(user_id: int) -> Dict[str, Any]:
+    return {"id": user_id, "is_bot": False, "first_name": f"User {user_id}", "username": f"user{user_id}"}
+
+
+class UpdateFactory:
+    """Builds Bot API `Update` payloads as they would arrive from Telegram."""
+
+    def __init__(self):
+        self._update_ids = count(1)
+        self._message_ids = count(1)
+
+    def message(self,
+                user_id: int,
+                text: Optional[str] = None,
+                photo: Optional[str] = None,
+                document: Optional[Tuple[str, str]] = None,
+                ) -> Dict[str, Any]:
+        """A message with `text`, a `photo` file id or a `document` given as `(file_id, file_name)`."""
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": make_user(user_id),
+        }
+        if text is not None:
+            message["text"] = text
+            if text.startswith("/"):
+                command = text.split()[0]
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        if photo is not None:
+            # the variants Telegram makes of a square photo, the largest one last
+            message["photo"] = [
+                {"file_id": f"{photo}-{side}", "file_unique_id": f"{photo}-u{side}", "width": side, "height": side,
+                 "file_size": side * side // 10}
+                for side in (90, 320, 800)
+            ] + [{"file_id": photo, "file_unique_id": f"{photo}-u", "width": 1280, "height": 1280,
+                  "file_size": 1280 * 1280 // 10}]
+        if document is not None:
+            file_id, file_name = document
+            message["document"] = {"file_id": file_id, "file_unique_id": f"{file_id}-u", "file_name": file_name}
+        return {"update_id": next(self._update_ids), "message": message}
+
+    def callback_query(self, user_id: int, data: str, message_id: int = 1) -> Dict[str, Any]:
+        return {
+            "update_id": next(self._update_ids),
+            "callback_query": {
+                "id": str(next(self._update_ids)),
+                "from": make_user(user_id),
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": {
+                    "message_id": message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "text": "page",
+                },
+            },
+        }
+
+
+def run_bot(monkeypatch,
+            db_path: str,
+            request: FakeRequest,
+            payloads: Iterable[Dict[str, Any]] = (),
+            during: Optional[Callable[[Any], Awaitable[T]]] = None,
+            ) -> Optional[T]:
+    """Runs the bot of `main` on the database at `db_path` and `request`, processing `payloads` one by one.
+
+    `during(application)` is awaited after the updates, before the bot shuts down, and its result is returned.
+    """
+    # main wants its token in the environment on import, which is up to the test module
+    import main
+    from repository import WishRepository
+
+    monkeypatch.setattr(main, "repository", WishRepository(db_path))
+
+    async def scenario() -> Optional[T]:
+        application = main.build_application("123:test", request=request)
+        await application.initialize()
+        await application.post_init(application)
+        try:
+            for payload in payloads:
+                await application.process_update(main.Update.de_json(payload, application.bot))
+            return await during(application) if during is not None else None
+        finally:
+            await application.post_shutdown(application)
+            await application.shutdown()
+
+    return asyncio.run(scenario())
@@ -0,0 +1,74 @@
+import os
+
+os.environ.setdefault("WISHLIST_BOT_TOKEN", "123:test")
+
+import main
+from db import Feed, Relation, RelationType, Wish, book_wish, create_tables_dict, db_ops, explain_query_plan, \
+    remember_user
+from fake_transport import FakeRequest, UpdateFactory, run_bot
+
+
+def feed_rows(db_path: str):
+    with db_ops(db_path, readonly=True) as cur:
+        return sorted(cur.execute("SELECT presenter_id, wish_id, creator_id FROM feed"))
+
+
+def test_feed_follows_wishes_bookings_and_relations(tmp_path) -> None:
+    db_path = str(tmp_path / "feed.db")
+    create_tables_dict(db_path)
+    wish, relation, feed = Wish(db_path), Relation(db_path), Feed(db_path)
+    wish.add(creator_id=2, creator_name="user2", name="bike")
+    relation.add(2, "user2", 1, "user1", RelationType.FRIEND)
+    relation.add(2, "user2", 3, "user3", RelationType.FAMILY)
+    wish.add(creator_id=2, creator_name="user2", name="ring", relation_type=RelationType.FAMILY.value)
+    wish.add(creator_id=4, creator_name="user4", name="unrelated")
+
+    assert [row[4] for row in feed.page(1)] == ["bike"]
+    assert [row[4] for row in feed.page(3)] == ["ring", "bike"]
+
+    book_wish(1, 3, "user3", db_path)
+    assert [row[4] for row in feed.page(1)] == []
+    assert [row[4] for row in feed.page(3)] == ["ring"]
+
+    relation.replace(2, "user2", 1, "user1", RelationType.FAMILY)
+    assert [row[4] for row in feed.page(1)] == ["ring"]
+    assert relation.remove(2, 3)
+    assert feed.page(3) == []
+
+    rows = feed_rows(db_path)
+    feed.rebuild()
+    assert feed_rows(db_path) == rows
+
+    plan = explain_query_plan(
+        "SELECT wish_id FROM feed WHERE presenter_id = ? AND wish_id < ? ORDER BY wish_id DESC", [1, 10], db_path
+    )
+    assert any("USING PRIMARY KEY" in step for step in plan)
+    assert not any("TEMP B-TREE" in step for step in plan)
+
+
+def test_follow_and_feed_commands(tmp_path, monkeypatch) -> None:
+    db_path = str(tmp_path / "feed_command.db")
+    create_tables_dict(db_path)
+    wish = Wish(db_path)
+    for i in range(12):
+        wish.add(creator_id=2, creator_name="user2", name=f"wish {i}")
+    remember_user(2, "user2", db_path)
+    request = FakeRequest()
+    updates = UpdateFactory()
+
+    run_bot(monkeypatch, db_path, request,
+            [updates.message(1, "/feed"), updates.message(1, "/follow @nobody"),
+             updates.message(1, "/follow @user2"), updates.message(1, "/feed"),
+             updates.callback_query(1, main.NEXT_FEED_PAGE), updates.message(1, "/unfollow @user2"),
+             updates.message(1, "/feed")])
+
+    texts = [call.parameters["text"] for call in request.calls_of("sendMessage")]
+    assert texts[0].startswith("Your feed is empty")
+    assert texts[1].startswith("nobody was not found")
+    assert texts[2].startswith("You now follow user2")
+    assert texts[3].count("*Wish \\#") == 10
+    assert texts[3].index("wish 11") < texts[3].index("wish 10") and texts[3].endswith("wish 2")
+    second_page = request.calls_of("editMessageText")[0].parameters["text"]
+    assert "*Wish \\#11* of user2" in second_page and "wish 0" in second_page
+    assert texts[4] == "You no longer follow user2"
+    assert texts[5].startswith("Your feed is empty")
@@ -0,0 +1,216 @@
+"""Replays synthetic conversations through the bot's ConversationHandler, fully offline.
+
+Example: `python loadtest.py --users 2000 --seed 1 --json loadtest.json`
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import os
+import random
+import statistics
+import tempfile
+import time
+from collections import defaultdict
+from dataclasses import dataclass, asdict
+from typing import Callable, Dict, List, Optional
+
+os.environ.setdefault("WISHLIST_BOT_TOKEN", "123:loadtest")
+
+import main
+from db import Wish, create_tables_dict, remember_user
+from fake_transport import FakeRequest, UpdateFactory
+from repository import WishRepository
+from sender import OutboundScheduler
+from telegram import Update
+from telegram.ext import Application, ConversationHandler
+
+
+@dataclass
+class HandlerReport:
+    handler: str
+    calls: int
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+
+
+@dataclass
+class LoadTestReport:
+    users: int
+    updates: int
+    seconds: float
+    updates_per_second: float
+    handlers: List[HandlerReport]
+
+
+def percentiles_ms(samples: List[float]) -> List[float]:
+    if len(samples) == 1:
+        return [samples[0] * 1000] * 3
+    cuts = statistics.quantiles(samples, n=100)
+    return [cuts[49] * 1000, cuts[94] * 1000, cuts[98] * 1000]
+
+
+def instrument(application: Application, timings: Dict[str, List[float]]) -> None:
+    """Wraps every ConversationHandler callback to record its latency under the callback's name."""
+
+    def timed(callback: Callable) -> Callable:
+        samples = timings[callback.__name__]
+
+        @functools.wraps(callback)
+        async def wrapper(update, context):
+            started = time.perf_counter()
+            try:
+                return await callback(update, context)
+            finally:
+                samples.append(time.perf_counter() - started)
+
+        return wrapper
+
+    for handlers in application.handlers.values():
+        for conversation in handlers:
+            if not isinstance(conversation, ConversationHandler):
+                continue
+            nested = [conversation.entry_points, conversation.fallbacks, *conversation.states.values()]
+            for handler in (handler for group in nested for handler in group):
+                handler.callback = timed(handler.callback)
+
+
+def make_a_wish_script(updates: UpdateFactory, user_id: int, rng: random.Random) -> List[dict]:
+    script = [updates.message(user_id, "/start"),
+              updates.message(user_id, "Make a wish"),
+              updates.message(user_id, f"wish {rng.randrange(10 ** 6)}")]
+    if rng.random() < 0.5:
+        script.append(updates.message(user_id, photo=f"photo-{user_id}"))
+    else:
+        script.append(updates.message(user_id, "/skip"))
+    script += [updates.message(user_id, str(rng.randrange(1, 500))),
+               updates.message(user_id, "something nice"),
+               updates.message(user_id, "Confirm"),
+               updates.message(user_id, "/cancel")]
+    return script
+
+
+def see_and_book_script(updates: UpdateFactory, user_id: int, creator_id: int, rng: random.Random) -> List[dict]:
+    return [updates.message(user_id, "/start"),
+            updates.message(user_id, "See wishes"),
+            updates.message(user_id, f"@user{creator_id}"),
+            updates.callback_query(user_id, main.NEXT_PAGE),
+            updates.message(user_id, str(rng.randrange(1, 4))),
+            updates.message(user_id, "/cancel")]
+
+
+def seed_database(db_path: str, creators: int, wishes_per_creator: int, rng: random.Random) -> None:
+    """Creates the schema and the wishlists of `user0` to `user<creators - 1>`."""
+    create_tables_dict(db_path)
+    wishes = Wish(db_path)
+    for creator_id in range(creators):
+        for i in range(wishes_per_creator):
+            wishes.add(creator_id=creator_id,
+                       creator_name=f"user{creator_id}",
+                       name=f"seeded wish {i}",
+                       priority=rng.choice([None, 1, 2, 3]))
+        remember_user(creator_id, f"user{creator_id}", db_path)
+
+
+def make_scripts(users: int, see_ratio: float, creators: int, rng: random.Random) -> List[List[dict]]:
+    """The updates sent by each of `users` users, who either make a wish or book one."""
+    updates = UpdateFactory()
+    scripts = []
+    for user_id in range(1000, 1000 + users):
+        if rng.random() < see_ratio:
+            scripts.append(see_and_book_script(updates, user_id, rng.randrange(creators), rng))
+        else:
+            scripts.append(make_a_wish_script(updates, user_id, rng))
+    return scripts
+
+
+async def run_load_test(users: int,
+                        seed: int = 0,
+                        see_ratio: float = 0.5,
+                        creators: int = 50,
+                        wishes_per_creator: int = 15,
+                        api_latency: float = 0.0,
+                        db_path: Optional[str] = None,
+                        ) -> LoadTestReport:
+    rng = random.Random(seed)
+    if db_path is None:
+        db_path = os.path.join(tempfile.mkdtemp(prefix="wishlist-loadtest-"), "wishlist.db")
+    seed_database(db_path, creators, wishes_per_creator, rng)
+    main.repository = WishRepository(db_path)
+    main.init_state_stores("memory")
+
+    request = FakeRequest(latency=api_latency)
+    application = main.build_application("123:loadtest", request=request)
+    # every synthetic user talks at once, none of them is to be shed
+    main.admission.high_watermark = users + 1
+    timings: Dict[str, List[float]] = defaultdict(list)
+    instrument(application, timings)
+    await application.initialize()
+    # replies are not rate limited against the fake transport
+    main.outbox = OutboundScheduler(application.bot, global_rate=10 ** 6, chat_rate=10 ** 6, chat_burst=10 ** 6)
+    main.outbox.start()
+
+    scripts = make_scripts(users, see_ratio, creators, rng)
+
+    async def converse(script: List[dict]) -> None:
+        for payload in script:
+            await application.process_update(Update.de_json(payload, application.bot))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(converse(script) for script in scripts))
+    elapsed = time.perf_counter() - started
+
+    await main.outbox.stop()
+    await application.shutdown()
+    main.repository.shutdown()
+
+    handlers = [HandlerReport(name, len(samples), *percentiles_ms(samples))
+                for name, samples in sorted(timings.items()) if samples]
+    total_updates = sum(len(script) for script in scripts)
+    return LoadTestReport(users=users,
+                          updates=total_updates,
+                          seconds=elapsed,
+                          updates_per_second=total_updates / elapsed,
+                          handlers=handlers)
+
+
+def print_report(report: LoadTestReport) -> None:
+    print(f"{report.users} users, {report.updates} updates in {report.seconds:.2f}s "
+          f"({report.updates_per_second:.0f} updates/s)")
+    print(f"{'handler':<24}{'calls':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for handler in report.handlers:
+        print(f"{handler.handler:<24}{handler.calls:>8}{handler.p50_ms:>10.2f}{handler.p95_ms:>10.2f}"
+              f"{handler.p99_ms:>10.2f}")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--see-ratio", type=float, default=0.5, help="share of users browsing instead of wishing")
+    parser.add_argument("--creators", type=int, default=50)
+    parser.add_argument("--wishes-per-creator", type=int, default=15)
+    parser.add_argument("--api-latency", type=float, default=0.0, help="seconds per fake Bot API call")
+    parser.add_argument("--db", help="database file, a temporary one by default")
+    parser.add_argument("--json", help="also write the report to this file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    report = asyncio.run(run_load_test(users=args.users,
+                                       seed=args.seed,
+                                       see_ratio=args.see_ratio,
+                                       creators=args.creators,
+                                       wishes_per_creator=args.wishes_per_creator,
+                                       api_latency=args.api_latency,
+                                       db_path=args.db))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(asdict(report), f, indent=2)
@@ -0,0 +1,13 @@
+import asyncio
+
+from loadtest import run_load_test
+
+
+def test_load_test_replays_every_flow(tmp_path) -> None:
+    report = asyncio.run(run_load_test(users=40, seed=3, creators=5, db_path=str(tmp_path / "load.db")))
+
+    calls = {handler.handler: handler.calls for handler in report.handlers}
+    assert calls["start"] == 40
+    assert calls["see_wishes"] + calls["new_wish_confirmation"] == 40
+    assert calls["book_wish_handler"] == calls["see_wishes"]
+    assert report.updates_per_second > 0
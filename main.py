@@ -1,20 +1,40 @@
+import asyncio
+import csv
+import io
 import logging
 import os
 import sqlite3
-from typing import Dict
+import time
+from typing import Dict, Optional, Tuple
 
-from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, Update
-from telegram.ext import ApplicationBuilder
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove, \
+    Update, User
+from telegram.ext import Application, ApplicationBuilder
 from telegram.ext import (
+    CallbackQueryHandler,
     CommandHandler,
     ContextTypes,
     ConversationHandler,
     MessageHandler,
+    TypeHandler,
     filters,
 )
 
-from db import create_tables_dict, TableName, book_wish
-from wishdata import WishData
+from telegram.request import BaseRequest
+
+import cluster
+import metrics
+from admission import AdmissionController
+from db import configure_pool, configure_snapshot, get_wish_cache, BookingOutcome, DB_PATH, READER_POOL_SIZE, \
+    PAGE_SIZE, RelationType, BookingCursor, WishCursor, wish_cursor
+from metrics import MetricsServer, DEFAULT_METRICS_LISTEN
+from repository import WishRepository
+from sender import CHAT_BURST, CHAT_RATE, GLOBAL_RATE, OutboundScheduler
+from state_store import StateStore, make_state_store
+from transfer import TransferFormat
+from webhook import WebhookServer, DEFAULT_LISTEN, DEFAULT_PORT, DEFAULT_PATH, DEFAULT_MAX_CONCURRENCY
+from wishdata import BookingsPage, FeedPage, PhotoVariant, SearchPage, WishData, WishOrder, WishPage, \
+    escape_markdown_v2, parse_price
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -22,16 +42,71 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-WISHLIST_BOT_TOKEN = os.environ["WISHLIST_BOT_TOKEN"]
+# "polling", "webhook" or "cluster"
+BOT_MODE = os.environ.get("WISHLIST_BOT_MODE", "polling")
+WEBHOOK_LISTEN = os.environ.get("WISHLIST_WEBHOOK_LISTEN", DEFAULT_LISTEN)
+WEBHOOK_PORT = int(os.environ.get("WISHLIST_WEBHOOK_PORT", DEFAULT_PORT))
+WEBHOOK_PATH = os.environ.get("WISHLIST_WEBHOOK_PATH", DEFAULT_PATH)
+# public URL Telegram should post to, the webhook is not registered if unset
+WEBHOOK_URL = os.environ.get("WISHLIST_WEBHOOK_URL")
+WEBHOOK_SECRET = os.environ.get("WISHLIST_WEBHOOK_SECRET")
+WEBHOOK_MAX_CONCURRENCY = int(os.environ.get("WISHLIST_WEBHOOK_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY))
+# Prometheus text endpoint, disabled if no port is set
+METRICS_LISTEN = os.environ.get("WISHLIST_METRICS_LISTEN", DEFAULT_METRICS_LISTEN)
+METRICS_PORT = os.environ.get("WISHLIST_METRICS_PORT")
+# comma separated Telegram user ids allowed to use /stats
+ADMIN_IDS = [int(user_id) for user_id in os.environ.get("WISHLIST_ADMIN_IDS", "").split(",") if user_id.strip()]
 ROLE_CHOICE, MAKE_A_WISH, SEE_WISHES_FOR_USER, NEW_WISH_NAME_REQUEST, NEW_WISH_PHOTO_REQUEST, \
 NEW_WISH_PRICE_REQUEST, EDIT_WISH, ADD_NAME, ADD_PHOTO, NEW_WISH_DESC_REQUEST, NEW_WISH_CONFIRMATION, \
-BACK_TO_MAIN, WHOSE_LIST, BOOK_WISH = range(14)
-
-wish_dict: Dict[int, WishData] = dict()
-target_user_to_list_of_his_wishes: Dict[str, Dict[int, int]] = dict()
-asked_user: Dict[str, str] = dict()
-
-tables = create_tables_dict()
+BACK_TO_MAIN, WHOSE_LIST, BOOK_WISH, IMPORT_WISHLIST, SEARCH_RESULTS, FEED, MY_BOOKINGS = range(18)
+# the Bot API does not let bots download larger files
+MAX_IMPORT_FILE_SIZE = 20 * 1024 * 1024
+
+STATE_BACKEND = os.environ.get("WISHLIST_STATE_BACKEND", "memory")
+DRAFT_TTL_SECONDS = 24 * 60 * 60
+BROWSING_TTL_SECONDS = 60 * 60
+
+# created by `init_state_stores` on startup
+wish_dict: Optional[StateStore[int, WishData]] = None
+# by viewer, the number a wish was shown with to its id
+viewed_wish_numbers: Optional[StateStore[int, Dict[int, int]]] = None
+asked_user: Optional[StateStore[int, int]] = None
+viewed_page: Optional[StateStore[int, WishPage]] = None
+viewed_search: Optional[StateStore[int, SearchPage]] = None
+viewed_feed: Optional[StateStore[int, FeedPage]] = None
+viewed_bookings: Optional[StateStore[int, BookingsPage]] = None
+state_stores: Dict[str, StateStore] = dict()
+
+PREVIOUS_PAGE = "wishes_page:previous"
+NEXT_PAGE = "wishes_page:next"
+PREVIOUS_SEARCH_PAGE = "search_page:previous"
+NEXT_SEARCH_PAGE = "search_page:next"
+PREVIOUS_FEED_PAGE = "feed_page:previous"
+NEXT_FEED_PAGE = "feed_page:next"
+PREVIOUS_BOOKINGS_PAGE = "bookings_page:previous"
+NEXT_BOOKINGS_PAGE = "bookings_page:next"
+# how often presented, cancelled and old bookings are moved to the archive
+BOOKING_ARCHIVE_INTERVAL_SECONDS = 60 * 60
+
+DB_READERS = int(os.environ.get("WISHLIST_DB_READERS", READER_POOL_SIZE))
+# seconds wish lists read from an in-memory snapshot may lag behind other processes, read from the file if unset
+SNAPSHOT_STALENESS = os.environ.get("WISHLIST_SNAPSHOT_STALENESS")
+# reply limits of this process, the workers of a cluster split the global one
+OUTBOX_GLOBAL_RATE = GLOBAL_RATE
+OUTBOX_CHAT_RATE = CHAT_RATE
+OUTBOX_CHAT_BURST = CHAT_BURST
+# (updates per second, burst) of one user in the states whose updates query the wish table
+ADMISSION_STATE_LIMITS = {SEE_WISHES_FOR_USER: (0.2, 3.0), BOOK_WISH: (0.5, 5.0)}
+ADMISSION_HIGH_WATERMARK = int(os.environ.get("WISHLIST_ADMISSION_HIGH_WATERMARK", 256))
+SLOW_DOWN_TEXT = "Slow down please, try again in a few seconds"
+
+# the database is opened on startup, unless a repository was set beforehand
+repository: Optional[WishRepository] = None
+outbox: Optional[OutboundScheduler] = None
+archiver: Optional[asyncio.Task] = None
+# created by `build_application`
+admission: Optional[AdmissionController] = None
+metrics_server: Optional[MetricsServer] = None
 
 skip_keyboard = [["Skip"]]
 back_main_keyboard = [["Back to main menu"]]
@@ -39,11 +114,40 @@ skip_markup = ReplyKeyboardMarkup(skip_keyboard, one_time_keyboard=True)
 back_markup = ReplyKeyboardMarkup(back_main_keyboard, one_time_keyboard=True)
 
 
+def display_name(user: User) -> str:
+    """Name stored next to the user's id, the username unless they have none."""
+    return user.username or user.full_name
+
+
+def reply_text(update: Update, text: str, **kwargs) -> asyncio.Future:
+    return outbox.send_message(update.effective_chat.id, text, **kwargs)
+
+
+def reply_photo(update: Update, photo: str, **kwargs) -> asyncio.Future:
+    return outbox.send_photo(update.effective_chat.id, photo, **kwargs)
+
+
+async def slow_down(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Reply to an update refused by the admission control."""
+    if update.callback_query is not None:
+        await update.callback_query.answer(SLOW_DOWN_TEXT)
+    elif update.effective_chat is not None:
+        reply_text(update, SLOW_DOWN_TEXT)
+
+
+async def remember_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Keeps the username index current, runs before the conversation handlers for every update."""
+    user = update.effective_user
+    if user is not None:
+        await repository.remember_user(user.id, user.username)
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Starts the conversation and asks the user about their choice."""
-    reply_keyboard = [["Make a wish", "See wishes", "Edit wishes"]]
+    reply_keyboard = [["Make a wish", "See wishes", "Edit wishes"], ["My bookings"]]
 
-    await update.message.reply_text(
+    reply_text(
+        update,
         "Hi! Would you like to add/edit your own wish or to see your friend's wish?\n\n",
         reply_markup=ReplyKeyboardMarkup(
             reply_keyboard, one_time_keyboard=True, input_field_placeholder="Wish or search?"
@@ -60,18 +164,25 @@ async def role_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     choice = update.message.text
 
     if choice == "Make a wish":
-        await update.message.reply_text(
+        reply_text(
+            update,
             f"What do you wish?",
         )
-        wish_dict[user.id] = WishData(creator_name=user.username, booked=False, presented=False)
+        wish_dict[user.id] = WishData(creator_id=user.id, creator_name=display_name(user), booked=False,
+                                      presented=False)
         return NEW_WISH_NAME_REQUEST
     elif choice == "See wishes":
-        await update.message.reply_text(
-            "Please type a target username",
+        reply_text(
+            update,
+            "Please type a target username, optionally followed by \"by price\" or \"under\" a price, "
+            "e.g. \"@alice under 50 EUR\"",
         )
         return SEE_WISHES_FOR_USER
+    elif choice == "My bookings":
+        return await my_bookings(update, context)
     elif choice == "Edit wishes":
-        await update.message.reply_text(
+        reply_text(
+            update,
             "TODO edit wishes...",
         )
         return EDIT_WISH
@@ -80,52 +191,477 @@ async def role_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
         return ConversationHandler.END
 
 
+def parse_wishes_request(text: str) -> Tuple[str, WishOrder, Optional[float], Optional[str]]:
+    """Username, order, price limit and currency of "@alice", "@alice by price" or "@alice under 50 EUR"."""
+    username, _, options = text.strip().partition(" ")
+    options = options.strip().lower()
+    max_price, currency = None, None
+    if "under" in options:
+        max_price, currency = parse_price(options.split("under", 1)[1])
+    wish_order = WishOrder.PRICE if max_price is not None or "price" in options else WishOrder.PRIORITY
+    return username.lstrip("@"), wish_order, max_price, currency
+
+
+async def load_wishes_page(target_id: int,
+                           target_user: str,
+                           number: int,
+                           after: Optional[WishCursor] = None,
+                           before: Optional[WishCursor] = None,
+                           wish_order: WishOrder = WishOrder.PRIORITY,
+                           max_price: Optional[float] = None,
+                           currency: Optional[str] = None,
+                           ) -> WishPage:
+    if before is not None:
+        wishes = await repository.search_page(creator_id=target_id, before=before, wish_order=wish_order,
+                                              max_price=max_price, currency=currency)
+        has_next = True
+    else:
+        wishes = await repository.search_page(creator_id=target_id, limit=PAGE_SIZE + 1, after=after,
+                                              wish_order=wish_order, max_price=max_price, currency=currency)
+        has_next = len(wishes) > PAGE_SIZE
+        wishes = wishes[:PAGE_SIZE]
+    return WishPage(creator_id=target_id,
+                    creator_name=target_user,
+                    number=number,
+                    first_number=number * PAGE_SIZE + 1,
+                    wishes=wishes,
+                    has_next=has_next,
+                    order=wish_order,
+                    max_price=max_price,
+                    currency=currency)
+
+
+def remember_page(user_id: int, page: WishPage) -> None:
+    asked_user[user_id] = page.creator_id
+    viewed_page[user_id] = page
+    wish_numbers = viewed_wish_numbers.get(user_id, dict())
+    wish_numbers.update({number: wish.wish_id for number, wish in page.numbered()})
+    viewed_wish_numbers[user_id] = wish_numbers
+
+
+def render_wishes_page(page: WishPage) -> str:
+    title = f"Wishes of {page.creator_name}"
+    if page.max_price is not None:
+        title += f" under {page.max_price:g}" + (f" {page.currency}" if page.currency is not None else "")
+    if page.order == WishOrder.PRICE:
+        title += ", cheapest first"
+    parts = [f"*{escape_markdown_v2(title)}*"]
+    parts += [f"*Wish \#{number}*\n{wish}" for number, wish in page.numbered()]
+    return "\n\n".join(parts)
+
+
+def wishes_page_markup(page: WishPage) -> Optional[InlineKeyboardMarkup]:
+    buttons = []
+    if page.has_previous:
+        buttons.append(InlineKeyboardButton("« Previous", callback_data=PREVIOUS_PAGE))
+    if page.has_next:
+        buttons.append(InlineKeyboardButton("Next »", callback_data=NEXT_PAGE))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+async def send_page_photos(update: Update, page: WishPage) -> None:
+    """Sends a thumbnail of every photo of `page`, the stored photo if it has no variants known."""
+    thumbnails = await repository.photo_thumbnails(wish.photo_unique_id for wish in page.wishes
+                                                   if wish.photo_unique_id is not None)
+    # consecutive photos are coalesced into a media group by the outbox
+    for number, wish in page.numbered():
+        if wish.photo_id is not None:
+            reply_photo(update,
+                        photo=thumbnails.get(wish.photo_unique_id, wish.photo_id),
+                        caption=f"*Wish* \#{number}",
+                        parse_mode="MarkdownV2")
+
+
 async def see_wishes(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.message.from_user
-    target_user = update.message.text.strip("@")
+    target_user, wish_order, max_price, currency = parse_wishes_request(update.message.text)
     logger.info(f"User {user.name} requested a list of wishes for {target_user}")
-    dbresult = tables[TableName.WISH].search_by_creator_and_booked_value(creator_name=target_user)
-    res = [WishData.from_tuple(single_result) for single_result in dbresult]
+    target_id = await repository.resolve_username(target_user)
+    if target_id is None:
+        reply_text(update, text="User's wishes were not found, please try again")
+        return SEE_WISHES_FOR_USER
+    page = await load_wishes_page(target_id, target_user, number=0, wish_order=wish_order, max_price=max_price,
+                                  currency=currency)
 
-    target_user_to_list_of_his_wishes[target_user] = {i + 1: wish.wish_id for i, wish in enumerate(res)}
-    asked_user[user.username] = target_user
+    viewed_wish_numbers[user.id] = dict()
+    remember_page(user.id, page)
+
+    if not page.wishes:
+        reply_text(update, text="User's wishes were not found, please try again")
+        return SEE_WISHES_FOR_USER
 
-    if not res:
-        await update.message.reply_text(text="User's wishes were not found, please try again")
+    reply_text(update,
+               text=render_wishes_page(page),
+               parse_mode="MarkdownV2",
+               reply_markup=wishes_page_markup(page))
+    await send_page_photos(update, page)
+    reply_text(update,
+               text=f"Would you like to book a wish? Just send the number or /cancel",
+               reply_markup=ReplyKeyboardRemove())
+    return BOOK_WISH
+
+
+async def turn_wishes_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    user = query.from_user
+    page = viewed_page.get(user.id)
+    if page is None:
+        return BOOK_WISH
+
+    if query.data == NEXT_PAGE and page.has_next and page.wishes:
+        page = await load_wishes_page(page.creator_id, page.creator_name, page.number + 1,
+                                      after=wish_cursor(page.wishes[-1], page.order), wish_order=page.order,
+                                      max_price=page.max_price, currency=page.currency)
+    elif query.data == PREVIOUS_PAGE and page.has_previous and page.wishes:
+        page = await load_wishes_page(page.creator_id, page.creator_name, page.number - 1,
+                                      before=wish_cursor(page.wishes[0], page.order), wish_order=page.order,
+                                      max_price=page.max_price, currency=page.currency)
     else:
-        await update.message.reply_text(text=f"Showing wishes for {target_user}")
-        for i, result in enumerate(res):
-            if result.photo_id is None:
-                await update.message.reply_text(text=f"*Wish \#{i + 1}\n\n*{result}", parse_mode="MarkdownV2")
-            else:
-                await update.message.reply_photo(photo=result.photo_id, caption=f"*Wish* \#{i + 1}\n\n{result}",
-                                                 parse_mode="MarkdownV2")
-        await update.message.reply_text(text=f"Would you like to book a wish? Just send the number or /cancel",
-                                        reply_markup=ReplyKeyboardRemove())
-    if res:
         return BOOK_WISH
+    logger.info(f"User {user.name} opened page {page.number + 1} of {page.creator_name}'s wishes")
+
+    remember_page(user.id, page)
+    outbox.enqueue(query.message.chat_id,
+                   "edit_message_text",
+                   message_id=query.message.message_id,
+                   text=render_wishes_page(page),
+                   parse_mode="MarkdownV2",
+                   reply_markup=wishes_page_markup(page))
+    await send_page_photos(update, page)
+    return BOOK_WISH
+
+
+async def load_search_page(user_id: int, terms: str, number: int) -> SearchPage:
+    wishes = await repository.search_text(user_id, terms, limit=PAGE_SIZE + 1, offset=number * PAGE_SIZE)
+    return SearchPage(terms=terms,
+                      number=number,
+                      first_number=number * PAGE_SIZE + 1,
+                      wishes=wishes[:PAGE_SIZE],
+                      has_next=len(wishes) > PAGE_SIZE)
+
+
+def render_search_page(page: SearchPage) -> str:
+    parts = [f"*Wishes matching {escape_markdown_v2(page.terms)}*"]
+    parts += [f"*Wish \\#{number}* of {escape_markdown_v2(wish.creator_name)}\n{wish}"
+              for number, wish in page.numbered()]
+    return "\n\n".join(parts)
+
+
+def search_page_markup(page: SearchPage) -> Optional[InlineKeyboardMarkup]:
+    buttons = []
+    if page.has_previous:
+        buttons.append(InlineKeyboardButton("« Previous", callback_data=PREVIOUS_SEARCH_PAGE))
+    if page.has_next:
+        buttons.append(InlineKeyboardButton("Next »", callback_data=NEXT_SEARCH_PAGE))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+async def search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """`/search <terms>`: wishes of the user's relations matching the terms."""
+    user = update.message.from_user
+    terms = " ".join(context.args or [])
+    if not terms:
+        reply_text(update, "Please add what you are looking for, e.g. /search bike")
+        return ConversationHandler.END
+    logger.info(f"User {user.name} searched for {terms}")
+    page = await load_search_page(user.id, terms, number=0)
+    if not page.wishes:
+        reply_text(update, "Nothing found in your friends' wishlists")
+        return ConversationHandler.END
+
+    viewed_search[user.id] = page
+    reply_text(update,
+               text=render_search_page(page),
+               parse_mode="MarkdownV2",
+               reply_markup=search_page_markup(page))
+    return SEARCH_RESULTS
+
+
+async def turn_search_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    user = query.from_user
+    page = viewed_search.get(user.id)
+    if page is None:
+        return SEARCH_RESULTS
+
+    if query.data == NEXT_SEARCH_PAGE and page.has_next:
+        page = await load_search_page(user.id, page.terms, page.number + 1)
+    elif query.data == PREVIOUS_SEARCH_PAGE and page.has_previous:
+        page = await load_search_page(user.id, page.terms, page.number - 1)
     else:
-        return SEE_WISHES_FOR_USER
+        return SEARCH_RESULTS
+
+    viewed_search[user.id] = page
+    outbox.enqueue(query.message.chat_id,
+                   "edit_message_text",
+                   message_id=query.message.message_id,
+                   text=render_search_page(page),
+                   parse_mode="MarkdownV2",
+                   reply_markup=search_page_markup(page))
+    return SEARCH_RESULTS
+
+
+async def load_feed_page(user_id: int,
+                         number: int,
+                         older_than: Optional[int] = None,
+                         newer_than: Optional[int] = None,
+                         ) -> FeedPage:
+    if newer_than is not None:
+        wishes = await repository.feed_page(user_id, newer_than=newer_than)
+        has_next = True
+    else:
+        wishes = await repository.feed_page(user_id, limit=PAGE_SIZE + 1, older_than=older_than)
+        has_next = len(wishes) > PAGE_SIZE
+        wishes = wishes[:PAGE_SIZE]
+    return FeedPage(number=number,
+                    first_number=number * PAGE_SIZE + 1,
+                    wishes=wishes,
+                    has_next=has_next)
+
+
+def render_feed_page(page: FeedPage) -> str:
+    parts = ["*Newest wishes of the people you follow*"]
+    parts += [f"*Wish \\#{number}* of {escape_markdown_v2(wish.creator_name)}\n{wish}"
+              for number, wish in page.numbered()]
+    return "\n\n".join(parts)
+
+
+def feed_page_markup(page: FeedPage) -> Optional[InlineKeyboardMarkup]:
+    buttons = []
+    if page.has_previous:
+        buttons.append(InlineKeyboardButton("« Newer", callback_data=PREVIOUS_FEED_PAGE))
+    if page.has_next:
+        buttons.append(InlineKeyboardButton("Older »", callback_data=NEXT_FEED_PAGE))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+async def feed(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """`/feed`: unbooked wishes of everyone the user follows, newest first."""
+    user = update.message.from_user
+    page = await load_feed_page(user.id, number=0)
+    if not page.wishes:
+        reply_text(update, "Your feed is empty, follow your friends with /follow @username")
+        return ConversationHandler.END
+
+    viewed_feed[user.id] = page
+    reply_text(update,
+               text=render_feed_page(page),
+               parse_mode="MarkdownV2",
+               reply_markup=feed_page_markup(page))
+    return FEED
+
+
+async def turn_feed_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    user = query.from_user
+    page = viewed_feed.get(user.id)
+    if page is None:
+        return FEED
+
+    if query.data == NEXT_FEED_PAGE and page.has_next and page.wishes:
+        page = await load_feed_page(user.id, page.number + 1, older_than=page.wishes[-1].wish_id)
+    elif query.data == PREVIOUS_FEED_PAGE and page.has_previous and page.wishes:
+        page = await load_feed_page(user.id, page.number - 1, newer_than=page.wishes[0].wish_id)
+    else:
+        return FEED
+
+    viewed_feed[user.id] = page
+    outbox.enqueue(query.message.chat_id,
+                   "edit_message_text",
+                   message_id=query.message.message_id,
+                   text=render_feed_page(page),
+                   parse_mode="MarkdownV2",
+                   reply_markup=feed_page_markup(page))
+    return FEED
+
+
+async def follow(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """`/follow @username [friend|family]`: adds the user's wishes to the feed."""
+    user = update.message.from_user
+    args = context.args or []
+    try:
+        relation_type = RelationType(args[1].lower()) if len(args) > 1 else RelationType.FRIEND
+    except ValueError:
+        relation_type = None
+    if not args or len(args) > 2 or relation_type is None:
+        reply_text(update, "Please name who to follow and optionally how you know them, e.g. /follow @alice family")
+        return ConversationHandler.END
+
+    target_user = args[0].lstrip("@")
+    target_id = await repository.resolve_username(target_user)
+    if target_id is None:
+        reply_text(update, f"{target_user} was not found, they have to start a chat with me first")
+        return ConversationHandler.END
+    if target_id == user.id:
+        reply_text(update, "Your own wishes are not part of your feed")
+        return ConversationHandler.END
+    await repository.follow(target_id, target_user, user.id, display_name(user), relation_type)
+    logger.info(f"User {user.name} follows {target_user} as {relation_type.value}")
+    reply_text(update, f"You now follow {target_user}, their new wishes show up in your /feed")
+    return ConversationHandler.END
+
+
+async def unfollow(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """`/unfollow @username`"""
+    user = update.message.from_user
+    args = context.args or []
+    if len(args) != 1:
+        reply_text(update, "Please name who to unfollow, e.g. /unfollow @alice")
+        return ConversationHandler.END
+
+    target_user = args[0].lstrip("@")
+    target_id = await repository.resolve_username(target_user)
+    if target_id is None or not await repository.unfollow(target_id, user.id):
+        reply_text(update, f"You do not follow {target_user}")
+    else:
+        reply_text(update, f"You no longer follow {target_user}")
+    return ConversationHandler.END
+
+
+async def load_bookings_page(user_id: int,
+                             number: int,
+                             after: Optional[BookingCursor] = None,
+                             before: Optional[BookingCursor] = None,
+                             ) -> BookingsPage:
+    if before is not None:
+        bookings = await repository.bookings_page(user_id, before=before)
+        has_next = True
+    else:
+        bookings = await repository.bookings_page(user_id, limit=PAGE_SIZE + 1, after=after)
+        has_next = len(bookings) > PAGE_SIZE
+        bookings = bookings[:PAGE_SIZE]
+    return BookingsPage(number=number,
+                        first_number=number * PAGE_SIZE + 1,
+                        bookings=bookings,
+                        has_next=has_next)
+
+
+def render_bookings_page(page: BookingsPage) -> str:
+    parts = ["*Your bookings*"]
+    for (date, _), (number, wish) in zip(page.bookings, page.numbered()):
+        booked_on = time.strftime("%Y-%m-%d", time.gmtime(date / 1000))
+        parts.append(f"*Wish \\#{number}* for {escape_markdown_v2(wish.creator_name)}, booked on "
+                     f"{escape_markdown_v2(booked_on)}\n{wish}")
+    return "\n\n".join(parts)
+
+
+def bookings_page_markup(page: BookingsPage) -> Optional[InlineKeyboardMarkup]:
+    buttons = []
+    if page.has_previous:
+        buttons.append(InlineKeyboardButton("« Newer", callback_data=PREVIOUS_BOOKINGS_PAGE))
+    if page.has_next:
+        buttons.append(InlineKeyboardButton("Older »", callback_data=NEXT_BOOKINGS_PAGE))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+def booking_cursor(booking: Tuple[int, WishData]) -> BookingCursor:
+    date, wish = booking
+    return date, wish.wish_id
+
+
+async def my_bookings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """`/bookings`: the wishes the user booked and has not presented yet, most recent first."""
+    user = update.message.from_user
+    page = await load_bookings_page(user.id, number=0)
+    if not page.bookings:
+        reply_text(update, "You have not booked any wish", reply_markup=ReplyKeyboardRemove())
+        return ConversationHandler.END
+
+    viewed_bookings[user.id] = page
+    reply_text(update,
+               text=render_bookings_page(page),
+               parse_mode="MarkdownV2",
+               reply_markup=bookings_page_markup(page))
+    reply_text(update,
+               text="Send the number of a wish once you have presented it, or /cancel",
+               reply_markup=ReplyKeyboardRemove())
+    return MY_BOOKINGS
+
+
+async def turn_bookings_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    user = query.from_user
+    page = viewed_bookings.get(user.id)
+    if page is None:
+        return MY_BOOKINGS
+
+    if query.data == NEXT_BOOKINGS_PAGE and page.has_next and page.bookings:
+        page = await load_bookings_page(user.id, page.number + 1, after=booking_cursor(page.bookings[-1]))
+    elif query.data == PREVIOUS_BOOKINGS_PAGE and page.has_previous and page.bookings:
+        page = await load_bookings_page(user.id, page.number - 1, before=booking_cursor(page.bookings[0]))
+    else:
+        return MY_BOOKINGS
+
+    viewed_bookings[user.id] = page
+    outbox.enqueue(query.message.chat_id,
+                   "edit_message_text",
+                   message_id=query.message.message_id,
+                   text=render_bookings_page(page),
+                   parse_mode="MarkdownV2",
+                   reply_markup=bookings_page_markup(page))
+    return MY_BOOKINGS
+
+
+async def present_wish_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    user = update.message.from_user
+    page = viewed_bookings.get(user.id)
+    wishes = dict(page.numbered()) if page is not None else dict()
+    try:
+        wish = wishes[int(update.message.text)]
+    except (ValueError, KeyError):
+        reply_text(update, "Please send the number of one of your bookings, or /cancel")
+        return MY_BOOKINGS
+
+    if await repository.present_wish(wish.wish_id, user.id):
+        logger.info(f"User {user.name} presented wish {wish.wish_id}")
+        reply_text(update, f"Marked {wish.name} as presented, it left your bookings")
+    else:
+        reply_text(update, f"{wish.name} is not among your bookings anymore")
+    return MY_BOOKINGS
+
+
+async def archive_bookings_periodically() -> None:
+    while True:
+        try:
+            moved = await repository.archive_bookings()
+            if moved:
+                logger.info(f"Moved {moved} bookings to the archive")
+        except sqlite3.Error:
+            logger.exception("Archiving bookings failed")
+        await asyncio.sleep(BOOKING_ARCHIVE_INTERVAL_SECONDS)
 
 
 async def book_wish_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.message.from_user
     wish_id_str = update.message.text
     try:
-        target_user = asked_user[user.username]
-        wish_id = target_user_to_list_of_his_wishes[target_user][int(wish_id_str)]
-        book_wish(wish_id=wish_id, presenter_name=user.username)
-        await update.message.reply_text("Your booking is now confirmed!")
-        return ROLE_CHOICE
-    except ValueError:
+        wish_id = viewed_wish_numbers[user.id][int(wish_id_str)]
+        outcome = await repository.book_wish(wish_id=wish_id, presenter_id=user.id, presenter_name=display_name(user))
+    except (ValueError, KeyError):
         logger.error("incorrect value (wish number is not int?)")
-        await update.message.reply_text("Incorrect parameter, please try again!", reply_markup=ReplyKeyboardRemove())
+        reply_text(update, "Incorrect parameter, please try again!", reply_markup=ReplyKeyboardRemove())
         return BOOK_WISH
     except sqlite3.Error:
         logger.error("booking went wrong")
-        await update.message.reply_text("Incorrect parameter, please try again!", reply_markup=ReplyKeyboardRemove())
+        reply_text(update, "We could not book this wish right now, please try again!",
+                   reply_markup=ReplyKeyboardRemove())
         return BOOK_WISH
 
+    if outcome == BookingOutcome.BOOKED:
+        reply_text(update, "Your booking is now confirmed!")
+        return ROLE_CHOICE
+    elif outcome == BookingOutcome.ALREADY_BOOKED:
+        reply_text(update, "Someone has already booked this wish, please choose another one or /cancel",
+                   reply_markup=ReplyKeyboardRemove())
+    else:
+        reply_text(update, "This wish does not exist anymore, please choose another one or /cancel",
+                   reply_markup=ReplyKeyboardRemove())
+    return BOOK_WISH
+
 
 async def new_wish_name_request(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     wish_name = update.message.text
@@ -135,8 +671,10 @@ async def new_wish_name_request(update: Update, context: ContextTypes.DEFAULT_TY
 
     tmp_wish: WishData = wish_dict[user_id]
     tmp_wish.name = wish_name
+    wish_dict[user_id] = tmp_wish
 
-    await update.message.reply_text(
+    reply_text(
+        update,
         f"Ok, you want a {wish_name}.\n\nDo you have a picture of it?",
         reply_markup=skip_markup,
     )
@@ -145,13 +683,21 @@ async def new_wish_name_request(update: Update, context: ContextTypes.DEFAULT_TY
 
 async def new_wish_photo_request(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.message.from_user
-    photo_file = await update.message.photo[-1].get_file()
-    photo_id = photo_file.file_id
+    # the sizes of the photo are all in the message, no need to ask the Bot API for the file
+    photo = update.message.photo[-1]
 
     tmp_wish: WishData = wish_dict[user.id]
-    tmp_wish.photo_id = photo_id
-
-    await update.message.reply_text(
+    tmp_wish.photo_id = photo.file_id
+    tmp_wish.photo_variants = [PhotoVariant(file_unique_id=size.file_unique_id,
+                                            file_id=size.file_id,
+                                            width=size.width,
+                                            height=size.height,
+                                            file_size=size.file_size)
+                               for size in update.message.photo]
+    wish_dict[user.id] = tmp_wish
+
+    reply_text(
+        update,
         "Thanks for a pic!\n\n"
         "How much does your wish cost?",
         reply_markup=skip_markup,
@@ -163,7 +709,8 @@ async def skip_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Skips the photo and asks for a location."""
     user = update.message.from_user
     logger.info(f"User {user.name} with id={user.id} did not send a photo.")
-    await update.message.reply_text(
+    reply_text(
+        update,
         "How much does your wish cost?",
         reply_markup=skip_markup,
     )
@@ -177,9 +724,15 @@ async def new_wish_price_request(update: Update, context: ContextTypes.DEFAULT_T
 
     tmp_wish = wish_dict[user.id]
     tmp_wish.price = wish_price
-
-    await update.message.reply_text(
-        f"Ok, estimated price for your wish is {wish_price}\n\nFeel free to add a quick description to your wish!",
+    tmp_wish.price_amount, tmp_wish.price_currency = parse_price(wish_price)
+    wish_dict[user.id] = tmp_wish
+
+    no_amount = "" if tmp_wish.price_amount is not None else \
+        "\n\nThere is no amount in it, so the wish will not show up when looking for wishes under a price."
+    reply_text(
+        update,
+        f"Ok, estimated price for your wish is {wish_price}{no_amount}\n\n"
+        f"Feel free to add a quick description to your wish!",
         reply_markup=skip_markup,
     )
     return NEW_WISH_DESC_REQUEST
@@ -189,7 +742,8 @@ async def skip_price(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Skips the photo and asks for a location."""
     user = update.message.from_user
     logger.info(f"User {user.name} with id={user.id} did not provide a price for their wish.")
-    await update.message.reply_text(
+    reply_text(
+        update,
         "Feel free to add a quick description to your wish!",
         reply_markup=skip_markup,
     )
@@ -203,11 +757,13 @@ async def new_wish_desc_request(update: Update, context: ContextTypes.DEFAULT_TY
 
     tmp_wish = wish_dict[user.id]
     tmp_wish.desc = desc
+    wish_dict[user.id] = tmp_wish
 
     wish_confirmation_keyboard = [["Reject", "Confirm"]]
     wish_confirmation_markup = ReplyKeyboardMarkup(wish_confirmation_keyboard, one_time_keyboard=True)
 
-    await update.message.reply_text(
+    reply_text(
+        update,
         f"Please review your wish before adding:\n\n{tmp_wish}",
         reply_markup=wish_confirmation_markup,
         parse_mode="MarkdownV2"
@@ -223,9 +779,11 @@ async def skip_desc(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     wish_confirmation_keyboard = [["Reject", "Confirm"]]
     wish_confirmation_markup = ReplyKeyboardMarkup(wish_confirmation_keyboard, one_time_keyboard=True)
 
-    await update.message.reply_text(
-        f"No problem! Please review your wish before adding:\n\n{wish}",
+    reply_text(
+        update,
+        f"{escape_markdown_v2('No problem! Please review your wish before adding:')}\n\n{wish}",
         reply_markup=wish_confirmation_markup,
+        parse_mode="MarkdownV2"
     )
     return NEW_WISH_CONFIRMATION
 
@@ -238,22 +796,23 @@ async def new_wish_confirmation(update: Update, context: ContextTypes.DEFAULT_TY
 
     if choice == "Confirm":
         wish = wish_dict[user.id]
-        creator_name = user.username
+        wish.creator_id = user.id
+        wish.creator_name = display_name(user)
 
-        tables[TableName.WISH].add(creator_name=creator_name,
-                                   name=wish.name,
-                                   desc=wish.desc,
-                                   price=wish.price,
-                                   photo_id=wish.photo_id)
+        await repository.add_wish(wish)
+        wish_dict.pop(user.id)
 
-        await update.message.reply_text(
+        reply_text(
+            update,
             f"Your wish is saved!",
             reply_markup=ReplyKeyboardMarkup(
                 reply_keyboard, one_time_keyboard=True, input_field_placeholder="Wish or search?"
             ),
         )
     elif choice == "Reject":
-        await update.message.reply_text(
+        wish_dict.pop(user.id)
+        reply_text(
+            update,
             f"Your wish is discarded",
             reply_markup=ReplyKeyboardMarkup(
                 reply_keyboard, one_time_keyboard=True, input_field_placeholder="Wish or search?"
@@ -262,10 +821,48 @@ async def new_wish_confirmation(update: Update, context: ContextTypes.DEFAULT_TY
     return ROLE_CHOICE
 
 
+async def import_request(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    reply_text(
+        update,
+        "Send me a CSV or JSON file exported from a wishlist, or /cancel",
+        reply_markup=ReplyKeyboardRemove(),
+    )
+    return IMPORT_WISHLIST
+
+
+async def import_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    user = update.message.from_user
+    document = update.message.document
+    try:
+        transfer_format = TransferFormat.from_file_name(document.file_name or "")
+    except ValueError:
+        reply_text(update, "Please send a .csv or a .json file, or /cancel")
+        return IMPORT_WISHLIST
+    if document.file_size is not None and document.file_size > MAX_IMPORT_FILE_SIZE:
+        reply_text(update, "This file is too large, the limit is 20 MB")
+        return IMPORT_WISHLIST
+
+    file = await document.get_file()
+    content = await file.download_as_bytearray()
+    try:
+        result = await repository.import_wishlist(user.id,
+                                                  display_name(user),
+                                                  io.StringIO(content.decode("utf-8-sig"), newline=""),
+                                                  transfer_format)
+    except (ValueError, KeyError, csv.Error) as e:
+        logger.error(f"Import of {document.file_name} by {user.name} failed: {e!r}")
+        reply_text(update, f"This file could not be imported: {e}\nWishes before the problem were added.")
+        return IMPORT_WISHLIST
+    logger.info(f"User {user.name} imported {result.wishes} wishes and {result.bookings} bookings")
+    reply_text(update, f"Imported {result.wishes} wishes and {result.bookings} bookings!")
+    return ConversationHandler.END
+
+
 async def edit_wish(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.message.from_user
     logger.info(f"User {user.name} requested a new wish editing")
-    await update.message.reply_text(
+    reply_text(
+        update,
         f"TODO Editing a new wish for {user}"
     )
     return ConversationHandler.END
@@ -278,20 +875,122 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         del wish_dict[user.id]
         logger.info(f"Removed temporary wish created for {user.name} with id={user.id}.")
     logger.info(f"User {user.name} with id={user.id} canceled the conversation.")
-    await update.message.reply_text(
+    reply_text(
+        update,
         "Bye! Come back soon!", reply_markup=ReplyKeyboardRemove()
     )
 
     return ConversationHandler.END
 
 
-def main():
-    application = ApplicationBuilder().token(WISHLIST_BOT_TOKEN).build()
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Sends the metrics digest, only registered for `ADMIN_IDS`."""
+    reply_text(update, metrics.summary() or "Nothing recorded yet")
+
+
+def register_gauges() -> None:
+    """Publishes the sizes of the in-memory structures, read only when the metrics are collected."""
+    for name, store in state_stores.items():
+        metrics.STATE_ENTRIES.labels(name).set_function(store.__len__)
+    wish_cache = get_wish_cache(DB_PATH)
+    metrics.REGISTRY.gauge("wishlist_wish_cache_entries", "Wish lists and pages held by the wish cache") \
+        .set_function(lambda: wish_cache.stats().size)
+    metrics.REGISTRY.gauge("wishlist_wish_cache_hits", "Wish cache hits since startup") \
+        .set_function(lambda: wish_cache.stats().hits)
+    metrics.REGISTRY.gauge("wishlist_wish_cache_misses", "Wish cache misses since startup") \
+        .set_function(lambda: wish_cache.stats().misses)
+    metrics.REGISTRY.gauge("wishlist_outbox_queue_depth", "Replies waiting to be sent") \
+        .set_function(lambda: outbox.queue_depth() if outbox is not None else 0)
+    metrics.REGISTRY.gauge("wishlist_admission_backlog", "Updates being handled or waiting to be") \
+        .set_function(lambda: admission.backlog() if admission is not None else 0)
+
+
+def init_state_stores(backend: str = STATE_BACKEND, db_path: str = DB_PATH) -> None:
+    global wish_dict, viewed_wish_numbers, asked_user, viewed_page, viewed_search, viewed_feed, \
+        viewed_bookings
+    wish_dict = make_state_store("wish_drafts", backend, DRAFT_TTL_SECONDS, db_path=db_path)
+    viewed_wish_numbers = make_state_store("wish_numbers", backend, BROWSING_TTL_SECONDS, db_path=db_path)
+    asked_user = make_state_store("asked_user", backend, BROWSING_TTL_SECONDS, db_path=db_path)
+    viewed_page = make_state_store("viewed_page", backend, BROWSING_TTL_SECONDS, db_path=db_path)
+    viewed_search = make_state_store("viewed_search", backend, BROWSING_TTL_SECONDS, db_path=db_path)
+    viewed_feed = make_state_store("viewed_feed", backend, BROWSING_TTL_SECONDS, db_path=db_path)
+    viewed_bookings = make_state_store("viewed_bookings", backend, BROWSING_TTL_SECONDS, db_path=db_path)
+    state_stores.clear()
+    state_stores.update({
+        "wish_drafts": wish_dict,
+        "wish_numbers": viewed_wish_numbers,
+        "asked_user": asked_user,
+        "viewed_page": viewed_page,
+        "viewed_search": viewed_search,
+        "viewed_feed": viewed_feed,
+        "viewed_bookings": viewed_bookings,
+    })
+
+
+async def on_startup(application: Application) -> None:
+    global repository, outbox, metrics_server, archiver
+    if repository is None:
+        configure_pool(DB_PATH, readers=DB_READERS)
+        repository = WishRepository(DB_PATH)
+    started = time.perf_counter()
+    version = await repository.bootstrap()
+    logger.info(f"Opened {repository.db_path} at schema version {version} in {time.perf_counter() - started:.3f}s")
+    # also turns the change log of a snapshot configured before off again
+    configure_snapshot(repository.db_path,
+                       max_staleness=float(SNAPSHOT_STALENESS) if SNAPSHOT_STALENESS is not None else None)
+    init_state_stores(db_path=repository.db_path)
+    outbox = OutboundScheduler(application.bot,
+                               global_rate=OUTBOX_GLOBAL_RATE,
+                               chat_rate=OUTBOX_CHAT_RATE,
+                               chat_burst=OUTBOX_CHAT_BURST)
+    outbox.start()
+    archiver = asyncio.create_task(archive_bookings_periodically())
+    register_gauges()
+    if METRICS_PORT is not None:
+        metrics_server = MetricsServer(listen=METRICS_LISTEN, port=int(METRICS_PORT))
+        metrics_server.start()
+
+
+async def on_shutdown(application: Application) -> None:
+    archiver.cancel()
+    await outbox.stop()
+    for store in state_stores.values():
+        store.close()
+    if metrics_server is not None:
+        metrics_server.stop()
+    # commits the writes still queued for the writer thread
+    repository.shutdown()
+
+
+def instrument_handlers(conversation: ConversationHandler) -> None:
+    """Records latency and errors of every callback of `conversation`, labelled with the callback name."""
+    nested = [conversation.entry_points, conversation.fallbacks, *conversation.states.values()]
+    for handler in (handler for group in nested for handler in group):
+        handler.callback = metrics.timed_handler(handler.callback.__name__)(handler.callback)
+
+
+def build_application(token: str, request: Optional[BaseRequest] = None) -> Application:
+    global admission
+    builder = ApplicationBuilder() \
+        .token(token) \
+        .post_init(on_startup) \
+        .post_shutdown(on_shutdown)
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    application = builder.build()
 
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler("start", start)],
+        entry_points=[CommandHandler("start", start),
+                      CommandHandler("import", import_request),
+                      CommandHandler("search", search),
+                      CommandHandler("feed", feed),
+                      CommandHandler("bookings", my_bookings),
+                      CommandHandler("follow", follow),
+                      CommandHandler("unfollow", unfollow)],
         states={
-            ROLE_CHOICE: [MessageHandler(filters.Regex("^(Make a wish|See wishes|Edit wishes)$"), role_choice)],
+            ROLE_CHOICE: [
+                MessageHandler(filters.Regex("^(Make a wish|See wishes|Edit wishes|My bookings)$"), role_choice)
+            ],
             EDIT_WISH: [MessageHandler(filters.TEXT & ~filters.COMMAND, edit_wish)],
             NEW_WISH_NAME_REQUEST: [MessageHandler(filters.TEXT & ~filters.COMMAND, new_wish_name_request)],
             NEW_WISH_PHOTO_REQUEST: [MessageHandler(filters.PHOTO, new_wish_photo_request),
@@ -308,15 +1007,78 @@ def main():
                 MessageHandler(filters.Regex("^(Confirm|Reject)$"), new_wish_confirmation)
             ],
             BOOK_WISH: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, book_wish_handler)
-            ]
+                MessageHandler(filters.TEXT & ~filters.COMMAND, book_wish_handler),
+                CallbackQueryHandler(turn_wishes_page, pattern=f"^({PREVIOUS_PAGE}|{NEXT_PAGE})$"),
+            ],
+            IMPORT_WISHLIST: [MessageHandler(filters.Document.ALL, import_document)],
+            SEARCH_RESULTS: [
+                CallbackQueryHandler(turn_search_page, pattern=f"^({PREVIOUS_SEARCH_PAGE}|{NEXT_SEARCH_PAGE})$"),
+            ],
+            FEED: [
+                CallbackQueryHandler(turn_feed_page, pattern=f"^({PREVIOUS_FEED_PAGE}|{NEXT_FEED_PAGE})$"),
+            ],
+            MY_BOOKINGS: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, present_wish_handler),
+                CallbackQueryHandler(turn_bookings_page, pattern=f"^({PREVIOUS_BOOKINGS_PAGE}|{NEXT_BOOKINGS_PAGE})$"),
+            ],
         },
-        fallbacks=[CommandHandler("cancel", cancel)]
+        fallbacks=[CommandHandler("cancel", cancel),
+                   CommandHandler("import", import_request),
+                   CommandHandler("search", search),
+                   CommandHandler("feed", feed),
+                   CommandHandler("bookings", my_bookings),
+                   CommandHandler("follow", follow),
+                   CommandHandler("unfollow", unfollow)]
     )
 
+    instrument_handlers(conv_handler)
+    admission = AdmissionController(slow_down,
+                                    state_limits=ADMISSION_STATE_LIMITS,
+                                    high_watermark=ADMISSION_HIGH_WATERMARK,
+                                    queued=application.update_queue.qsize)
+    # refused updates do not count as handler calls
+    admission.guard_conversation(conv_handler)
+    application.add_handler(TypeHandler(Update, remember_user), group=-1)
     application.add_handler(conv_handler)
+    if ADMIN_IDS:
+        application.add_handler(CommandHandler("stats", stats, filters=filters.User(user_id=ADMIN_IDS)), group=1)
+    return application
+
+
+async def serve_webhook(application: Application) -> None:
+    server = WebhookServer(application,
+                           listen=WEBHOOK_LISTEN,
+                           port=WEBHOOK_PORT,
+                           path=WEBHOOK_PATH,
+                           secret_token=WEBHOOK_SECRET,
+                           max_concurrency=WEBHOOK_MAX_CONCURRENCY)
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    await server.start()
+    if WEBHOOK_URL is not None:
+        await application.bot.set_webhook(WEBHOOK_URL,
+                                          secret_token=WEBHOOK_SECRET,
+                                          max_connections=WEBHOOK_MAX_CONCURRENCY)
+    try:
+        # serve until interrupted
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+        await application.stop()
+        await application.post_shutdown(application)
+        await application.shutdown()
 
-    application.run_polling()
+
+def main():
+    if BOT_MODE == "cluster":
+        cluster.run(os.environ["WISHLIST_BOT_TOKEN"], workers=cluster.WORKERS)
+        return
+    application = build_application(os.environ["WISHLIST_BOT_TOKEN"])
+    if BOT_MODE == "webhook":
+        asyncio.run(serve_webhook(application))
+    else:
+        application.run_polling()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,398 @@
+from __future__ import annotations
+
+import bisect
+import functools
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# seconds, from a cached read to a slow write behind a busy lock
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+DEFAULT_METRICS_LISTEN = "127.0.0.1"
+DEFAULT_METRICS_PORT = 9464
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+Labels = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values))
+    return f"{{{pairs}}}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(ABC):
+    """A named family of series, one per combination of label values."""
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Labels, object] = dict()
+        self._lock = threading.Lock()
+
+    def labels(self, *values: str):
+        """The series of these label values; keep it around on hot paths to skip the lookup."""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    @abstractmethod
+    def _new_child(self):
+        pass
+
+    def series(self) -> List[Tuple[Labels, object]]:
+        with self._lock:
+            return list(self._children.items())
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.type_name}"
+        for values, child in sorted(self.series()):
+            yield from self._render_child(values, child)
+
+    def _render_child(self, values: Labels, child) -> Iterator[str]:
+        yield f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value())}"
+
+
+class CounterChild:
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self._value += amount
+
+    def value(self) -> float:
+        return self._value
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def _new_child(self) -> CounterChild:
+        return CounterChild()
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+
+class GaugeChild:
+    def __init__(self):
+        self._value = 0.0
+        self._function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float) -> None:
+        self._value = value
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """Reads the value from `function` at collection time instead, so the hot path pays nothing."""
+        self._function = function
+
+    def value(self) -> float:
+        if self._function is not None:
+            try:
+                return self._function()
+            except Exception as e:
+                logger.warning(f"Failed to collect a gauge: {e!r}")
+                return float("nan")
+        return self._value
+
+
+class Gauge(Metric):
+    type_name = "gauge"
+
+    def _new_child(self) -> GaugeChild:
+        return GaugeChild()
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        self.labels().set_function(function)
+
+
+class HistogramChild:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def snapshot(self) -> Tuple[List[int], float]:
+        """Cumulative bucket counts, the last one being the total count, and the sum of observations."""
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        cumulative, running = [], 0
+        for count in counts:
+            running += count
+            cumulative.append(running)
+        return cumulative, total
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding the `q` quantile, None if nothing was observed."""
+        cumulative, _ = self.snapshot()
+        if not cumulative[-1]:
+            return None
+        rank = q * cumulative[-1]
+        for bound, count in zip((*self.buckets, float("inf")), cumulative):
+            if count >= rank:
+                return bound
+        return float("inf")
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS,
+                 ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self) -> HistogramChild:
+        return HistogramChild(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def _render_child(self, values: Labels, child: HistogramChild) -> Iterator[str]:
+        cumulative, total = child.snapshot()
+        for bound, count in zip((*self.buckets, float("inf")), cumulative):
+            labels = _format_labels((*self.labelnames, "le"), (*values, _format_value(bound)))
+            yield f"{self.name}_bucket{labels} {count}"
+        labels = _format_labels(self.labelnames, values)
+        yield f"{self.name}_sum{labels} {_format_value(total)}"
+        yield f"{self.name}_count{labels} {cumulative[-1]}"
+
+
+class Registry:
+    """Metrics of the process, rendered in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = dict()
+        self._lock = threading.Lock()
+
+    def _register(self, metric: Metric) -> Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                    raise ValueError(f"{metric.name} is already registered differently")
+                return existing
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self,
+                  name: str,
+                  documentation: str,
+                  labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS,
+                  ) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def get(self, name: str) -> Optional[Metric]:
+        with self._lock:
+            return self._metrics.get(name)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        return "".join(f"{line}\n" for metric in metrics for line in metric.render())
+
+
+REGISTRY = Registry()
+
+HANDLER_LATENCY = REGISTRY.histogram("wishlist_handler_seconds",
+                                     "Latency of conversation handler callbacks",
+                                     ["handler"])
+HANDLER_ERRORS = REGISTRY.counter("wishlist_handler_errors_total",
+                                  "Conversation handler callbacks that raised",
+                                  ["handler"])
+DB_LATENCY = REGISTRY.histogram("wishlist_db_operation_seconds",
+                                "Latency of database operations",
+                                ["operation"])
+DB_ERRORS = REGISTRY.counter("wishlist_db_operation_errors_total",
+                             "Database operations that raised",
+                             ["operation"])
+DB_ROLLBACKS = REGISTRY.counter("wishlist_db_rollbacks_total", "Write transactions rolled back")
+BOOKING_OUTCOMES = REGISTRY.counter("wishlist_bookings_total", "Booking attempts by outcome", ["outcome"])
+BOOKING_RETRIES = REGISTRY.counter("wishlist_booking_retries_total", "Bookings retried because the database was busy")
+BOOKING_BUSY_FAILURES = REGISTRY.counter("wishlist_booking_busy_failures_total",
+                                         "Bookings given up because the database stayed busy")
+ADMISSION_OUTCOMES = REGISTRY.counter("wishlist_admission_updates_total",
+                                      "Updates held back by the admission control, by outcome",
+                                      ["outcome"])
+STATE_ENTRIES = REGISTRY.gauge("wishlist_state_entries",
+                               "Entries held by a conversation state store",
+                               ["store"])
+
+
+def timed(latency: HistogramChild, errors: CounterChild) -> Callable[[Callable[..., T]], Callable[..., T]]:
+    """Records the latency of every call of the decorated function and counts the calls that raise."""
+
+    def decorator(func: Callable[..., T]) -> Callable[..., T]:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs) -> T:
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except BaseException:
+                errors.inc()
+                raise
+            finally:
+                latency.observe(time.perf_counter() - started)
+
+        return wrapper
+
+    return decorator
+
+
+def timed_async(latency: HistogramChild, errors: CounterChild) -> Callable[[Callable], Callable]:
+    """`timed` for coroutine functions."""
+
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except BaseException:
+                errors.inc()
+                raise
+            finally:
+                latency.observe(time.perf_counter() - started)
+
+        return wrapper
+
+    return decorator
+
+
+def timed_db_operation(operation: str) -> Callable[[Callable[..., T]], Callable[..., T]]:
+    return timed(DB_LATENCY.labels(operation), DB_ERRORS.labels(operation))
+
+
+def timed_handler(handler: str) -> Callable[[Callable], Callable]:
+    return timed_async(HANDLER_LATENCY.labels(handler), HANDLER_ERRORS.labels(handler))
+
+
+def summary(registry: Registry = REGISTRY) -> str:
+    """Short human readable digest: calls, errors and latency percentiles of every timed operation."""
+    lines = []
+    for histogram_name, errors_name in [(HANDLER_LATENCY.name, HANDLER_ERRORS.name),
+                                        (DB_LATENCY.name, DB_ERRORS.name)]:
+        histogram, errors = registry.get(histogram_name), registry.get(errors_name)
+        if histogram is None:
+            continue
+        error_counts = {values: child.value() for values, child in errors.series()} if errors else dict()
+        for values, child in sorted(histogram.series()):
+            cumulative, total = child.snapshot()
+            if not cumulative[-1]:
+                continue
+            p50, p99 = child.quantile(0.5), child.quantile(0.99)
+            lines.append(f"{values[0]}: {cumulative[-1]} calls, {int(error_counts.get(values, 0))} errors, "
+                         f"mean {total / cumulative[-1] * 1000:.1f}ms, p50 <{p50 * 1000:g}ms, p99 <{p99 * 1000:g}ms")
+    for name in (DB_ROLLBACKS.name, BOOKING_RETRIES.name, BOOKING_BUSY_FAILURES.name):
+        metric = registry.get(name)
+        if metric is not None:
+            lines.append(f"{name}: {int(sum(child.value() for _, child in metric.series()))}")
+    outcomes = registry.get(BOOKING_OUTCOMES.name)
+    if outcomes is not None:
+        for values, child in sorted(outcomes.series()):
+            lines.append(f"bookings {values[0]}: {int(child.value())}")
+    admissions = registry.get(ADMISSION_OUTCOMES.name)
+    if admissions is not None:
+        for values, child in sorted(admissions.series()):
+            lines.append(f"updates {values[0]}: {int(child.value())}")
+    gauges = registry.get(STATE_ENTRIES.name)
+    if gauges is not None:
+        for values, child in sorted(gauges.series()):
+            lines.append(f"{values[0]} entries: {child.value():g}")
+    return "\n".join(lines)
+
+
+class MetricsServer:
+    """Serves `registry` at `GET /metrics` from a daemon thread, independently of the event loop."""
+
+    def __init__(self,
+                 registry: Registry = REGISTRY,
+                 listen: str = DEFAULT_METRICS_LISTEN,
+                 port: int = DEFAULT_METRICS_PORT,
+                 ):
+        self.registry = registry
+        self.listen = listen
+        self.port = port
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args) -> None:
+                pass
+
+        self._server = ThreadingHTTPServer((self.listen, self.port), Handler)
+        self._server.daemon_threads = True
+        # the actual port if 0 was requested
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True)
+        self._thread.start()
+        logger.info(f"Serving metrics on {self.listen}:{self.port}/metrics")
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
@@ -0,0 +1,101 @@
+import os
+
+import httpx
+import pytest
+
+os.environ.setdefault("WISHLIST_BOT_TOKEN", "123:test")
+
+import main
+import metrics
+from db import Wish, db_ops
+from fake_transport import FakeRequest, UpdateFactory, run_bot
+from metrics import Registry, timed
+
+
+def test_registry_renders_prometheus_text() -> None:
+    registry = Registry()
+    calls = registry.counter("calls_total", "Calls", ["kind"])
+    latency = registry.histogram("latency_seconds", "Latency", buckets=[0.1, 1.0])
+    registry.gauge("queue_depth", "Depth").set_function(lambda: 3)
+
+    calls.labels("a").inc()
+    calls.labels("a").inc(2)
+    latency.observe(0.05)
+    latency.observe(0.5)
+    latency.observe(5)
+
+    assert registry.render().splitlines() == [
+        "# HELP calls_total Calls",
+        "# TYPE calls_total counter",
+        'calls_total{kind="a"} 3',
+        "# HELP latency_seconds Latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{le="0.1"} 1',
+        'latency_seconds_bucket{le="1.0"} 2',
+        'latency_seconds_bucket{le="+Inf"} 3',
+        "latency_seconds_sum 5.55",
+        "latency_seconds_count 3",
+        "# HELP queue_depth Depth",
+        "# TYPE queue_depth gauge",
+        "queue_depth 3",
+    ]
+    assert latency.labels().quantile(0.5) == 1.0
+
+
+def test_timed_counts_errors() -> None:
+    registry = Registry()
+    latency = registry.histogram("op_seconds", "Latency", ["op"]).labels("fail")
+    errors = registry.counter("op_errors_total", "Errors", ["op"]).labels("fail")
+
+    @timed(latency, errors)
+    def fail():
+        raise RuntimeError()
+
+    with pytest.raises(RuntimeError):
+        fail()
+    assert errors.value() == 1
+    assert latency.snapshot()[0][-1] == 1
+
+
+def test_db_operations_and_rollbacks_are_recorded(tmp_path) -> None:
+    db_path = str(tmp_path / "metrics.db")
+    wishes = Wish(db_path).create_table()
+    add = metrics.DB_LATENCY.labels("Wish.add")
+    calls = add.snapshot()[0][-1]
+    rollbacks = metrics.DB_ROLLBACKS.labels().value()
+
+    wishes.add(creator_id=1, creator_name="user1", name="bike")
+    with pytest.raises(ValueError):
+        with db_ops(db_path) as cur:
+            cur.execute("DELETE FROM wish")
+            raise ValueError()
+
+    assert add.snapshot()[0][-1] == calls + 1
+    assert metrics.DB_ROLLBACKS.labels().value() == rollbacks + 1
+    assert len(wishes.search_by_creator_and_booked_value(1)) == 1
+
+
+def test_metrics_endpoint_and_stats_command(tmp_path, monkeypatch) -> None:
+    db_path = str(tmp_path / "stats.db")
+    Wish(db_path).create_table().add(creator_id=2, creator_name="user2", name="bike")
+    monkeypatch.setattr(main, "ADMIN_IDS", [1])
+    monkeypatch.setattr(main, "METRICS_PORT", "0")
+    request = FakeRequest()
+    updates = UpdateFactory()
+
+    async def scrape(application) -> str:
+        async with httpx.AsyncClient() as client:
+            response = await client.get(f"http://127.0.0.1:{main.metrics_server.port}/metrics")
+        return response.text
+
+    exposition = run_bot(monkeypatch, db_path, request,
+                         [updates.message(2, "/start"), updates.message(2, "See wishes"), updates.message(2, "@user2"),
+                          updates.message(2, "/stats"), updates.message(1, "/stats")],
+                         during=scrape)
+
+    assert 'wishlist_handler_seconds_count{handler="see_wishes"}' in exposition
+    assert 'wishlist_state_entries{store="viewed_page"}' in exposition
+    texts = [call.parameters["text"] for call in request.calls_of("sendMessage")]
+    stats_replies = [text for text in texts if "viewed_page entries: " in text]
+    assert len(stats_replies) == 1
+    assert "\nsee_wishes: " in stats_replies[0]
@@ -0,0 +1,68 @@
+import os
+
+os.environ.setdefault("WISHLIST_BOT_TOKEN", "123:test")
+
+from db import TABLE_CLASSES, Photo, add_photos, create_tables_dict, db_ops
+from fake_transport import FakeRequest, UpdateFactory, run_bot
+from wishdata import PhotoVariant
+
+
+def variants(photo: str, *sides: int):
+    return [PhotoVariant(f"{photo}-u{side}", f"{photo}-{side}", side, side * 3 // 4) for side in sides]
+
+
+def test_photos_are_stored_once_and_listed_small(tmp_path) -> None:
+    db_path = str(tmp_path / "photos.db")
+    create_tables_dict(db_path)
+    photos = Photo(db_path)
+    assert photos.add(variants("a", 90, 320, 800, 1280)) == "a-u1280"
+    # sent again, e.g. forwarded, with other file ids
+    assert photos.add([PhotoVariant(v.file_unique_id, "other", v.width, v.height) for v in variants("a", 90, 1280)]) \
+           == "a-u1280"
+    assert photos.add(variants("b", 90, 240)) == "b-u240"
+    with db_ops(db_path, readonly=True) as cur:
+        assert list(cur.execute("SELECT count(*), count(DISTINCT photo_unique_id) FROM photo")) == [(6, 2)]
+
+    # a photo without a large enough variant is sent as stored
+    assert photos.thumbnails(["a-u1280", "b-u240", "unknown"]) == {"a-u1280": "a-320"}
+    assert photos.thumbnails(["a-u1280"], side=1000) == {"a-u1280": "a-1280"}
+    assert photos.thumbnails([]) == dict()
+
+
+def test_photo_migration_is_safe_to_run_again(tmp_path) -> None:
+    db_path = str(tmp_path / "photo_migration.db")
+    for table_name, table_class in TABLE_CLASSES.items():
+        if table_name.value != "photo":
+            table_class(db_path).create_table()
+    with db_ops(db_path) as cur:
+        cur.execute("ALTER TABLE wish DROP COLUMN photo_unique_id")
+    add_photos(db_path)
+    add_photos(db_path)
+    with db_ops(db_path, readonly=True) as cur:
+        assert "photo_unique_id" in {row[1] for row in cur.execute("PRAGMA table_info(wish)")}
+    assert Photo(db_path).thumbnails(["missing"]) == dict()
+
+
+def test_wishes_with_photos_take_no_file_requests(tmp_path, monkeypatch) -> None:
+    db_path = str(tmp_path / "photo_flow.db")
+    create_tables_dict(db_path)
+    request = FakeRequest()
+    updates = UpdateFactory()
+
+    def make_a_wish(user_id: int, name: str):
+        return [updates.message(user_id, "/start"), updates.message(user_id, "Make a wish"),
+                updates.message(user_id, name), updates.message(user_id, photo="sunset"),
+                updates.message(user_id, "/skip"), updates.message(user_id, "/skip"),
+                updates.message(user_id, "Confirm"), updates.message(user_id, "/cancel")]
+
+    run_bot(monkeypatch, db_path, request,
+            [*make_a_wish(1, "painting"), *make_a_wish(3, "poster"),
+             updates.message(2, "/start"), updates.message(2, "See wishes"), updates.message(2, "@user1")])
+
+    assert request.calls_of("getFile") == []
+    with db_ops(db_path, readonly=True) as cur:
+        assert list(cur.execute("SELECT name, photo_id, photo_unique_id FROM wish ORDER BY wish_id")) == \
+               [("painting", "sunset", "sunset-u"), ("poster", "sunset", "sunset-u")]
+        assert list(cur.execute("SELECT count(*) FROM photo")) == [(4,)]
+    sent = [call.parameters["photo"] for call in request.calls_of("sendPhoto")]
+    assert sent == ["sunset-320"]
@@ -0,0 +1,116 @@
+import os
+
+os.environ.setdefault("WISHLIST_BOT_TOKEN", "123:test")
+
+from db import TABLE_CLASSES, Wish, add_price_amounts, backfill_prices, create_tables_dict, db_ops, \
+    explain_query_plan, get_pool, remember_user, wish_cursor
+from fake_transport import FakeRequest, UpdateFactory, run_bot
+from wishdata import WishData, WishOrder, parse_price
+
+
+def test_prices_are_parsed_into_amount_and_currency() -> None:
+    assert parse_price("about 30 CHF") == (30.0, "CHF")
+    assert parse_price("1,500.50$") == (1500.5, "USD")
+    assert parse_price("12,5 €") == (12.5, "EUR")
+    assert parse_price("1 500 руб") == (1500.0, "RUB")
+    assert parse_price("1.500") == (1500.0, None)
+    assert parse_price("eur 19.99") == (19.99, "EUR")
+    assert parse_price(25.0) == (25.0, None)
+    assert parse_price("no idea") == (None, None)
+
+
+def test_price_pages_are_range_scans(tmp_path) -> None:
+    db_path = str(tmp_path / "prices.db")
+    create_tables_dict(db_path)
+    wish = Wish(db_path)
+    for i, price in enumerate(["40 EUR", "about 10 EUR", None, "25 USD", "10 EUR", "priceless", "30 EUR"]):
+        wish.add(creator_id=10, creator_name="10", name=f"wish {i}", price=price)
+
+    by_price = [WishData.from_tuple(row) for row in wish.search_page(10, limit=10, wish_order=WishOrder.PRICE)]
+    assert [w.name for w in by_price] == ["wish 1", "wish 4", "wish 3", "wish 6", "wish 0", "wish 2", "wish 5"]
+
+    first = [WishData.from_tuple(row)
+             for row in wish.search_page(10, limit=2, wish_order=WishOrder.PRICE, max_price=30, currency="EUR")]
+    rest = wish.search_page(10, limit=2, after=wish_cursor(first[-1], WishOrder.PRICE), wish_order=WishOrder.PRICE,
+                            max_price=30, currency="EUR")
+    assert [w.name for w in first] + [row[4] for row in rest] == ["wish 1", "wish 4", "wish 6"]
+
+    query = """SELECT * FROM wish WHERE creator_id = ? AND booked = ? AND ifnull(price_amount, 1e999) <= ?
+               AND price_currency = ? ORDER BY ifnull(price_amount, 1e999), wish_id LIMIT 10"""
+    plan = explain_query_plan(query, [10, 0, 30, "EUR"], db_path)
+    assert any("USING INDEX wish_creator_id_booked_price" in step for step in plan)
+    assert not any("TEMP B-TREE" in step for step in plan)
+
+
+def test_existing_prices_are_parsed_in_batches(tmp_path) -> None:
+    db_path = str(tmp_path / "backfill.db")
+    for table_class in TABLE_CLASSES.values():
+        table_class(db_path).create_table()
+    with db_ops(db_path) as cur:
+        # the schema before parsed prices
+        cur.execute("ALTER TABLE wish DROP COLUMN price_amount")
+        cur.execute("ALTER TABLE wish DROP COLUMN price_currency")
+        cur.executemany("INSERT INTO wish(booked, presented, creator_name, name, price, creator_id) "
+                        "VALUES (0, 0, 'alice', ?, ?, 1)",
+                        [(f"wish {i}", f"{i} EUR" if i % 2 else i) for i in range(25)] + [("car", "a lot")])
+
+    add_price_amounts(db_path)
+    statements = []
+    with get_pool(db_path).writer() as conn:
+        conn.set_trace_callback(statements.append)
+    backfill_prices(db_path, batch_size=10)
+    with get_pool(db_path).writer() as conn:
+        conn.set_trace_callback(None)
+    assert statements.count("COMMIT") >= 3
+
+    with db_ops(db_path, readonly=True) as cur:
+        assert list(cur.execute("SELECT price_amount, price_currency FROM wish WHERE wish_id IN (4, 8, 26)")) == \
+               [(3.0, "EUR"), (7.0, "EUR"), (None, None)]
+    assert len(Wish(db_path).search_page(1, limit=100, wish_order=WishOrder.PRICE, max_price=10)) == 11
+
+
+def test_see_wishes_under_a_price(tmp_path, monkeypatch) -> None:
+    db_path = str(tmp_path / "see_prices.db")
+    create_tables_dict(db_path)
+    wish = Wish(db_path)
+    for price in [50, 5, None, 20, 15]:
+        wish.add(creator_id=2, creator_name="user2", name=f"wish for {price}", price=price)
+    remember_user(2, "user2", db_path)
+    request = FakeRequest()
+    updates = UpdateFactory()
+
+    run_bot(monkeypatch, db_path, request,
+            [updates.message(1, "/start"), updates.message(1, "See wishes"),
+             updates.message(1, "@user2 under 20"), updates.message(1, "/cancel"),
+             updates.message(1, "/start"), updates.message(1, "See wishes"),
+             updates.message(1, "@user2 by price")])
+
+    pages = [call.parameters["text"] for call in request.calls_of("sendMessage")
+             if call.parameters["text"].startswith("*Wishes of")]
+    assert pages[0].startswith("*Wishes of user2 under 20, cheapest first*")
+    assert pages[0].index("wish for 5") < pages[0].index("wish for 15") < pages[0].index("wish for 20")
+    assert "wish for 50" not in pages[0] and "wish for None" not in pages[0]
+    assert pages[1].index("wish for 50") < pages[1].index("wish for None")
+
+
+def test_viewers_book_by_the_numbers_they_were_shown(tmp_path, monkeypatch) -> None:
+    db_path = str(tmp_path / "two_viewers.db")
+    create_tables_dict(db_path)
+    wish = Wish(db_path)
+    wish.add(creator_id=2, creator_name="user2", name="EXPENSIVE", priority=1, price=500)
+    wish.add(creator_id=2, creator_name="user2", name="CHEAP", price=5)
+    remember_user(2, "user2", db_path)
+    request = FakeRequest()
+    updates = UpdateFactory()
+
+    run_bot(monkeypatch, db_path, request,
+            [updates.message(1, "/start"), updates.message(1, "See wishes"), updates.message(1, "@user2"),
+             updates.message(3, "/start"), updates.message(3, "See wishes"), updates.message(3, "@user2 by price"),
+             updates.message(1, "1"), updates.message(3, "2")])
+
+    with db_ops(db_path, readonly=True) as cur:
+        bookings = list(cur.execute("SELECT presenter_id, name FROM booked JOIN wish USING (wish_id) "
+                                    "ORDER BY presenter_id"))
+    assert bookings == [(1, "EXPENSIVE")]
+    texts = [call.parameters["text"] for call in request.calls_of("sendMessage") if call.parameters["chat_id"] == 3]
+    assert texts[-1].startswith("Someone has already booked this wish")
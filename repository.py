@@ -0,0 +1,171 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, TypeVar
+
+import db
+import transfer
+from cache import LRUCache
+from db import DB_PATH, READER_POOL_SIZE, PAGE_SIZE, Booked, BookingCursor, BookingOutcome, Feed, Photo, \
+    Presented, Relation, RelationType, Username, Wish, WishCursor
+from transfer import ImportResult, TransferFormat
+from wishdata import WishData, WishOrder
+from writer import GroupCommitWriter
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+KNOWN_USERS_CACHE_SIZE = 65536
+KNOWN_USERS_TTL_SECONDS = 60 * 60
+
+
+class WishRepository:
+    """Awaitable facade over the `db` tables.
+
+    Every query runs on a dedicated thread pool, so the event loop keeps dispatching updates
+    while SQLite waits for the disk. Writes are queued to a single writer thread committing them in batches.
+    """
+
+    def __init__(self, db_path: str = DB_PATH, max_workers: int = READER_POOL_SIZE + 1):
+        self.db_path = db_path
+        self.wishes = Wish(db_path)
+        self.usernames = Username(db_path)
+        self.relations = Relation(db_path)
+        self.feed = Feed(db_path)
+        self.booked = Booked(db_path)
+        self.presented = Presented(db_path)
+        self.photos = Photo(db_path)
+        # user id -> (username,) already in the username index
+        self.known_usernames: LRUCache[int, Tuple[Optional[str]]] = LRUCache(KNOWN_USERS_CACHE_SIZE,
+                                                                            KNOWN_USERS_TTL_SECONDS)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="wishlist-db")
+        self.writer = GroupCommitWriter(db_path)
+
+    async def _run(self, func: Callable[..., T], *args, **kwargs) -> T:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def bootstrap(self) -> int:
+        return await self._run(db.bootstrap, self.db_path)
+
+    async def search_wishes(self, creator_id: int, booked_value_needed: bool = False) -> List[WishData]:
+        return await self._run(self.wishes.search_wishes, creator_id, booked_value_needed)
+
+    async def search_page(self,
+                          creator_id: int,
+                          booked_value_needed: bool = False,
+                          limit: int = PAGE_SIZE,
+                          after: Optional[WishCursor] = None,
+                          before: Optional[WishCursor] = None,
+                          wish_order: WishOrder = WishOrder.PRIORITY,
+                          max_price: Optional[float] = None,
+                          currency: Optional[str] = None,
+                          ) -> List[WishData]:
+        return await self._run(self.wishes.search_wishes_page,
+                               creator_id, booked_value_needed, limit, after, before, wish_order, max_price, currency)
+
+    async def search_text(self, presenter_id: int, terms: str, limit: int = PAGE_SIZE, offset: int = 0
+                          ) -> List[WishData]:
+        return await self._run(self.wishes.search_text, presenter_id, terms, limit, offset, WishData.row_factory)
+
+    async def feed_page(self,
+                        presenter_id: int,
+                        limit: int = PAGE_SIZE,
+                        older_than: Optional[int] = None,
+                        newer_than: Optional[int] = None,
+                        ) -> List[WishData]:
+        return await self._run(self.feed.page, presenter_id, limit, older_than, newer_than, WishData.row_factory)
+
+    async def bookings_page(self,
+                            presenter_id: int,
+                            limit: int = PAGE_SIZE,
+                            after: Optional[BookingCursor] = None,
+                            before: Optional[BookingCursor] = None,
+                            ) -> List[Tuple[int, WishData]]:
+        return await self._run(self.booked.page, presenter_id, limit, after, before, WishData.booking_row_factory)
+
+    async def photo_thumbnails(self, photo_unique_ids: Iterable[str]) -> Dict[str, str]:
+        return await self._run(self.photos.thumbnails, photo_unique_ids)
+
+    async def resolve_username(self, username: str) -> Optional[int]:
+        return await self._run(self.usernames.resolve, username)
+
+    async def _write(self, func: Callable[..., T], *args, **kwargs) -> T:
+        return await asyncio.wrap_future(self.writer.submit(func, *args, **kwargs))
+
+    async def add_wish(self, wish: WishData) -> None:
+        if wish.photo_variants:
+            wish.photo_unique_id = await self._write(self.photos.add, wish.photo_variants)
+        await self._write(self.wishes.add,
+                          creator_id=wish.creator_id,
+                          creator_name=wish.creator_name,
+                          name=wish.name,
+                          priority=wish.priority,
+                          relation_type=wish.relation_type,
+                          link=wish.link,
+                          price=wish.price,
+                          photo_id=wish.photo_id,
+                          desc=wish.desc,
+                          quantity=wish.quantity,
+                          photo_unique_id=wish.photo_unique_id)
+
+    async def book_wish(self, wish_id: int, presenter_id: int, presenter_name: str) -> BookingOutcome:
+        return await self._write(db.book_wish,
+                                 wish_id=wish_id,
+                                 presenter_id=presenter_id,
+                                 presenter_name=presenter_name,
+                                 db_path=self.db_path)
+
+    async def present_wish(self, wish_id: int, presenter_id: int) -> bool:
+        return await self._write(self.presented.do_present_wish, wish_id, presenter_id)
+
+    async def archive_bookings(self, older_than: Optional[int] = None) -> int:
+        """Moves bookings to the archive batch by batch, each batch a write of its own between the other writes."""
+        moved = 0
+        while True:
+            batch = await self._write(db.archive_bookings, self.db_path, older_than)
+            moved += batch
+            if batch < db.BOOKING_ARCHIVE_BATCH_SIZE:
+                return moved
+
+    async def follow(self,
+                     creator_id: int,
+                     creator_name: str,
+                     presenter_id: int,
+                     presenter_name: str,
+                     relation_type: RelationType,
+                     ) -> None:
+        await self._write(self.relations.replace, creator_id, creator_name, presenter_id, presenter_name, relation_type)
+
+    async def unfollow(self, creator_id: int, presenter_id: int) -> bool:
+        return await self._write(self.relations.remove, creator_id, presenter_id)
+
+    async def remember_user(self, user_id: int, username: Optional[str]) -> None:
+        """Updates the username index, written only when the user is new to this process or was renamed."""
+        if self.known_usernames.get(user_id) == (username,):
+            return
+        await self._write(db.remember_user, user_id, username, self.db_path)
+        self.known_usernames.put(user_id, (username,))
+
+    async def import_wishlist(self,
+                              creator_id: int,
+                              creator_name: str,
+                              lines: Iterable[str],
+                              transfer_format: TransferFormat,
+                              ) -> ImportResult:
+        """Parses on the thread pool and inserts batch by batch on the writer thread, between other writes."""
+        return await self._run(transfer.import_wishlist,
+                               creator_id,
+                               creator_name,
+                               lines,
+                               transfer_format,
+                               self.db_path,
+                               run_batch=lambda insert: self.writer.submit(insert).result())
+
+    def shutdown(self) -> None:
+        self.writer.close()
+        self._executor.shutdown(wait=True)
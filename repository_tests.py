@@ -0,0 +1,71 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+os.environ.setdefault("WISHLIST_BOT_TOKEN", "123:test")
+
+import main
+from db import Wish, create_tables_dict
+from fake_transport import FakeRequest, run_bot
+from repository import WishRepository
+from wishdata import WishData
+
+
+def test_slow_write_does_not_block_other_conversations(tmp_path) -> None:
+    db_path = str(tmp_path / "repository.db")
+    create_tables_dict(db_path)
+    Wish(db_path).add(creator_id=1, creator_name="alice", name="bike")
+    repository = WishRepository(db_path)
+
+    add = repository.wishes.add
+
+    def slow_add(*args, **kwargs) -> None:
+        time.sleep(0.5)
+        add(*args, **kwargs)
+
+    repository.wishes.add = slow_add
+    finished = []
+
+    async def write() -> None:
+        await repository.add_wish(WishData(creator_id=2, creator_name="bob", booked=False, presented=False, name="car"))
+        finished.append("write")
+
+    async def read() -> None:
+        wishes = await repository.search_wishes(1)
+        assert [wish.name for wish in wishes] == ["bike"]
+        finished.append("read")
+
+    async def ticker() -> float:
+        # measures how late the event loop wakes up while the write is in flight
+        started = time.perf_counter()
+        await asyncio.sleep(0.05)
+        return time.perf_counter() - started - 0.05
+
+    async def conversations() -> float:
+        results = await asyncio.gather(write(), *(read() for _ in range(5)), ticker())
+        return results[-1]
+
+    loop_lag = asyncio.run(conversations())
+    repository.shutdown()
+
+    assert finished == ["read"] * 5 + ["write"]
+    assert loop_lag < 0.1
+    assert [row[4] for row in Wish(db_path).search_by_creator_and_booked_value(2)] == ["car"]
+
+
+def test_bot_shutdown_commits_the_queued_writes(tmp_path, monkeypatch) -> None:
+    db_path = str(tmp_path / "shutdown.db")
+    create_tables_dict(db_path)
+
+    async def queue_writes(application) -> None:
+        # the wish waits behind a slow write until the bot shuts down
+        main.repository.writer.submit(time.sleep, 0.2)
+        main.repository.writer.submit(Wish(db_path).add, creator_id=2, creator_name="bob", name="car")
+
+    run_bot(monkeypatch, db_path, FakeRequest(), during=queue_writes)
+
+    assert [row[4] for row in Wish(db_path).search_by_creator_and_booked_value(2)] == ["car"]
+    with pytest.raises(RuntimeError):
+        main.repository.writer.submit(time.sleep, 0)
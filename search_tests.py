@@ -0,0 +1,59 @@
+import os
+
+os.environ.setdefault("WISHLIST_BOT_TOKEN", "123:test")
+
+import main
+from db import Relation, RelationType, Wish, create_tables_dict, db_ops, explain_query_plan, fts_query
+from fake_transport import FakeRequest, UpdateFactory, run_bot
+
+
+def seed(db_path: str) -> Wish:
+    create_tables_dict(db_path)
+    wish = Wish(db_path)
+    wish.add(creator_id=2, creator_name="user2", name="Red bike", desc="a fast one")
+    wish.add(creator_id=2, creator_name="user2", name="Bike helmet", desc="for the red bike")
+    wish.add(creator_id=3, creator_name="user3", name="Bike lights")
+    wish.add(creator_id=2, creator_name="user2", name="Cookbook", desc="vegetarian")
+    Relation(db_path).add(2, "user2", 1, "user1", RelationType.FRIEND)
+    return wish
+
+
+def test_search_is_ranked_restricted_and_in_sync(tmp_path) -> None:
+    db_path = str(tmp_path / "search.db")
+    wish = seed(db_path)
+
+    assert [row[4] for row in wish.search_text(1, "red bik")] == ["Red bike", "Bike helmet"]
+    assert [row[4] for row in wish.search_text(1, "bike", limit=1, offset=1)] == ["Red bike"]
+    assert wish.search_text(4, "bike") == []
+    assert wish.search_text(1, 'AND " OR') == []
+
+    with db_ops(db_path) as cur:
+        cur.execute("UPDATE wish SET name = 'Blue bike' WHERE wish_id = 1")
+        cur.execute("DELETE FROM wish WHERE wish_id = 2")
+    assert [row[4] for row in wish.search_text(1, "bike")] == ["Blue bike"]
+    assert wish.search_text(1, "red") == []
+
+    plan = explain_query_plan(
+        "SELECT rowid FROM wish_fts WHERE wish_fts MATCH ?", [fts_query("bike")], db_path
+    )
+    assert any("VIRTUAL TABLE INDEX" in step for step in plan)
+
+
+def test_search_command_pages_through_matches(tmp_path, monkeypatch) -> None:
+    db_path = str(tmp_path / "search_command.db")
+    wish = seed(db_path)
+    for i in range(12):
+        wish.add(creator_id=2, creator_name="user2", name=f"bike bell {i}")
+    request = FakeRequest()
+    updates = UpdateFactory()
+
+    run_bot(monkeypatch, db_path, request,
+            [updates.message(1, "/search bike"), updates.callback_query(1, main.NEXT_SEARCH_PAGE),
+             updates.message(5, "/search bike")])
+
+    first_page = request.calls_of("sendMessage")[0].parameters
+    assert first_page["text"].count("*Wish \\#") == 10
+    assert "user3" not in first_page["text"]
+    second_page = request.calls_of("editMessageText")[0].parameters["text"]
+    assert "*Wish \\#14* of user2" in second_page
+    assert request.calls_of("sendMessage")[1].parameters["text"] == "Nothing found in your friends' wishlists"
@@ -0,0 +1,252 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import statistics
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+from telegram import InputMediaPhoto
+from telegram.error import RetryAfter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows about 30 messages per second overall and about one per second in a single chat
+GLOBAL_RATE = 30.0
+CHAT_RATE = 1.0
+CHAT_BURST = 3.0
+MAX_CONCURRENT_SENDS = 8
+MAX_MEDIA_GROUP_SIZE = 10
+LATENCY_WINDOW = 1000
+
+SEND_LATENCY = metrics.REGISTRY.histogram("wishlist_outbox_send_latency_seconds",
+                                          "Time from enqueueing a reply until Telegram accepted it",
+                                          buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+
+
+class TokenBucket:
+    """Allows `rate` operations per second on average and bursts of up to `capacity` operations."""
+
+    def __init__(self, rate: float, capacity: float, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._tokens = capacity
+        self._updated_at = clock()
+
+    def _refill(self) -> None:
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def delay(self, tokens: float = 1.0) -> float:
+        """Seconds until `tokens` are available, zero if they are available right now."""
+        self._refill()
+        return max(0.0, (tokens - self._tokens) / self.rate)
+
+    def try_acquire(self, tokens: float = 1.0) -> float:
+        """Takes `tokens` and returns zero, or returns the number of seconds to wait before trying again."""
+        wait = self.delay(tokens)
+        if wait == 0:
+            self._tokens -= tokens
+        return wait
+
+    def reserve(self, tokens: float = 1.0) -> float:
+        """Takes `tokens` even if they are not there yet and returns the number of seconds until they are."""
+        wait = self.delay(tokens)
+        self._tokens -= tokens
+        return wait
+
+    def is_full(self) -> bool:
+        return self.delay(self.capacity) == 0
+
+
+@dataclass
+class OutboundMessage:
+    chat_id: int
+    method: str
+    kwargs: Dict[str, Any]
+    future: asyncio.Future
+    enqueued_at: float
+
+    def can_join_media_group(self) -> bool:
+        return self.method == "send_photo" and "reply_markup" not in self.kwargs
+
+
+@dataclass
+class SenderStats:
+    queue_depth: int
+    sent: int
+    failed: int
+    retries: int
+    latency_p50: Optional[float]
+    latency_p95: Optional[float]
+
+
+class OutboundScheduler:
+    """Send queue between the handlers and the Bot API.
+
+    Messages of one chat leave in the order they were enqueued, different chats are served concurrently
+    within the global and per-chat rate limits. Consecutive photos of a chat are sent as a single media group.
+    """
+
+    def __init__(self,
+                 bot,
+                 global_rate: float = GLOBAL_RATE,
+                 chat_rate: float = CHAT_RATE,
+                 chat_burst: float = CHAT_BURST,
+                 max_concurrency: int = MAX_CONCURRENT_SENDS,
+                 clock: Callable[[], float] = time.monotonic,
+                 ):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_concurrency = max_concurrency
+        self._clock = clock
+        self._global_bucket = TokenBucket(global_rate, max(global_rate, MAX_MEDIA_GROUP_SIZE), clock)
+        self._chat_buckets: Dict[int, TokenBucket] = dict()
+        self._pending: Dict[int, Deque[OutboundMessage]] = dict()
+        self._ready: asyncio.Queue = asyncio.Queue()
+        self._workers: List[asyncio.Task] = []
+        self._latencies: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self._sent = 0
+        self._failed = 0
+        self._retries = 0
+
+    def start(self) -> None:
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self.max_concurrency)]
+
+    async def stop(self) -> None:
+        """Waits for the queued messages to be sent and stops the workers."""
+        await self._ready.join()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def enqueue(self, chat_id: int, method: str, **kwargs) -> asyncio.Future:
+        """Schedules `bot.<method>(chat_id=chat_id, **kwargs)`, the future resolves to its result."""
+        message = OutboundMessage(chat_id=chat_id,
+                                  method=method,
+                                  kwargs=kwargs,
+                                  future=asyncio.get_running_loop().create_future(),
+                                  enqueued_at=self._clock())
+        pending = self._pending.get(chat_id)
+        if pending is None:
+            # the chat is not handled by any worker yet
+            self._pending[chat_id] = deque([message])
+            self._ready.put_nowait(chat_id)
+        else:
+            pending.append(message)
+        return message.future
+
+    def send_message(self, chat_id: int, text: str, **kwargs) -> asyncio.Future:
+        return self.enqueue(chat_id, "send_message", text=text, **kwargs)
+
+    def send_photo(self, chat_id: int, photo: str, **kwargs) -> asyncio.Future:
+        return self.enqueue(chat_id, "send_photo", photo=photo, **kwargs)
+
+    def queue_depth(self) -> int:
+        return sum(len(pending) for pending in self._pending.values())
+
+    def stats(self) -> SenderStats:
+        latencies = sorted(self._latencies)
+        p50 = p95 = None
+        if len(latencies) >= 2:
+            percentiles = statistics.quantiles(latencies, n=100)
+            p50, p95 = percentiles[49], percentiles[94]
+        elif latencies:
+            p50 = p95 = latencies[0]
+        return SenderStats(queue_depth=self.queue_depth(),
+                           sent=self._sent,
+                           failed=self._failed,
+                           retries=self._retries,
+                           latency_p50=p50,
+                           latency_p95=p95)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst, self._clock)
+        return bucket
+
+    def _next_batch(self, pending: Deque[OutboundMessage]) -> List[OutboundMessage]:
+        batch = [pending.popleft()]
+        if batch[0].can_join_media_group():
+            while pending and len(batch) < MAX_MEDIA_GROUP_SIZE and pending[0].can_join_media_group():
+                batch.append(pending.popleft())
+        return batch
+
+    async def _work(self) -> None:
+        while True:
+            chat_id = await self._ready.get()
+            try:
+                pending = self._pending[chat_id]
+                batch = self._next_batch(pending)
+                await self._send(chat_id, batch)
+            finally:
+                if pending:
+                    self._ready.put_nowait(chat_id)
+                else:
+                    del self._pending[chat_id]
+                    if self._chat_bucket(chat_id).delay(self.chat_burst) == 0:
+                        # a full bucket holds no state worth keeping
+                        del self._chat_buckets[chat_id]
+                self._ready.task_done()
+
+    async def _acquire(self, chat_id: int, tokens: int) -> None:
+        """Waits for `tokens` of the global bucket and of the bucket of the chat, one per message of a media group.
+
+        A media group larger than the burst of the chat waits for a full bucket and leaves it in debt,
+        so the next messages of the chat wait for the rest.
+        """
+        chat_bucket = self._chat_bucket(chat_id)
+        chat_tokens = min(tokens, chat_bucket.capacity)
+        while True:
+            wait = max(chat_bucket.delay(chat_tokens), self._global_bucket.delay(tokens))
+            if wait == 0:
+                chat_bucket.reserve(tokens)
+                self._global_bucket.try_acquire(tokens)
+                return
+            await asyncio.sleep(wait)
+
+    async def _send(self, chat_id: int, batch: List[OutboundMessage]) -> None:
+        while True:
+            await self._acquire(chat_id, len(batch))
+            try:
+                if len(batch) == 1:
+                    message = batch[0]
+                    results = [await getattr(self.bot, message.method)(chat_id=chat_id, **message.kwargs)]
+                else:
+                    media = [InputMediaPhoto(media=message.kwargs["photo"],
+                                             caption=message.kwargs.get("caption"),
+                                             parse_mode=message.kwargs.get("parse_mode"))
+                             for message in batch]
+                    results = list(await self.bot.send_media_group(chat_id=chat_id, media=media))
+            except RetryAfter as e:
+                self._retries += 1
+                logger.warning(f"Flood limit hit for chat {chat_id}, retrying in {e.retry_after}s")
+                await asyncio.sleep(e.retry_after)
+                continue
+            except Exception as e:
+                self._failed += len(batch)
+                logger.error(f"Sending {batch[0].method} to chat {chat_id} failed: {e}")
+                for message in batch:
+                    if not message.future.done():
+                        message.future.set_exception(e)
+                        # nobody is obliged to await the future, the error is logged above
+                        message.future.exception()
+                return
+            break
+
+        now = self._clock()
+        for message, result in zip(batch, results):
+            self._sent += 1
+            self._latencies.append(now - message.enqueued_at)
+            SEND_LATENCY.observe(now - message.enqueued_at)
+            if not message.future.done():
+                message.future.set_result(result)
@@ -0,0 +1,107 @@
+import asyncio
+import time
+from typing import List, Tuple
+
+from telegram.error import RetryAfter
+
+import metrics
+from sender import OutboundScheduler, TokenBucket
+
+
+class FakeBot:
+    def __init__(self, fail_first_with_retry_after: bool = False):
+        self.calls: List[Tuple[float, str, int, dict]] = []
+        self.fail_first_with_retry_after = fail_first_with_retry_after
+
+    async def _call(self, method: str, chat_id: int, **kwargs):
+        if self.fail_first_with_retry_after:
+            self.fail_first_with_retry_after = False
+            raise RetryAfter(0)
+        self.calls.append((time.monotonic(), method, chat_id, kwargs))
+        await asyncio.sleep(0.01)
+        return f"{method}:{chat_id}:{len(self.calls)}"
+
+    async def send_message(self, chat_id: int, **kwargs):
+        return await self._call("send_message", chat_id, **kwargs)
+
+    async def send_photo(self, chat_id: int, **kwargs):
+        return await self._call("send_photo", chat_id, **kwargs)
+
+    async def send_media_group(self, chat_id: int, media):
+        await self._call("send_media_group", chat_id, media=media)
+        return [f"photo:{chat_id}:{i}" for i in range(len(media))]
+
+
+def test_token_bucket() -> None:
+    now = [0.0]
+    bucket = TokenBucket(rate=2, capacity=2, clock=lambda: now[0])
+    assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() == 0.5
+    now[0] = 0.5
+    assert bucket.try_acquire() == 0
+
+
+def test_photos_are_coalesced_and_chat_order_is_kept() -> None:
+    bot = FakeBot()
+
+    async def scenario():
+        outbox = OutboundScheduler(bot, chat_rate=100, chat_burst=100)
+        outbox.start()
+        futures = [outbox.send_message(1, "header"),
+                   *(outbox.send_photo(1, f"photo{i}", caption=f"#{i}") for i in range(3)),
+                   outbox.send_message(1, "footer")]
+        results = await asyncio.gather(*futures)
+        await outbox.stop()
+        return results, outbox.stats()
+
+    results, stats = asyncio.run(scenario())
+
+    assert [call[1] for call in bot.calls] == ["send_message", "send_media_group", "send_message"]
+    assert [media.media for media in bot.calls[1][3]["media"]] == ["photo0", "photo1", "photo2"]
+    assert results[1:4] == ["photo:1:0", "photo:1:1", "photo:1:2"]
+    assert stats.sent == 5 and stats.queue_depth == 0
+
+
+def test_rate_limits_and_retry_after() -> None:
+    bot = FakeBot(fail_first_with_retry_after=True)
+
+    async def scenario():
+        outbox = OutboundScheduler(bot, global_rate=1000, chat_rate=10, chat_burst=1)
+        outbox.start()
+        started = time.monotonic()
+        await asyncio.gather(*(outbox.send_message(chat_id, str(i)) for i in range(5) for chat_id in (1, 2)))
+        elapsed = time.monotonic() - started
+        await outbox.stop()
+        return elapsed, outbox.stats()
+
+    elapsed, stats = asyncio.run(scenario())
+
+    # five messages per chat at 10/s without burst, both chats in parallel
+    assert 0.35 < elapsed < 1.0
+    assert stats.retries == 1 and stats.sent == 10
+    for chat_id in (1, 2):
+        texts = [call[3]["text"] for call in bot.calls if call[2] == chat_id]
+        assert texts == [str(i) for i in range(5)]
+
+
+def test_every_photo_of_a_media_group_counts_towards_the_chat_limit() -> None:
+    bot = FakeBot()
+    latency = metrics.REGISTRY.get("wishlist_outbox_send_latency_seconds").labels()
+    observed = latency.snapshot()[0][-1]
+
+    async def scenario():
+        outbox = OutboundScheduler(bot, global_rate=1000, chat_rate=10, chat_burst=3)
+        outbox.start()
+        started = time.monotonic()
+        await asyncio.gather(*(outbox.send_photo(1, f"photo{i}") for i in range(5)), outbox.send_message(1, "footer"))
+        elapsed = time.monotonic() - started
+        await outbox.stop()
+        return elapsed
+
+    elapsed = asyncio.run(scenario())
+
+    assert [call[1] for call in bot.calls] == ["send_media_group", "send_message"]
+    # the burst of 3 covers three photos, the two others and the footer wait for 3 tokens at 10/s
+    assert 0.25 < elapsed < 1.0
+    assert latency.snapshot()[0][-1] == observed + 6
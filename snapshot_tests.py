@@ -0,0 +1,179 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import pytest
+
+from db import WISH_CHANGELOG_SIZE, WishSnapshot, Wish, book_wish, configure_snapshot, create_tables_dict, db_ops, \
+    get_pool
+
+
+def names(wish: Wish, creator_id: int, booked: bool = False):
+    return [row[4] for row in wish.search_by_creator_and_booked_value(creator_id, booked)]
+
+
+def count_file_reads(monkeypatch, db_path: str):
+    pool = get_pool(db_path)
+    reads = [0]
+    reader = pool.reader
+
+    @contextmanager
+    def counting_reader():
+        reads[0] += 1
+        with reader() as conn:
+            yield conn
+
+    monkeypatch.setattr(pool, "reader", counting_reader)
+    return reads
+
+
+def test_snapshot_sees_the_writes_of_this_process(tmp_path, monkeypatch) -> None:
+    db_path = str(tmp_path / "snapshot.db")
+    create_tables_dict(db_path)
+    wish = Wish(db_path)
+    wish.add(creator_id=1, creator_name="alice", name="bike")
+    snapshot = configure_snapshot(db_path, max_staleness=60)
+    try:
+        reads = count_file_reads(monkeypatch, db_path)
+        assert names(wish, 1) == ["bike"]
+        assert names(wish, 1) == ["bike"]
+        assert [row[4] for row in wish.search_page(1)] == ["bike"]
+        assert (reads[0], snapshot.full_copies, snapshot.refreshes) == (1, 1, 0)
+
+        wish.add(creator_id=1, creator_name="alice", name="car", priority=1)
+        assert names(wish, 1) == ["car", "bike"]
+        book_wish(1, 2, "bob", db_path)
+        wish.change_booked(2, True)
+        assert names(wish, 1) == []
+        assert names(wish, 1, booked=True) == ["car", "bike"]
+        assert (snapshot.full_copies, snapshot.refreshes) == (1, 2)
+    finally:
+        configure_snapshot(db_path, max_staleness=None)
+    assert names(wish, 1, booked=True) == ["car", "bike"]
+
+
+def test_commits_of_other_processes_show_within_the_staleness(tmp_path) -> None:
+    db_path = str(tmp_path / "staleness.db")
+    create_tables_dict(db_path)
+    wish = Wish(db_path)
+    wish.add(creator_id=1, creator_name="alice", name="bike")
+    now = [0.0]
+    snapshot = WishSnapshot(db_path, max_staleness=5, clock=lambda: now[0])
+
+    def snapshot_names():
+        with snapshot.cursor() as cur:
+            return [row[0] for row in cur.execute("SELECT name FROM wish WHERE creator_id = 1 ORDER BY wish_id")]
+
+    assert snapshot_names() == ["bike"]
+    other = sqlite3.connect(db_path, isolation_level=None)
+    other.execute("UPDATE wish SET name = 'car'")
+    other.execute("INSERT INTO wish(booked, presented, creator_name, name, creator_id) "
+                  "VALUES (0, 0, 'alice', 'kite', 1)")
+    other.close()
+    now[0] = 5.0
+    assert snapshot_names() == ["bike"]
+    now[0] = 5.5
+    assert snapshot_names() == ["car", "kite"]
+
+    # behind the trimmed part of the log, the snapshot is copied anew
+    with db_ops(db_path) as cur:
+        cur.execute("UPDATE wish SET name = 'boat' WHERE name = 'car'")
+        cur.execute("DELETE FROM wish_changelog")
+        cur.execute("UPDATE wish SET name = 'sled' WHERE name = 'kite'")
+    snapshot.mark_stale()
+    assert snapshot_names() == ["boat", "sled"]
+    assert (snapshot.full_copies, snapshot.refreshes) == (2, 1)
+    snapshot.close()
+
+
+def test_snapshot_copies_the_wish_table_and_serves_readers_while_catching_up(tmp_path) -> None:
+    db_path = str(tmp_path / "concurrent.db")
+    create_tables_dict(db_path)
+    wish = Wish(db_path)
+    wish.add(creator_id=1, creator_name="alice", name="bike")
+    snapshot = WishSnapshot(db_path, max_staleness=60)
+
+    def snapshot_names():
+        with snapshot.cursor() as cur:
+            return [row[0] for row in cur.execute("SELECT name FROM wish WHERE creator_id = 1 ORDER BY wish_id")]
+
+    with snapshot.cursor() as cur:
+        tables = {name for name, in cur.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        indexes = {name for name, in cur.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        assert tables <= {"wish", "sqlite_sequence"}
+        assert {"wish_creator_id_booked_priority", "wish_creator_id_booked_price"} <= indexes
+
+        # a read in progress keeps neither other readers nor the catching up of the other copy waiting
+        rows = cur.execute("SELECT name FROM wish")
+        wish.add(creator_id=1, creator_name="alice", name="car")
+        snapshot.mark_stale()
+        other = []
+        reader = threading.Thread(target=lambda: other.append(snapshot_names()))
+        reader.start()
+        reader.join(timeout=5)
+        assert other == [["bike", "car"]]
+        assert [name for name, in rows] == ["bike"]
+    assert (snapshot.full_copies, snapshot.refreshes) == (1, 1)
+    snapshot.close()
+
+
+class FailingOnce:
+    """Connection whose first `executemany` fails."""
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+        self.failed = False
+
+    def executemany(self, *args):
+        if not self.failed:
+            self.failed = True
+            raise sqlite3.OperationalError("disk I/O error")
+        return self.connection.executemany(*args)
+
+    def __getattr__(self, name: str):
+        return getattr(self.connection, name)
+
+
+def test_changes_failing_to_apply_are_applied_by_the_next_read(tmp_path) -> None:
+    db_path = str(tmp_path / "failing.db")
+    create_tables_dict(db_path)
+    wish = Wish(db_path)
+    wish.add(creator_id=1, creator_name="alice", name="bike")
+    snapshot = WishSnapshot(db_path, max_staleness=60)
+
+    def snapshot_names():
+        with snapshot.cursor() as cur:
+            return [row[0] for row in cur.execute("SELECT name FROM wish WHERE creator_id = 1 ORDER BY wish_id")]
+
+    assert snapshot_names() == ["bike"]
+    wish.add(creator_id=1, creator_name="alice", name="car")
+    snapshot.mark_stale()
+    assert snapshot_names() == ["bike", "car"]
+
+    # both copies were made, the next one to catch up fails to apply the change
+    spare = 1 - snapshot._current
+    snapshot._copies[spare] = FailingOnce(snapshot._copies[spare])
+    wish.add(creator_id=1, creator_name="alice", name="kite")
+    snapshot.mark_stale()
+    with pytest.raises(sqlite3.OperationalError):
+        snapshot_names()
+    assert snapshot_names() == ["bike", "car", "kite"]
+    snapshot.close()
+
+
+def test_change_log_is_bounded_and_only_kept_for_snapshots(tmp_path) -> None:
+    db_path = str(tmp_path / "changelog.db")
+    create_tables_dict(db_path)
+    Wish(db_path).add(creator_id=1, creator_name="a", name="unlogged")
+    configure_snapshot(db_path, max_staleness=60)
+    with db_ops(db_path) as cur:
+        cur.executemany("INSERT INTO wish(booked, presented, creator_name, name, creator_id) VALUES (0, 0, 'a', ?, 1)",
+                        [(f"wish {i}",) for i in range(WISH_CHANGELOG_SIZE + 100)])
+        assert cur.execute("SELECT count(*), min(seq), max(seq) FROM wish_changelog").fetchone() == \
+               (WISH_CHANGELOG_SIZE, 101, WISH_CHANGELOG_SIZE + 100)
+
+    configure_snapshot(db_path, max_staleness=None)
+    Wish(db_path).add(creator_id=1, creator_name="a", name="unlogged")
+    with db_ops(db_path, readonly=True) as cur:
+        assert cur.execute("SELECT count(*) FROM wish_changelog").fetchone()[0] == 0
+        assert cur.execute("SELECT count(*) FROM sqlite_master WHERE name LIKE 'wish_changelog_%'").fetchone()[0] == 0
@@ -0,0 +1,335 @@
+from __future__ import annotations
+
+import dataclasses
+import json
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from enum import Enum
+from typing import Any, Callable, Dict, Generic, Hashable, Iterator, List, Optional, Tuple, TypeVar
+
+from db import DB_PATH, db_ops
+from wishdata import BookingsPage, FeedPage, PhotoVariant, SearchPage, WishData, WishOrder, WishPage
+
+logger = logging.getLogger(__name__)
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+STATE_TABLE = "conversation_state"
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+DEFAULT_MAX_ENTRIES = 10_000
+FLUSH_BATCH_SIZE = 100
+FLUSH_INTERVAL_SECONDS = 2.0
+# classes of the values kept in state stores, persisted as JSON objects tagged with the class name
+STATE_TYPES: Dict[str, type] = {cls.__name__: cls for cls in (WishData, PhotoVariant, WishPage, SearchPage, FeedPage,
+                                                              BookingsPage, WishOrder)}
+
+
+def encode_state(value: Any) -> Any:
+    """Turns `value` into JSON types. A dataclass becomes an object of its fields, so values stored before
+    a field was added or removed still decode."""
+    if dataclasses.is_dataclass(value):
+        return {"__type__": type(value).__name__,
+                **{field.name: encode_state(getattr(value, field.name)) for field in dataclasses.fields(value)}}
+    if isinstance(value, Enum):
+        return {"__type__": type(value).__name__, "value": value.value}
+    # JSON object keys are strings only
+    if isinstance(value, dict):
+        return {"__type__": "dict", "items": [[encode_state(key), encode_state(item)] for key, item in value.items()]}
+    if isinstance(value, tuple):
+        return {"__type__": "tuple", "items": [encode_state(item) for item in value]}
+    if isinstance(value, list):
+        return [encode_state(item) for item in value]
+    return value
+
+
+def decode_state(value: Any) -> Any:
+    """Inverse of `encode_state`, fields a class does not have anymore are dropped, new ones get their default."""
+    if isinstance(value, list):
+        return [decode_state(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    type_name = value["__type__"]
+    if type_name == "dict":
+        return {decode_state(key): decode_state(item) for key, item in value["items"]}
+    if type_name == "tuple":
+        return tuple(decode_state(item) for item in value["items"])
+    cls = STATE_TYPES[type_name]
+    if issubclass(cls, Enum):
+        return cls(value["value"])
+    names = {field.name for field in dataclasses.fields(cls)}
+    return cls(**{name: decode_state(item) for name, item in value.items() if name in names})
+
+
+def dumps_state(value: Any) -> str:
+    return json.dumps(encode_state(value), separators=(",", ":"))
+
+
+def loads_state(text: str) -> Any:
+    return decode_state(json.loads(text))
+
+
+class StateStore(ABC, Generic[K, V]):
+    """Dict-like storage of per-user conversation state.
+
+    Values are not watched for changes: a mutated value has to be stored again to be persisted.
+    """
+
+    @abstractmethod
+    def get(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        pass
+
+    @abstractmethod
+    def set(self, key: K, value: V, ttl: Optional[float] = None) -> None:
+        pass
+
+    @abstractmethod
+    def pop(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        pass
+
+    @abstractmethod
+    def __len__(self) -> int:
+        pass
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.flush()
+
+    def __getitem__(self, key: K) -> V:
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: K, value: V) -> None:
+        self.set(key, value)
+
+    def __delitem__(self, key: K) -> None:
+        if self.pop(key) is None:
+            raise KeyError(key)
+
+    def __contains__(self, key: K) -> bool:
+        return self.get(key) is not None
+
+    def setdefault(self, key: K, default: V) -> V:
+        value = self.get(key)
+        if value is None:
+            self.set(key, default)
+            value = default
+        return value
+
+
+class MemoryStateStore(StateStore[K, V]):
+    """Keeps at most `max_entries` entries, evicting the least recently used one; entries expire after `ttl` seconds."""
+
+    def __init__(self,
+                 ttl: float = DEFAULT_TTL_SECONDS,
+                 max_entries: int = DEFAULT_MAX_ENTRIES,
+                 clock: Callable[[], float] = time.time,
+                 ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._clock = clock
+        self._entries: OrderedDict[K, Tuple[float, V]] = OrderedDict()
+        self._lock = threading.RLock()
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at <= self._clock():
+                del self._entries[key]
+                self.expirations += 1
+                self._removed(key)
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: K, value: V, ttl: Optional[float] = None) -> None:
+        with self._lock:
+            self._store(key, value, self._clock() + (self.ttl if ttl is None else ttl))
+            self._changed(key)
+            while len(self._entries) > self.max_entries:
+                evicted, _ = self._entries.popitem(last=False)
+                self.evictions += 1
+                self._removed(evicted)
+        self._written()
+
+    def _store(self, key: K, value: V, expires_at: float) -> None:
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+
+    def pop(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        with self._lock:
+            value = self.get(key)
+            if value is None:
+                return default
+            del self._entries[key]
+            self._removed(key)
+            return value
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[K]:
+        return iter(list(self._entries))
+
+    def _changed(self, key: K) -> None:
+        pass
+
+    def _removed(self, key: K) -> None:
+        pass
+
+    def _written(self) -> None:
+        pass
+
+
+class SqliteStateStore(MemoryStateStore[K, V]):
+    """`MemoryStateStore` that survives restarts.
+
+    Changes are written behind in batches: once `flush_batch_size` keys are dirty, every `flush_interval` seconds
+    and on `close`, so in-flight drafts are persisted without a write per message. Batches are written by
+    the flusher thread, the thread storing a value only waits for SQLite when there is no flusher.
+    Keys and values are stored as JSON, see `encode_state` for the types they may be made of.
+    """
+
+    def __init__(self,
+                 name: str,
+                 db_path: str = DB_PATH,
+                 ttl: float = DEFAULT_TTL_SECONDS,
+                 max_entries: int = DEFAULT_MAX_ENTRIES,
+                 flush_batch_size: int = FLUSH_BATCH_SIZE,
+                 flush_interval: float = FLUSH_INTERVAL_SECONDS,
+                 clock: Callable[[], float] = time.time,
+                 ):
+        super().__init__(ttl, max_entries, clock)
+        self.name = name
+        self.db_path = db_path
+        self.flush_batch_size = flush_batch_size
+        # key -> True if it has to be written, False if it has to be deleted
+        self._dirty: Dict[K, bool] = dict()
+        self._flush_lock = threading.Lock()
+        self._flush_requested = threading.Event()
+        self._closed = threading.Event()
+
+        with db_ops(db_path) as cur:
+            cur.execute(
+                f"""CREATE TABLE IF NOT EXISTS {STATE_TABLE}
+                    (
+                        store TEXT NOT NULL,
+                        key BLOB NOT NULL,
+                        value BLOB NOT NULL,
+                        expires_at REAL NOT NULL,
+                        PRIMARY KEY(store, key)
+                    )"""
+            )
+        self._load()
+
+        self._flusher: Optional[threading.Thread] = None
+        if flush_interval > 0:
+            self._flusher = threading.Thread(target=self._flush_periodically,
+                                             args=(flush_interval,),
+                                             name=f"state-store-{name}",
+                                             daemon=True)
+            self._flusher.start()
+
+    def _load(self) -> None:
+        with db_ops(self.db_path, readonly=True) as cur:
+            rows = list(cur.execute(
+                f"""
+                SELECT key, value, expires_at FROM {STATE_TABLE}
+                WHERE store = ? AND expires_at > ?
+                ORDER BY expires_at DESC
+                LIMIT ?
+                """, [self.name, self._clock(), self.max_entries]
+            ))
+        restored = 0
+        with self._lock:
+            for key, value, expires_at in reversed(rows):
+                try:
+                    self._store(loads_state(key), loads_state(value), expires_at)
+                    restored += 1
+                except (ValueError, KeyError, TypeError) as e:
+                    logger.warning(f"Dropped an entry of state store {self.name} that does not decode: {e}")
+        logger.info(f"Restored {restored} entries of state store {self.name}")
+
+    def _changed(self, key: K) -> None:
+        self._dirty[key] = True
+
+    def _removed(self, key: K) -> None:
+        self._dirty[key] = False
+
+    def _written(self) -> None:
+        if len(self._dirty) >= self.flush_batch_size:
+            if self._flusher is not None:
+                self._flush_requested.set()
+            else:
+                self.flush()
+
+    def flush(self) -> None:
+        with self._flush_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, dict()
+                upserts = [(self.name, dumps_state(key), dumps_state(self._entries[key][1]), self._entries[key][0])
+                           for key, present in dirty.items() if present and key in self._entries]
+                deletes = [(self.name, dumps_state(key)) for key, present in dirty.items() if not present]
+            if not upserts and not deletes:
+                return
+            try:
+                self._write(upserts, deletes)
+            except Exception:
+                with self._lock:
+                    self._dirty = {**dirty, **self._dirty}
+                raise
+
+    def _write(self, upserts: List[Tuple], deletes: List[Tuple]) -> None:
+        with db_ops(self.db_path) as cur:
+            cur.executemany(
+                f"""
+                INSERT OR REPLACE INTO {STATE_TABLE} VALUES
+                    (?, ?, ?, ?)
+                """, upserts
+            )
+            cur.executemany(f"DELETE FROM {STATE_TABLE} WHERE store = ? AND key = ?", deletes)
+            cur.execute(f"DELETE FROM {STATE_TABLE} WHERE store = ? AND expires_at <= ?",
+                        [self.name, self._clock()])
+
+    def _flush_periodically(self, interval: float) -> None:
+        while True:
+            self._flush_requested.wait(interval)
+            self._flush_requested.clear()
+            if self._closed.is_set():
+                return
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Flushing state store {self.name} failed: {e}")
+
+    def close(self) -> None:
+        self._closed.set()
+        self._flush_requested.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+
+
+def make_state_store(name: str,
+                     backend: str = "memory",
+                     ttl: float = DEFAULT_TTL_SECONDS,
+                     max_entries: int = DEFAULT_MAX_ENTRIES,
+                     db_path: str = DB_PATH,
+                     ) -> StateStore:
+    if backend == "memory":
+        return MemoryStateStore(ttl, max_entries)
+    elif backend == "sqlite":
+        return SqliteStateStore(name, db_path, ttl, max_entries)
+    raise ValueError(f"Unknown state store backend: {backend}")
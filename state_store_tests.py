@@ -0,0 +1,116 @@
+import json
+import pickle
+import threading
+
+from db import db_ops
+from state_store import MemoryStateStore, SqliteStateStore, STATE_TABLE
+from wishdata import BookingsPage, PhotoVariant, WishData, WishOrder, WishPage
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_memory_store_ttl_and_lru_cap() -> None:
+    clock = FakeClock()
+    store = MemoryStateStore(ttl=10, max_entries=2, clock=clock)
+
+    store[1] = "a"
+    store[2] = "b"
+    assert store[1] == "a"
+    store[3] = "c"
+    assert 2 not in store
+    assert len(store) == 2
+
+    store.set(4, "d", ttl=100)
+    clock.now += 50
+    assert store.get(3) is None
+    assert store[4] == "d"
+    assert (store.evictions, store.expirations) == (2, 1)
+
+
+def test_sqlite_store_persists_drafts_in_batches(tmp_path) -> None:
+    db_path = str(tmp_path / "state.db")
+    clock = FakeClock()
+    store = SqliteStateStore("drafts", db_path, ttl=60, flush_batch_size=3, flush_interval=0, clock=clock)
+
+    def stored_rows() -> int:
+        with db_ops(db_path, readonly=True) as cur:
+            return cur.execute(f"SELECT count(*) FROM {STATE_TABLE}").fetchone()[0]
+
+    draft = WishData(creator_name="alice", booked=False, presented=False, name="bike")
+    store[1] = draft
+    draft.price = "100"
+    store[1] = draft
+    store[2] = WishData(creator_name="bob", booked=False, presented=False)
+    assert stored_rows() == 0
+    store[3] = WishData(creator_name="carol", booked=False, presented=False)
+    assert stored_rows() == 3
+
+    del store[3]
+    store.close()
+    assert stored_rows() == 2
+
+    restored = SqliteStateStore("drafts", db_path, ttl=60, flush_interval=0, clock=clock)
+    assert restored[1] == draft
+    assert 3 not in restored
+
+    clock.now += 61
+    restored = SqliteStateStore("drafts", db_path, ttl=60, flush_interval=0, clock=clock)
+    assert len(restored) == 0
+
+
+def test_full_batches_are_written_by_the_flusher_thread(tmp_path) -> None:
+    db_path = str(tmp_path / "flusher.db")
+    store = SqliteStateStore("pages", db_path, flush_batch_size=2, flush_interval=60)
+    written = threading.Event()
+    writers = []
+    write = store._write
+
+    def recording_write(upserts, deletes) -> None:
+        writers.append(threading.current_thread().name)
+        write(upserts, deletes)
+        written.set()
+
+    store._write = recording_write
+    store[1] = "a"
+    store[2] = "b"
+    assert written.wait(timeout=5)
+    assert writers == ["state-store-pages"]
+    store.close()
+    with db_ops(db_path, readonly=True) as cur:
+        assert cur.execute(f"SELECT count(*) FROM {STATE_TABLE}").fetchone()[0] == 2
+
+
+def test_values_are_stored_as_json_across_field_changes(tmp_path) -> None:
+    db_path = str(tmp_path / "json.db")
+    wish = WishData(creator_name="alice", booked=False, presented=False, wish_id=3, name="bike",
+                    photo_variants=[PhotoVariant("u", "f", 90, 90)])
+    values = {
+        "page": WishPage(creator_id=2, creator_name="alice", number=1, first_number=11, wishes=[wish], has_next=False,
+                         order=WishOrder.PRICE, max_price=20.0),
+        "bookings": BookingsPage(number=0, first_number=1, bookings=[(1700, wish)], has_next=True),
+        "numbers": {11: 3, 12: 5},
+    }
+    store = SqliteStateStore("values", db_path, flush_interval=0)
+    for key, value in values.items():
+        store[key] = value
+    store.close()
+
+    with db_ops(db_path) as cur:
+        key, value = cur.execute(f"SELECT key, value FROM {STATE_TABLE} WHERE key = '\"page\"'").fetchone()
+        page = json.loads(value)
+        # stored before a field was added and after one was removed
+        del page["wishes"][0]["photo_unique_id"]
+        page["wishes"][0]["gone"] = 1
+        cur.execute(f"UPDATE {STATE_TABLE} SET value = ? WHERE key = ?", [json.dumps(page), key])
+        cur.execute(f"INSERT INTO {STATE_TABLE} VALUES ('values', ?, ?, 1e12)",
+                    [pickle.dumps("old"), pickle.dumps(wish)])
+
+    restored = SqliteStateStore("values", db_path, flush_interval=0)
+    assert len(restored) == 3
+    assert {key: restored[key] for key in values} == values
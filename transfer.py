@@ -0,0 +1,220 @@
+from __future__ import annotations
+
+import csv
+import io
+import itertools
+import json
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+from db import DB_PATH, BookedArchive, TableName, Wish, current_time_in_ms_since_1970, db_ops
+from wishdata import WishData
+
+T = TypeVar("T")
+
+IMPORT_BATCH_SIZE = 1000
+EXPORT_FETCH_SIZE = 1000
+
+WISH_FIELDS = ["wish_id", "name", "priority", "relation_type", "link", "price", "photo_id", "desc", "quantity",
+               "booked", "presented"]
+BOOKING_FIELDS = ["presenter_name", "date"]
+# one row per booking, a wish without bookings takes a single row with empty booking fields
+CSV_FIELDS = WISH_FIELDS + BOOKING_FIELDS
+
+
+class TransferFormat(Enum):
+    """File formats of exported wishlists, which also carry the booking history."""
+    CSV = "csv"
+    # one JSON object per line and per wish, bookings nested in a list
+    JSON = "json"
+
+    @staticmethod
+    def from_file_name(file_name: str) -> TransferFormat:
+        extension = file_name.rsplit(".", 1)[-1].lower()
+        if extension == "csv":
+            return TransferFormat.CSV
+        if extension in ("json", "jsonl", "ndjson"):
+            return TransferFormat.JSON
+        raise ValueError(f"Unsupported file type: {file_name}")
+
+
+@dataclass
+class WishRecord:
+    wish: WishData
+    # (presenter_name, date)
+    bookings: List[Tuple[str, int]] = field(default_factory=list)
+
+
+@dataclass
+class ImportResult:
+    wishes: int = 0
+    bookings: int = 0
+
+
+def iter_wishlist(creator_id: int, db_path: str = DB_PATH) -> Iterator[WishRecord]:
+    """Wishes of `creator_id` with their current and archived bookings, in `wish_id` order, read `EXPORT_FETCH_SIZE`
+    rows at a time.
+
+    The whole export reads a single snapshot, a pooled reader connection is held until the generator is exhausted.
+    """
+    with db_ops(db_path, readonly=True) as cur:
+        # a wish without current bookings takes a row with empty booking fields
+        cur.execute(
+            f"""
+            SELECT w.*, b.presenter_name, b.date AS booking_date FROM {TableName.WISH.value} w
+            LEFT JOIN {TableName.BOOKED.value} b ON b.wish_id = w.wish_id
+            WHERE w.creator_id = ?
+            UNION ALL
+            SELECT w.*, a.presenter_name, a.date FROM {TableName.WISH.value} w
+            JOIN {TableName.BOOKED_ARCHIVE.value} a ON a.wish_id = w.wish_id
+            WHERE w.creator_id = ?
+            ORDER BY wish_id, booking_date
+            """, [creator_id, creator_id]
+        )
+        rows = itertools.chain.from_iterable(iter(lambda: cur.fetchmany(EXPORT_FETCH_SIZE), []))
+        for _, wish_rows in itertools.groupby(rows, key=lambda row: row[0]):
+            wish_rows = list(wish_rows)
+            yield WishRecord(wish=WishData.row_factory(cur, wish_rows[0][:-2]),
+                             bookings=[(row[-2], row[-1]) for row in wish_rows if row[-2] is not None])
+
+
+def _wish_fields(wish: WishData) -> Dict[str, Any]:
+    return {name: getattr(wish, name) for name in WISH_FIELDS}
+
+
+def export_wishlist(creator_id: int, transfer_format: TransferFormat, db_path: str = DB_PATH) -> Iterator[str]:
+    """Yields the wishlist of `creator_id` line by line, memory use does not grow with its length."""
+    if transfer_format == TransferFormat.JSON:
+        for record in iter_wishlist(creator_id, db_path):
+            document = _wish_fields(record.wish)
+            document["bookings"] = [dict(zip(BOOKING_FIELDS, booking)) for booking in record.bookings]
+            yield json.dumps(document, ensure_ascii=False) + "\n"
+        return
+
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=CSV_FIELDS, lineterminator="\n")
+
+    def flush() -> str:
+        line = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return line
+
+    writer.writeheader()
+    yield flush()
+    for record in iter_wishlist(creator_id, db_path):
+        fields = _wish_fields(record.wish)
+        for booking in record.bookings or [(None, None)]:
+            writer.writerow({**fields, **dict(zip(BOOKING_FIELDS, booking))})
+            yield flush()
+
+
+def _optional(value: Any, convert: Callable[[Any], T] = str) -> Optional[T]:
+    if value is None or value == "":
+        return None
+    return convert(value)
+
+
+def _flag(value: Any) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes")
+    return bool(value)
+
+
+def _price(value: Any) -> Any:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return str(value)
+
+
+def _record(creator_id: int,
+            creator_name: str,
+            fields: Dict[str, Any],
+            bookings: List[Tuple[str, int]],
+            number: int,
+            ) -> WishRecord:
+    name = _optional(fields.get("name"))
+    if name is None:
+        raise ValueError(f"Wish #{number} has no name")
+    return WishRecord(
+        wish=WishData(creator_id=creator_id,
+                      creator_name=creator_name,
+                      booked=_flag(fields.get("booked")) or bool(bookings),
+                      presented=_flag(fields.get("presented")),
+                      name=name,
+                      priority=_optional(fields.get("priority"), int),
+                      relation_type=_optional(fields.get("relation_type")),
+                      link=_optional(fields.get("link")),
+                      price=_optional(fields.get("price"), _price),
+                      photo_id=_optional(fields.get("photo_id")),
+                      desc=_optional(fields.get("desc")),
+                      quantity=_optional(fields.get("quantity"), int)),
+        bookings=bookings,
+    )
+
+
+def parse_wishlist(creator_id: int,
+                   creator_name: str,
+                   lines: Iterable[str],
+                   transfer_format: TransferFormat,
+                   ) -> Iterator[WishRecord]:
+    """Lazily parses an exported wishlist, every wish is assigned to `creator_id`."""
+    number = itertools.count(1)
+    if transfer_format == TransferFormat.JSON:
+        for line in lines:
+            if not line.strip():
+                continue
+            document = json.loads(line)
+            bookings = [(str(booking["presenter_name"]), int(booking["date"]))
+                        for booking in document.get("bookings") or []]
+            yield _record(creator_id, creator_name, document, bookings, next(number))
+        return
+
+    rows = csv.DictReader(lines)
+    if rows.fieldnames is None or "name" not in rows.fieldnames:
+        raise ValueError("The CSV header has no name column")
+    # rows of one wish share its exported wish_id, rows without one are wishes of their own
+    for _, wish_rows in itertools.groupby(rows, key=lambda row: row.get("wish_id") or object()):
+        wish_rows = list(wish_rows)
+        bookings = [(row["presenter_name"], int(row["date"])) for row in wish_rows if row.get("presenter_name")]
+        yield _record(creator_id, creator_name, wish_rows[0], bookings, next(number))
+
+
+def insert_records(records: List[WishRecord], db_path: str = DB_PATH) -> ImportResult:
+    """Inserts a batch of records in one transaction.
+
+    Presenters are only named in exports, and anyone can write a file naming anyone. Their bookings are kept
+    as history in the booking archive without a presenter id, so they show in nobody's bookings.
+    """
+    with db_ops(db_path):
+        wish_ids = Wish(db_path).add_many(record.wish for record in records)
+        archived = current_time_in_ms_since_1970()
+        bookings = [(wish_id, record.wish.creator_name, presenter_name, date, record.wish.creator_id, None, archived)
+                    for wish_id, record in zip(wish_ids, records)
+                    for presenter_name, date in record.bookings]
+        BookedArchive(db_path).add_many(bookings)
+    return ImportResult(wishes=len(wish_ids), bookings=len(bookings))
+
+
+def import_wishlist(creator_id: int,
+                    creator_name: str,
+                    lines: Iterable[str],
+                    transfer_format: TransferFormat,
+                    db_path: str = DB_PATH,
+                    batch_size: int = IMPORT_BATCH_SIZE,
+                    run_batch: Callable[[Callable[[], ImportResult]], ImportResult] = lambda insert: insert(),
+                    ) -> ImportResult:
+    """Adds the wishes of an exported wishlist to the one of `creator_id`, `batch_size` wishes per transaction.
+
+    `run_batch` executes every batch insert, e.g. on the writer thread. Batches inserted before a malformed record
+    are kept.
+    """
+    result = ImportResult()
+    records = parse_wishlist(creator_id, creator_name, lines, transfer_format)
+    for batch in iter(lambda: list(itertools.islice(records, batch_size)), []):
+        inserted = run_batch(lambda: insert_records(batch, db_path))
+        result.wishes += inserted.wishes
+        result.bookings += inserted.bookings
+    return result
@@ -0,0 +1,91 @@
+import io
+import json
+import os
+import sqlite3
+import threading
+import types
+
+os.environ.setdefault("WISHLIST_BOT_TOKEN", "123:test")
+
+from db import Booked, Wish, book_wish, create_tables_dict, db_ops, remember_user
+from fake_transport import FakeRequest, UpdateFactory, run_bot
+from transfer import TransferFormat, export_wishlist, import_wishlist
+from wishdata import WishData
+
+
+def seed(db_path: str) -> None:
+    create_tables_dict(db_path)
+    Wish(db_path).add_many(WishData(creator_id=1, creator_name="alice", booked=False, presented=False, name=f"wish {i}",
+                                    priority=i % 3, price=10.5, desc='with "quotes", commas\nand lines')
+                           for i in range(5))
+    book_wish(2, 2, "bob", db_path)
+    Booked(db_path).add(1, "alice", 3, "carol", 2, date=1)
+
+
+def test_bulk_ids_are_taken_under_the_write_lock(tmp_path) -> None:
+    db_path = str(tmp_path / "bulk_ids.db")
+    seed(db_path)
+    other = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+    other.execute("BEGIN IMMEDIATE")
+    other.execute("INSERT INTO wish(booked, presented, creator_name, name, creator_id) VALUES (0, 0, 'bob', 'kite', 2)")
+    releaser = threading.Timer(0.05, other.execute, ["COMMIT"])
+    releaser.start()
+    wish_ids = Wish(db_path).add_many(WishData(creator_id=3, creator_name="carol", booked=False, presented=False,
+                                               name=f"bulk {i}") for i in range(3))
+    releaser.join()
+    other.close()
+    assert wish_ids == [7, 8, 9]
+    assert [w.name for w in Wish(db_path).search_wishes(2)] == ["kite"]
+
+
+def test_export_import_round_trip(tmp_path) -> None:
+    db_path = str(tmp_path / "transfer.db")
+    seed(db_path)
+
+    for transfer_format, creator_id, creator_name in [(TransferFormat.CSV, 4, "dave"), (TransferFormat.JSON, 5, "erin")]:
+        exported = export_wishlist(1, transfer_format, db_path)
+        assert isinstance(exported, types.GeneratorType)
+        text = "".join(exported)
+        result = import_wishlist(creator_id, creator_name, io.StringIO(text, newline=""), transfer_format, db_path,
+                                 batch_size=2)
+        assert (result.wishes, result.bookings) == (5, 2)
+
+        original = Wish(db_path).search_wishes(1) + Wish(db_path).search_wishes(1, True)
+        imported = Wish(db_path).search_wishes(creator_id) + Wish(db_path).search_wishes(creator_id, True)
+        assert [(w.name, w.priority, w.price, w.desc, w.booked) for w in imported] == \
+               [(w.name, w.priority, w.price, w.desc, w.booked) for w in original]
+        assert "".join(export_wishlist(creator_id, transfer_format, db_path)).count("carol") == 1
+
+
+def test_imported_bookings_are_attributed_to_nobody(tmp_path) -> None:
+    db_path = str(tmp_path / "forged.db")
+    create_tables_dict(db_path)
+    remember_user(9, "victim", db_path)
+    document = {"name": "bike", "bookings": [{"presenter_name": "victim", "date": 1},
+                                             {"presenter_name": "ghost", "date": 2}]}
+
+    result = import_wishlist(7, "mallory", [json.dumps(document)], TransferFormat.JSON, db_path)
+    remember_user(10, "ghost", db_path)
+
+    assert (result.wishes, result.bookings) == (1, 2)
+    assert Booked(db_path).page(9) == [] and Booked(db_path).page(10) == []
+    with db_ops(db_path, readonly=True) as cur:
+        assert list(cur.execute("SELECT presenter_name, presenter_id FROM booked_archive ORDER BY date")) == \
+               [("victim", None), ("ghost", None)]
+
+
+def test_import_command(tmp_path, monkeypatch) -> None:
+    db_path = str(tmp_path / "import.db")
+    create_tables_dict(db_path)
+    request = FakeRequest()
+    request.files["list-1"] = "name,price\nbike,100\nbook,\n".encode()
+    updates = UpdateFactory()
+
+    run_bot(monkeypatch, db_path, request,
+            [updates.message(7, "/import"), updates.message(7, document=("list-1", "wishes.txt")),
+             updates.message(7, document=("list-1", "wishes.csv"))])
+
+    texts = [call.parameters["text"] for call in request.calls_of("sendMessage")]
+    assert texts[1] == "Please send a .csv or a .json file, or /cancel"
+    assert texts[2] == "Imported 2 wishes and 0 bookings!"
+    assert [(w.name, w.price) for w in Wish(db_path).search_wishes(7)] == [("bike", 100.0), ("book", None)]
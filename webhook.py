@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import secrets
+from typing import Dict, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import Application
+
+from dispatch import UserOrderedDispatcher, update_user_id
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LISTEN = "127.0.0.1"
+DEFAULT_PORT = 8443
+DEFAULT_PATH = "/telegram"
+DEFAULT_MAX_CONCURRENCY = 16
+MAX_BODY_SIZE = 1024 * 1024
+HEADER_TIMEOUT_SECONDS = 10.0
+SECRET_TOKEN_HEADER = "x-telegram-bot-api-secret-token"
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+}
+
+
+class WebhookServer:
+    """Minimal HTTP endpoint receiving Telegram updates and dispatching them to `application`.
+
+    At most `max_concurrency` updates are processed at once, further requests wait for a free slot.
+    The updates of one user are processed one after the other, in the order their requests were read.
+    A request is answered only after its update has been processed.
+    """
+
+    def __init__(self,
+                 application: Application,
+                 listen: str = DEFAULT_LISTEN,
+                 port: int = DEFAULT_PORT,
+                 path: str = DEFAULT_PATH,
+                 secret_token: Optional[str] = None,
+                 max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                 ):
+        self.application = application
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.max_concurrency = max_concurrency
+        self._dispatcher = UserOrderedDispatcher(application, max_concurrency)
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._serve_connection, self.listen, self.port)
+        # the actual port if 0 was requested
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Listening for webhook updates on {self.listen}:{self.port}{self.path}")
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            keep_alive = True
+            while keep_alive:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                status = await self._handle(method, path, headers, body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(
+                    f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                    f"Content-Length: 0\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode()
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ValueError) as e:
+            logger.warning(f"Dropping webhook connection: {e!r}")
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict[str, str], bytes]]:
+        request_line = await asyncio.wait_for(reader.readline(), HEADER_TIMEOUT_SECONDS)
+        if not request_line:
+            return None
+        method, path, _ = request_line.decode("latin-1").split(" ", 2)
+        headers = dict()
+        while True:
+            line = await asyncio.wait_for(reader.readline(), HEADER_TIMEOUT_SECONDS)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, value = line.decode("latin-1").split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0))
+        if length > MAX_BODY_SIZE:
+            raise ValueError(f"body of {length} bytes is too large")
+        body = await reader.readexactly(length) if length else b""
+        return method, path, headers, body
+
+    async def _handle(self, method: str, path: str, headers: Dict[str, str], body: bytes) -> int:
+        if path != self.path:
+            return 404
+        if method != "POST":
+            return 405
+        if self.secret_token is not None and \
+                not secrets.compare_digest(headers.get(SECRET_TOKEN_HEADER, ""), self.secret_token):
+            return 403
+        try:
+            payload = json.loads(body)
+            update = Update.de_json(payload, self.application.bot)
+            user_id = update_user_id(payload)
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            logger.warning(f"Received a malformed update: {e!r}")
+            return 400
+        task = await self._dispatcher.dispatch(user_id, update)
+        await task
+        return 200
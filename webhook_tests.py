@@ -0,0 +1,80 @@
+import asyncio
+import os
+
+import httpx
+
+os.environ.setdefault("WISHLIST_BOT_TOKEN", "123:test")
+
+from db import Wish, create_tables_dict, remember_user
+from fake_transport import FakeRequest, UpdateFactory, run_bot
+from webhook import WebhookServer
+
+
+def test_webhook_dispatches_posted_updates(tmp_path, monkeypatch) -> None:
+    db_path = str(tmp_path / "webhook.db")
+    create_tables_dict(db_path)
+    Wish(db_path).add(creator_id=2, creator_name="user2", name="bike")
+    remember_user(2, "user2", db_path)
+    request = FakeRequest()
+    updates = UpdateFactory()
+
+    async def post_updates(application) -> None:
+        server = WebhookServer(application, port=0, path="/hook", secret_token="s3cret", max_concurrency=4)
+        await server.start()
+        url = f"http://127.0.0.1:{server.port}/hook"
+        headers = {"X-Telegram-Bot-Api-Secret-Token": "s3cret"}
+
+        async with httpx.AsyncClient() as client:
+            async def post(payload) -> int:
+                return (await client.post(url, json=payload, headers=headers)).status_code
+
+            users = range(10, 20)
+            assert await asyncio.gather(*(post(updates.message(user, "/start")) for user in users)) == [200] * 10
+            assert await asyncio.gather(*(post(updates.message(user, "See wishes")) for user in users)) == [200] * 10
+            assert await asyncio.gather(*(post(updates.message(user, "@user2")) for user in users)) == [200] * 10
+
+            assert (await client.post(url, json=updates.message(1, "/start"))).status_code == 403
+            assert (await client.post(url + "x", json=updates.message(1, "/start"), headers=headers)).status_code == 404
+            assert (await client.post(url, content=b"{", headers=headers)).status_code == 400
+
+        await server.stop()
+
+    run_bot(monkeypatch, db_path, request, during=post_updates)
+
+    texts = [call.parameters["text"] for call in request.calls_of("sendMessage")]
+    assert sum(text.startswith("Hi!") for text in texts) == 10
+    assert sum("bike" in text for text in texts) == 10
+
+
+class SlowApplication:
+    """Stands in for the bot, the update "first" takes a while."""
+    bot = None
+
+    def __init__(self):
+        self.processed = []
+
+    async def process_update(self, update) -> None:
+        if update.message.text == "first":
+            await asyncio.sleep(0.2)
+        self.processed.append((update.effective_user.id, update.message.text))
+
+
+def test_webhook_keeps_the_order_of_each_users_updates() -> None:
+    application = SlowApplication()
+    updates = UpdateFactory()
+
+    async def post_updates() -> None:
+        server = WebhookServer(application, port=0, path="/hook", max_concurrency=4)
+        await server.start()
+        url = f"http://127.0.0.1:{server.port}/hook"
+        async with httpx.AsyncClient() as client:
+            first = asyncio.create_task(client.post(url, json=updates.message(1, "first")))
+            await asyncio.sleep(0.05)
+            responses = await asyncio.gather(first, client.post(url, json=updates.message(1, "second")),
+                                             client.post(url, json=updates.message(2, "other")))
+        await server.stop()
+        assert [response.status_code for response in responses] == [200] * 3
+
+    asyncio.run(post_updates())
+
+    assert application.processed == [(2, "other"), (1, "first"), (1, "second")]
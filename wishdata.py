@@ -1,12 +1,108 @@
 from __future__ import annotations
 
+import re
+import sqlite3
 from dataclasses import dataclass
-from typing import Optional, Tuple
+from enum import Enum
+from functools import lru_cache
+from typing import Any, List, Optional, Tuple
 
 PHOTO_PLACEHOLDER = "Some photo"
 
+# characters that have to be escaped anywhere in a MarkdownV2 message, and inside the (...) part of a link
+MARKDOWN_V2_SPECIAL_CHARS = "\\_*[]()~`>#+-=|{}.!"
+MARKDOWN_V2_LINK_SPECIAL_CHARS = "\\)"
+RENDER_CACHE_SIZE = 65536
 
-@dataclass
+# currencies written as a symbol or a word, ISO 4217 codes of `CURRENCY_CODES` are recognized as they are
+CURRENCY_SYMBOLS = {"$": "USD", "€": "EUR", "£": "GBP", "¥": "JPY", "₽": "RUB", "₴": "UAH", "₸": "KZT",
+                    "₹": "INR", "₺": "TRY", "₾": "GEL", "₪": "ILS"}
+CURRENCY_WORDS = {"dollar": "USD", "dollars": "USD", "bucks": "USD", "euro": "EUR", "euros": "EUR",
+                  "pound": "GBP", "pounds": "GBP", "franc": "CHF", "francs": "CHF", "yen": "JPY", "zł": "PLN",
+                  "руб": "RUB", "рубль": "RUB", "рубля": "RUB", "рублей": "RUB", "р": "RUB", "грн": "UAH",
+                  "тенге": "KZT"}
+CURRENCY_CODES = frozenset(["AED", "AMD", "AUD", "AZN", "BGN", "BRL", "BYN", "CAD", "CHF", "CNY", "CZK", "DKK",
+                            "EUR", "GBP", "GEL", "HKD", "HUF", "ILS", "INR", "JPY", "KRW", "KZT", "MXN", "NOK",
+                            "NZD", "PLN", "RON", "RSD", "RUB", "SEK", "SGD", "THB", "TRY", "UAH", "USD"])
+
+_MARKDOWN_V2_SPECIAL = re.compile(f"[{re.escape(MARKDOWN_V2_SPECIAL_CHARS)}]")
+_MARKDOWN_V2_LINK_SPECIAL = re.compile(f"[{re.escape(MARKDOWN_V2_LINK_SPECIAL_CHARS)}]")
+# digits grouped by thousands ("1 500", "1.500.000,50") or plain ("30", "12.5")
+_PRICE_AMOUNT = re.compile(r"\d{1,3}(?:[ \u00a0'.,]\d{3})+(?:[.,]\d+)?(?!\d)|\d+(?:[.,]\d+)?")
+_PRICE_WORD = re.compile(r"[^\W\d_]+")
+
+
+def _escape_match(match: re.Match) -> str:
+    return "\\" + match.group()
+
+
+def escape_markdown_v2(text: str) -> str:
+    """Escapes every MarkdownV2 special character in a single pass over `text`."""
+    return _MARKDOWN_V2_SPECIAL.sub(_escape_match, text)
+
+
+def _parse_amount(text: str) -> float:
+    digits = re.sub("[ \u00a0']", "", text)
+    separators = [c for c in digits if c in ",."]
+    if not separators:
+        return float(digits)
+    decimal = separators[-1]
+    # a single kind of separator groups thousands if it repeats or is followed by three digits: "1,500", "1.500.000"
+    if len(set(separators)) == 1 and (len(separators) > 1 or len(digits) - digits.rfind(decimal) == 4):
+        return float(digits.replace(decimal, ""))
+    integer, _, fraction = digits.rpartition(decimal)
+    return float(re.sub("[,.]", "", integer) + "." + fraction)
+
+
+def _parse_currency(text: str) -> Optional[str]:
+    for symbol, code in CURRENCY_SYMBOLS.items():
+        if symbol in text:
+            return code
+    for word in _PRICE_WORD.findall(text):
+        if word.upper() in CURRENCY_CODES:
+            return word.upper()
+        if word.lower() in CURRENCY_WORDS:
+            return CURRENCY_WORDS[word.lower()]
+    return None
+
+
+def parse_price(price: Any) -> Tuple[Optional[float], Optional[str]]:
+    """Amount and currency of a price as typed by a user, `(30.0, "CHF")` for "about 30 CHF".
+
+    The amount is the first number of the text, either is None when not recognized.
+    """
+    if price is None:
+        return None, None
+    if isinstance(price, (int, float)):
+        return float(price), None
+    match = _PRICE_AMOUNT.search(price)
+    return _parse_amount(match.group()) if match else None, _parse_currency(price)
+
+
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
+def render_wish(name: Optional[str], price: Any, desc: Optional[str], link: Optional[str]) -> str:
+    """MarkdownV2 text of a wish, memoized on the displayed fields."""
+    parts = [f"*name:* {escape_markdown_v2(str(name))}"]
+    if price is not None:
+        parts.append(f"\n*price:* {escape_markdown_v2(str(price))}")
+    if desc is not None:
+        parts.append(f"\n*desc:* {escape_markdown_v2(desc)}")
+    if link is not None:
+        parts.append(f"\n[link]({_MARKDOWN_V2_LINK_SPECIAL.sub(_escape_match, link)})")
+    return "".join(parts)
+
+
+@dataclass(frozen=True)
+class PhotoVariant:
+    """One of the sizes Telegram keeps of a photo, as in a `PhotoSize`."""
+    file_unique_id: str
+    file_id: str
+    width: int
+    height: int
+    file_size: Optional[int] = None
+
+
+@dataclass(slots=True)
 class WishData:
     creator_name: str
 
@@ -23,27 +119,105 @@ class WishData:
     photo_id: Optional[str] = None
     desc: Optional[str] = None
     quantity: Optional[str] = None
+    # Telegram id of the creator, `creator_name` is the username they had when adding the wish
+    creator_id: Optional[int] = None
+    # `price` parsed when the wish was stored
+    price_amount: Optional[float] = None
+    price_currency: Optional[str] = None
+    # `file_unique_id` of the largest variant of the photo, None for photos stored before their variants were
+    photo_unique_id: Optional[str] = None
+    # variants of a photo sent while drafting the wish, stored along with it
+    photo_variants: Optional[List[PhotoVariant]] = None
+
+    @staticmethod
+    def row_factory(cursor: Optional[sqlite3.Cursor], row: Tuple) -> WishData:
+        """`sqlite3` row factory for `SELECT * FROM wish`."""
+        return WishData(row[3], row[1], row[2], row[0], row[4], row[5], row[6], row[7], row[8], row[9], row[10],
+                        row[11], row[12], row[13], row[14], row[15])
 
     @staticmethod
     def from_tuple(t: Tuple) -> WishData:
-        return WishData(
-            wish_id=t[0],
-            booked=t[1],
-            presented=t[2],
-            creator_name=t[3],
-            name=t[4],
-            priority=t[5],
-            relation_type=t[6],
-            link=t[7],
-            price=t[8],
-            photo_id=t[9],
-            desc=t[10],
-            quantity=t[11],
-        )
+        return WishData.row_factory(None, t)
+
+    @staticmethod
+    def booking_row_factory(cursor: Optional[sqlite3.Cursor], row: Tuple) -> Tuple[int, WishData]:
+        """`sqlite3` row factory for `SELECT w.*, b.date` of a booking, makes `(date, wish)` pairs."""
+        return row[-1], WishData.row_factory(cursor, row[:-1])
 
     def __str__(self):
-        name_str = f"*name:* {self.name}"
-        price_str = "" if self.price is None else f"\n*price:* {self.price}"
-        desc_str = "" if self.desc is None else f"\n*desc:* {self.desc}"
-        link_str = "" if self.link is None else f"\n[link]({self.link})"
-        return "".join([name_str, price_str, desc_str, link_str]).replace(".", "\.")  # TODO make proper escaping
+        return render_wish(self.name, self.price, self.desc, self.link)
+
+
+class WishOrder(Enum):
+    """Orders a wishlist can be browsed in."""
+    PRIORITY = "priority"
+    # cheapest first, wishes without a price last
+    PRICE = "price"
+
+
+@dataclass
+class WishPage:
+    creator_id: int
+    creator_name: str
+    number: int
+    first_number: int
+    wishes: List[WishData]
+    has_next: bool
+    order: WishOrder = WishOrder.PRIORITY
+    # only wishes priced at most `max_price`, in `currency` if set
+    max_price: Optional[float] = None
+    currency: Optional[str] = None
+
+    @property
+    def has_previous(self) -> bool:
+        return self.number > 0
+
+    def numbered(self) -> List[Tuple[int, WishData]]:
+        return [(self.first_number + i, wish) for i, wish in enumerate(self.wishes)]
+
+
+@dataclass
+class SearchPage:
+    terms: str
+    number: int
+    first_number: int
+    wishes: List[WishData]
+    has_next: bool
+
+    @property
+    def has_previous(self) -> bool:
+        return self.number > 0
+
+    def numbered(self) -> List[Tuple[int, WishData]]:
+        return [(self.first_number + i, wish) for i, wish in enumerate(self.wishes)]
+
+
+@dataclass
+class FeedPage:
+    number: int
+    first_number: int
+    wishes: List[WishData]
+    has_next: bool
+
+    @property
+    def has_previous(self) -> bool:
+        return self.number > 0
+
+    def numbered(self) -> List[Tuple[int, WishData]]:
+        return [(self.first_number + i, wish) for i, wish in enumerate(self.wishes)]
+
+
+@dataclass
+class BookingsPage:
+    number: int
+    first_number: int
+    # (booking date, wish), most recent booking first
+    bookings: List[Tuple[int, WishData]]
+    has_next: bool
+
+    @property
+    def has_previous(self) -> bool:
+        return self.number > 0
+
+    def numbered(self) -> List[Tuple[int, WishData]]:
+        return [(self.first_number + i, wish) for i, (_, wish) in enumerate(self.bookings)]
@@ -0,0 +1,20 @@
+from wishdata import WishData, escape_markdown_v2, render_wish
+
+
+def test_escape_markdown_v2_covers_every_special_character() -> None:
+    assert escape_markdown_v2("_*[]()~`>#+-=|{}.!\\") == "\\_\\*\\[\\]\\(\\)\\~\\`\\>\\#\\+\\-\\=\\|\\{\\}\\.\\!\\\\"
+    assert escape_markdown_v2("plain text") == "plain text"
+
+
+def test_wish_is_built_from_a_row_and_rendered_once_per_version() -> None:
+    row = (7, 0, 0, "alice", "Lego (big)", None, None, "https://example.com/a_(b)", 9.5, None, "v2.0!", None, 42, 9.5, None, None)
+    wish = WishData.from_tuple(row)
+    assert (wish.wish_id, wish.creator_id, wish.creator_name, wish.name) == (7, 42, "alice", "Lego (big)")
+
+    render_wish.cache_clear()
+    assert str(wish) == "*name:* Lego \\(big\\)\n*price:* 9\\.5\n*desc:* v2\\.0\\!\n[link](https://example.com/a_(b\\))"
+    assert str(WishData.from_tuple(row)) == str(wish)
+    assert render_wish.cache_info().hits == 2
+
+    wish.desc = None
+    assert str(wish) == "*name:* Lego \\(big\\)\n*price:* 9\\.5\n[link](https://example.com/a_(b\\))"
@@ -0,0 +1,130 @@
+from __future__ import annotations
+
+import logging
+import queue
+import random
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Any, Callable, List, Optional
+
+import metrics
+from db import BOOKING_BACKOFF_SECONDS, BOOKING_MAX_ATTEMPTS, BOOKING_MAX_BACKOFF_SECONDS, DB_PATH, db_ops, \
+    is_busy_error
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH_SIZE = 256
+# how long the first write of a batch waits for company, zero to only take what is already queued
+MAX_BATCH_DELAY_SECONDS = 0.0
+
+BATCH_SIZE = metrics.REGISTRY.histogram("wishlist_write_batch_size",
+                                        "Writes committed together by the writer thread",
+                                        buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+WRITE_QUEUE_DEPTH = metrics.REGISTRY.gauge("wishlist_write_queue_depth", "Writes waiting for the writer thread")
+BATCH_RETRIES = metrics.REGISTRY.counter("wishlist_write_batch_retries_total",
+                                         "Batches started again because the database was busy")
+
+
+@dataclass
+class WriteOperation:
+    func: Callable[..., Any]
+    args: tuple
+    kwargs: dict
+    future: Future
+
+
+class GroupCommitWriter:
+    """Single thread applying the writes of `db_path` in batches, one transaction per batch.
+
+    Every write runs in its own savepoint, so a failing write only fails its own future.
+    Futures resolve once the batch is committed. Writes are plain functions doing their own `db_ops`,
+    which join the batch transaction since they run on the writer connection.
+    """
+
+    def __init__(self,
+                 db_path: str = DB_PATH,
+                 max_batch_size: int = MAX_BATCH_SIZE,
+                 max_batch_delay: float = MAX_BATCH_DELAY_SECONDS,
+                 ):
+        self.db_path = db_path
+        self.max_batch_size = max_batch_size
+        self.max_batch_delay = max_batch_delay
+        self._queue: queue.Queue[Optional[WriteOperation]] = queue.Queue()
+        self._thread = threading.Thread(target=self._work, name=f"writer-{db_path}", daemon=True)
+        self._closed = False
+        self._thread.start()
+        WRITE_QUEUE_DEPTH.set_function(self._queue.qsize)
+
+    def submit(self, func: Callable[..., Any], *args, **kwargs) -> Future:
+        """Queues `func(*args, **kwargs)`, the future resolves to its result after the commit."""
+        if self._closed:
+            raise RuntimeError("writer is closed")
+        future = Future()
+        self._queue.put(WriteOperation(func, args, kwargs, future))
+        return future
+
+    def close(self) -> None:
+        """Applies the queued writes and stops the thread."""
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._thread.join()
+
+    def _next_batch(self) -> List[Optional[WriteOperation]]:
+        batch = [self._queue.get()]
+        while batch[-1] is not None and len(batch) < self.max_batch_size:
+            try:
+                batch.append(self._queue.get(timeout=self.max_batch_delay) if self.max_batch_delay
+                             else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _work(self) -> None:
+        while True:
+            batch = self._next_batch()
+            operations = [operation for operation in batch if operation is not None]
+            if operations:
+                self._apply(operations)
+            if len(operations) < len(batch):
+                return
+
+    def _apply(self, operations: List[WriteOperation]) -> None:
+        """Commits `operations` in one transaction.
+
+        A batch finding the write lock taken by another process is started again with the backoff of
+        `db.book_wish`, whose own retries cannot help inside the batch transaction.
+        """
+        BATCH_SIZE.observe(len(operations))
+        backoff = BOOKING_BACKOFF_SECONDS
+        for attempt in range(1, BOOKING_MAX_ATTEMPTS + 1):
+            results = []
+            try:
+                with db_ops(self.db_path, immediate=True) as cur:
+                    for operation in operations:
+                        cur.execute("SAVEPOINT write")
+                        try:
+                            results.append((operation.func(*operation.args, **operation.kwargs), None))
+                        except Exception as e:
+                            cur.execute("ROLLBACK TO write")
+                            results.append((None, e))
+                        cur.execute("RELEASE write")
+            except Exception as e:
+                # only a batch none of whose writes ran yet is started again
+                if not results and is_busy_error(e) and attempt < BOOKING_MAX_ATTEMPTS:
+                    BATCH_RETRIES.inc()
+                    time.sleep(random.uniform(backoff / 2, backoff))
+                    backoff = min(backoff * 2, BOOKING_MAX_BACKOFF_SECONDS)
+                    continue
+                logger.error(f"Committing a batch of {len(operations)} writes failed: {e}")
+                for operation in operations:
+                    operation.future.set_exception(e)
+                return
+            break
+        for operation, (result, error) in zip(operations, results):
+            if error is not None:
+                operation.future.set_exception(error)
+            else:
+                operation.future.set_result(result)
@@ -0,0 +1,80 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from db import BookingOutcome, Wish, book_wish, configure_pool, create_tables_dict, db_ops, get_wish_cache
+from writer import BATCH_RETRIES, GroupCommitWriter
+
+
+def test_writes_are_committed_in_batches(tmp_path) -> None:
+    db_path = str(tmp_path / "writer.db")
+    create_tables_dict(db_path)
+    wish = Wish(db_path)
+    writer = GroupCommitWriter(db_path)
+    release = threading.Event()
+    # holds the writer thread so the following writes queue up into a single batch
+    first = writer.submit(release.wait)
+
+    futures = [writer.submit(wish.add, creator_id=10, creator_name="10", name=f"wish {i}") for i in range(20)]
+    failing = writer.submit(wish.add, creator_id=10, creator_name=None, name="no creator")
+    release.set()
+
+    first.result(timeout=5)
+    assert [future.result(timeout=5) for future in futures] == [None] * 20
+    with pytest.raises(sqlite3.IntegrityError):
+        failing.result(timeout=5)
+    writer.close()
+
+    assert len(wish.search_by_creator_and_booked_value(10)) == 20
+
+
+def test_readers_do_not_wait_for_an_open_batch(tmp_path) -> None:
+    db_path = str(tmp_path / "wal.db")
+    create_tables_dict(db_path)
+    wish = Wish(db_path)
+    wish.add(creator_id=10, creator_name="10", name="bike")
+    writer = GroupCommitWriter(db_path)
+    inside = threading.Event()
+
+    def slow_add() -> None:
+        wish.add(creator_id=10, creator_name="10", name="car")
+        inside.set()
+        time.sleep(0.3)
+
+    future = writer.submit(slow_add)
+    inside.wait(timeout=5)
+    started = time.perf_counter()
+    assert len(wish.search_by_creator_and_booked_value(10)) == 1
+    assert time.perf_counter() - started < 0.1
+    # a list loaded meanwhile is dropped once the batch commits
+    get_wish_cache(db_path).clear()
+    assert [w.name for w in wish.search_wishes(10)] == ["bike"]
+    future.result(timeout=5)
+    writer.close()
+
+    with db_ops(db_path, readonly=True) as cur:
+        assert cur.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+    assert get_wish_cache(db_path).get((10, False)) is None
+    assert [w.name for w in wish.search_wishes(10)] == ["bike", "car"]
+
+
+def test_batches_wait_for_another_process_to_commit(tmp_path) -> None:
+    db_path = str(tmp_path / "busy_writer.db")
+    configure_pool(db_path, busy_timeout=0.01)
+    create_tables_dict(db_path)
+    Wish(db_path).add(creator_id=10, creator_name="10", name="bike")
+    retries = BATCH_RETRIES.labels().value()
+    writer = GroupCommitWriter(db_path)
+
+    other = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+    other.execute("BEGIN IMMEDIATE")
+    releaser = threading.Timer(0.05, other.execute, ["COMMIT"])
+    releaser.start()
+    booking = writer.submit(book_wish, 1, 20, "presenter", db_path)
+    assert booking.result(timeout=5) == BookingOutcome.BOOKED
+    releaser.join()
+    other.close()
+    writer.close()
+    assert BATCH_RETRIES.labels().value() > retries